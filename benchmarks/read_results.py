@@ -0,0 +1,151 @@
+"""
+File: benchmarks/read_results.py
+
+Microbenchmark of the amazed result readers of `SpectrumResults`: the
+vectorised readers against the former per-line Python parsing, in time and
+peak memory.
+
+Example::
+
+    python benchmarks/read_results.py --zpdf_rows 30000 --candidates 5
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from drp_1dpipe.process_spectra.results import (SpectrumResults,
+                                                RedshiftCandidate,
+                                                LineMeasurement,
+                                                candidates_file_type_map,
+                                                linemeas_file_type_map)
+
+
+def _text_rows(path):
+    with open(path, 'r') as f:
+        for l in f:
+            if not l.strip() or l.startswith('#'):
+                continue
+            yield l.split()
+
+
+def read_results_text(output_dir, output_lines_dir):
+    """Former readers : one split and one converter call per field"""
+    candidates = [RedshiftCandidate(*[f(x) for f, x in
+                                      zip(candidates_file_type_map, r)])
+                  for r in _text_rows(os.path.join(output_dir,
+                                                   'candidatesresult.csv'))]
+    zpdf = np.array(list(_text_rows(
+        os.path.join(output_dir, 'zPDF', 'logposterior.logMargP_Z_data.csv'))),
+        dtype=float)
+    models = np.array([[r[1] for r in _text_rows(os.path.join(
+        output_dir, 'linemodelsolve.linemodel_spc_extrema_{}.csv'.format(i)))]
+        for i in range(len(candidates))], dtype=np.float64)
+    linemeas = [LineMeasurement(*[f(x) for f, x in
+                                  zip(linemeas_file_type_map, r)])
+                for r in _text_rows(os.path.join(
+                    output_lines_dir,
+                    'linemodelsolve.linemodel_fit_extrema_0.csv'))]
+    return candidates, zpdf, models, linemeas
+
+
+def read_results_vectorised(output_dir, output_lines_dir):
+    """Vectorised readers of `SpectrumResults`"""
+    results = SpectrumResults(None, output_dir,
+                              output_lines_dir=output_lines_dir)
+    results._read_candidates()
+    results._read_zpdf()
+    results._read_models()
+    results._read_lines()
+    return results.candidates, results.zpdf, results.models, results.linemeas
+
+
+def write_results(output_dir, output_lines_dir, zpdf_rows, npix, ncandidates,
+                  nlines):
+    """Write amazed-like result files of the given sizes"""
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(output_dir, 'zPDF'))
+    with open(os.path.join(output_dir, 'candidatesresult.csv'), 'w') as ff:
+        ff.write("#rank\tIDs\tredshift\tintgProba\tRank_PDF\tDeltaz\t"
+                 "gaussAmp_unused\tgaussAmpErr_unused\tgaussSigma_unused\t"
+                 "gaussSigmaErr_unused\n")
+        for rank in range(ncandidates):
+            ff.write("{}\tEXT{}\t{:.8g}\t{:.8g}\t{}\t{:.8g}\t-1\t-1\t-1\t"
+                     "-1\n".format(rank, rank, *rng.uniform(0., 3., 2), rank,
+                                   rng.uniform()))
+    np.savetxt(os.path.join(output_dir, 'zPDF',
+                            'logposterior.logMargP_Z_data.csv'),
+               np.column_stack((np.linspace(0., 6., zpdf_rows),
+                                rng.normal(-1e3, 1e2, zpdf_rows))),
+               fmt='%.8g', delimiter='\t', header='z\tlogP')
+    wavelength = np.linspace(3800., 12600., npix)
+    for rank in range(ncandidates):
+        np.savetxt(os.path.join(output_dir,
+                                'linemodelsolve.linemodel_spc_extrema_'
+                                '{}.csv'.format(rank)),
+                   np.column_stack((wavelength, rng.normal(1., 0.1, npix))),
+                   fmt='%.8g', delimiter='\t', header='lambda\tflux')
+    with open(os.path.join(output_lines_dir,
+                           'linemodelsolve.linemodel_fit_extrema_0.csv'),
+              'w') as ff:
+        ff.write("#type\tforce\tname\telt_id\t...\n")
+        for k in range(nlines):
+            ff.write("E\tS\tL{}\t{}\t".format(k, k) +
+                     "\t".join("{:.8g}".format(v) for v in rng.normal(size=5)) +
+                     "\t-1\t" +
+                     "\t".join("{:.8g}".format(v) for v in rng.normal(size=8)) +
+                     "\n")
+
+
+def bench(read, args, repeat):
+    """Best time over `repeat` calls in milliseconds, and peak memory in MB"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        read(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    read(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return 1e3 * best, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='read_results',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--zpdf_rows', type=int, default=30000,
+                        help='Number of rows of the zPDF file.')
+    parser.add_argument('--npix', type=int, default=11640,
+                        help='Number of rows of each model file.')
+    parser.add_argument('--candidates', type=int, default=5,
+                        help='Number of redshift candidates.')
+    parser.add_argument('--lines', type=int, default=50,
+                        help='Number of line measurements.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = os.path.join(tmp, 'spc')
+        output_lines_dir = os.path.join(tmp, 'spc-lf')
+        os.makedirs(output_lines_dir)
+        write_results(output_dir, output_lines_dir, args.zpdf_rows, args.npix,
+                      args.candidates, args.lines)
+        for label, read in (('per-line Python', read_results_text),
+                            ('vectorised', read_results_vectorised)):
+            elapsed, peak = bench(read, (output_dir, output_lines_dir),
+                                  args.repeat)
+            print("{:<16} {:9.2f} ms/spectrum {:9.2f} MB peak".format(
+                label, elapsed, peak))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+File: benchmarks/read_spectrum.py
+
+Microbenchmark of the spectrum reader: the memory-mapped selective reader
+of `drp_1dpipe.io.reader` against the former `PfsObject.readFits` path.
+
+Example::
+
+    python benchmarks/read_spectrum.py --count 200 --repeat 3
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from pfs.datamodel.drp import PfsObject
+from pylibamazed.redshift import (CSpectrumSpectralAxis,
+                                  CSpectrumFluxAxis_withError,
+                                  CSpectrum)
+
+from drp_1dpipe.io.reader import SpectrumHandle
+from drp_1dpipe.process_spectra.synthetic import generate_spectra
+
+
+def read_spectrum_readfits(path):
+    """Former reader : full PfsObject read and several copies"""
+    obj = PfsObject.readFits(path)
+    valid = np.where(obj.mask == 0, True, False)
+    wavelength = np.array(np.extract(valid, obj.wavelength), dtype=np.float32)
+    flux = np.array(np.extract(valid, obj.flux), dtype=np.float32)
+    error = np.array(np.extract(valid, np.sqrt(obj.covar[0][0:])), dtype=np.float32)
+    spectralaxis = CSpectrumSpectralAxis(wavelength * 10.0)
+    signal = CSpectrumFluxAxis_withError(flux, error)
+    spectrum = CSpectrum(spectralaxis, signal)
+    spectrum.SetName(os.path.basename(path))
+    return spectrum
+
+
+def read_spectrum_memmap(path):
+    """Memory-mapped selective reader"""
+    return SpectrumHandle(path).spectrum
+
+
+def bench(read, paths, repeat):
+    """Best time per file over `repeat` passes, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            read(path)
+        best = min(best, time.perf_counter() - start)
+    return 1e3 * best / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='read_spectrum',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--count', type=int, default=200,
+                        help='Number of distinct spectra files.')
+    parser.add_argument('--npix', type=int, default=11640,
+                        help='Number of pixels per spectrum.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed passes.')
+    parser.add_argument('--spectra_dir',
+                        help='Directory of spectra to read instead of '
+                        'generated ones.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.spectra_dir:
+            spectra_dir = args.spectra_dir
+            names = sorted(os.listdir(spectra_dir))[:args.count]
+        else:
+            spectra_dir = tmp
+            names = generate_spectra(spectra_dir, args.count,
+                                     unique=args.count, npix=args.npix)
+        paths = [os.path.join(spectra_dir, name) for name in names]
+        # warm the page cache so that both readers see the same I/O
+        bench(read_spectrum_memmap, paths, 1)
+        for label, read in (('PfsObject.readFits', read_spectrum_readfits),
+                            ('memory-mapped', read_spectrum_memmap)):
+            print("{:<20} {:8.3f} ms/spectrum".format(
+                label, bench(read, paths, args.repeat)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
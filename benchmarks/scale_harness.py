@@ -0,0 +1,141 @@
+"""
+File: benchmarks/scale_harness.py
+
+End-to-end scale test of drp_1dpipe with the SYNTHETIC process method.
+
+For each requested number of spectra, fake pfsObject files are generated,
+drp_1dpipe is run with synthetic amazed results and the wall time of each
+pipeline stage is reported, along with the overhead of process_spectra over
+the synthetic cost itself.
+
+Example::
+
+    python benchmarks/scale_harness.py --sizes 10000 100000 1000000 \\
+        --concurrency 32 --bunch_size 1000 --synthetic_cost constant:0
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from drp_1dpipe.process_spectra.synthetic import generate_spectra
+
+
+def define_program_options():
+    parser = argparse.ArgumentParser(
+        prog='scale_harness',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='Numbers of spectra to process.')
+    parser.add_argument('--workdir', default='scale_harness',
+                        help='Base working directory.')
+    parser.add_argument('--unique', type=int, default=100,
+                        help='Number of distinct spectra files, the other '
+                        'ones being symbolic links.')
+    parser.add_argument('--npix', type=int, default=11640,
+                        help='Number of pixels of generated spectra.')
+    parser.add_argument('--scheduler', default='local',
+                        help='drp_1dpipe scheduler.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='drp_1dpipe concurrency.')
+    parser.add_argument('--bunch_size', type=int, default=1000,
+                        help='drp_1dpipe bunch size.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='process_spectra workers per bunch.')
+    parser.add_argument('--lineflux', choices=['on', 'off'], default='on',
+                        help='Whether to run the line measurement pass.')
+    parser.add_argument('--synthetic_cost', default='constant:0',
+                        help='Per-spectrum cost distribution.')
+    parser.add_argument('--extra', nargs=argparse.REMAINDER, default=[],
+                        help='Extra drp_1dpipe arguments.')
+    return parser
+
+
+def run_size(args, size):
+    """Generate spectra and run drp_1dpipe on them
+
+    Returns
+    -------
+    dict
+        Stage wall times, process_spectra timing report and overheads
+    """
+    workdir = os.path.abspath(os.path.join(args.workdir, 'N{}'.format(size)))
+    spectra_dir = os.path.join(workdir, 'spectra')
+    output_dir = os.path.join(workdir, 'output')
+    start = time.perf_counter()
+    generate_spectra(spectra_dir, size, unique=args.unique, npix=args.npix)
+    generation = time.perf_counter() - start
+
+    task = ['drp_1dpipe',
+            '--workdir={}'.format(workdir),
+            '--spectra_dir={}'.format(spectra_dir),
+            '--output_dir={}'.format(output_dir),
+            '--logdir={}'.format(os.path.join(workdir, 'log')),
+            '--scheduler={}'.format(args.scheduler),
+            '--concurrency={}'.format(args.concurrency),
+            '--bunch_size={}'.format(args.bunch_size),
+            '--workers={}'.format(args.workers),
+            '--lineflux={}'.format(args.lineflux),
+            '--process_method=SYNTHETIC',
+            '--synthetic_cost={}'.format(args.synthetic_cost)]
+    task.extend(args.extra)
+    start = time.perf_counter()
+    subprocess.run(task, check=True)
+    wall = time.perf_counter() - start
+
+    with open(os.path.join(output_dir, 'scheduler_timing.json'), 'r') as f:
+        stages = json.load(f)
+    report_path = os.path.join(output_dir, 'timing_report.json')
+    if os.path.exists(report_path):
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+    else:
+        report = {'spectra': 0, 'stages': {}}
+
+    # time process_spectra would take with no overhead at all
+    parallelism = max(1, args.concurrency) * max(1, args.workers)
+    spectra_time = report['stages'].get('total', {}).get('total', 0.)
+    ideal = spectra_time / parallelism
+    return {'size': size,
+            'generation': generation,
+            'wall': wall,
+            'stages': stages,
+            'spectra': report['spectra'],
+            'spectra_time': spectra_time,
+            'process_spectra_overhead': stages.get('process_spectra', 0.) - ideal}
+
+
+def print_report(results):
+    columns = ['pre_process', 'process_spectra', 'merge_bunches',
+               'merge_results', 'cleanup', 'scheduler', 'total']
+    print("{:>9} {:>9} ".format('spectra', 'done') +
+          " ".join("{:>15}".format(c) for c in columns) +
+          " {:>15}".format('ps overhead'))
+    for r in results:
+        print("{:>9} {:>9} ".format(r['size'], r['spectra']) +
+              " ".join("{:>14.2f}s".format(r['stages'].get(c, float('nan')))
+                       for c in columns) +
+              " {:>14.2f}s".format(r['process_spectra_overhead']))
+
+
+def main():
+    args = define_program_options().parse_args()
+    results = []
+    for size in args.sizes:
+        results.append(run_size(args, size))
+        print_report(results[-1:])
+    os.makedirs(args.workdir, exist_ok=True)
+    with open(os.path.join(args.workdir, 'scale_report.json'), 'w') as f:
+        json.dump(results, f, indent=4)
+    print()
+    print_report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,74 @@
 import os
 import json
+import math
+import heapq
 import subprocess
 import uuid
-from drp_1dpipe.core.utils import normpath, wait_semaphores, convert_dl_to_ld
+from drp_1dpipe.core.utils import normpath, convert_dl_to_ld
 from drp_1dpipe.core.engine.runner import Runner
+from drp_1dpipe.core.watcher import wait_files, JobError
+
+
+def parse_walltime(walltime):
+    """Seconds of a [[HH:]MM:]SS walltime"""
+    seconds = 0
+    for field in str(walltime).split(':'):
+        seconds = 60 * seconds + int(field)
+    return seconds
+
+
+def format_walltime(seconds):
+    """HH:MM:SS walltime of a number of seconds, rounded up to the minute"""
+    minutes = max(1, int(math.ceil(seconds / 60.)))
+    return '{:02d}:{:02d}:00'.format(minutes // 60, minutes % 60)
+
+
+def array_elements(ntasks, slots, costs=None, budget=None):
+    """Group tasks into array elements running `slots` tasks at once
+
+    Without costs, each element gets `slots` tasks, run in a single wave.
+    With costs, tasks are taken longest first and given to the first element
+    where the least loaded slot still ends within `budget`, a new element
+    being opened when none does.
+
+    Parameters
+    ----------
+    ntasks : int
+        Number of tasks
+    slots : int
+        Number of tasks run at once by an element
+    costs : list, optional
+        Predicted duration of each task in seconds, by default None
+    budget : float, optional
+        Largest predicted duration of an element in seconds, by default no
+        limit
+
+    Returns
+    -------
+    list, list
+        Task indexes of each element, and predicted duration of each
+        element in seconds (None without costs)
+    """
+    slots = max(1, int(slots))
+    if costs is None:
+        elements = [list(range(start, min(start + slots, ntasks)))
+                    for start in range(0, ntasks, slots)]
+        return elements, [None] * len(elements)
+    elements = []
+    # end time of each slot of each element
+    loads = []
+    for i in sorted(range(ntasks), key=lambda i: -costs[i]):
+        for element, load in zip(elements, loads):
+            if budget is None or load[0] + costs[i] <= budget:
+                break
+        else:
+            element, load = [], [0.] * slots
+            elements.append(element)
+            loads.append(load)
+        element.append(i)
+        heapq.heapreplace(load, load[0] + costs[i])
+    return elements, [max(load) for load in loads]
+
 
 class BatchQueue(Runner):
 
@@ -12,6 +77,98 @@ class BatchQueue(Runner):
 
     parallel_script_template = "# Batch script for parallel task"
 
+    # interval between two job state checks, in seconds
+    state_interval = 5.
+
+    # time left after a job end for its `.done` files to show up on a
+    # network filesystem, in seconds
+    grace = 60.
+
+    # requested walltime of an array element, relative to its predicted
+    # duration, and extra seconds for its startup
+    walltime_margin = 1.5
+    walltime_startup = 120.
+
+    def __init__(self, config, tmpcontext=None, logger=None):
+        super().__init__(config, tmpcontext=tmpcontext, logger=logger)
+        self.cores_per_node = max(1, int(getattr(config, 'cores_per_node', 1)))
+        self.walltime = getattr(config, 'walltime', '01:00:00')
+        self.array_throttle = int(getattr(config, 'array_throttle', 0))
+
+    def parse_job_id(self, output):
+        """Job id from the output of the batch submitter, None if unknown"""
+        return None
+
+    def job_state_command(self, job_id):
+        """Command showing the state of a job, None if not supported"""
+        return None
+
+    def job_ended(self, result):
+        """Whether a job state command result shows the job has ended"""
+        return False
+
+    def job_alive(self, job_id):
+        """Whether a job is still queued or running
+
+        The job is considered alive when its state can not be checked.
+        """
+        command = self.job_state_command(job_id)
+        if command is None:
+            return True
+        try:
+            result = subprocess.run(command, capture_output=True, text=True)
+        except OSError:
+            return True
+        return not self.job_ended(result)
+
+    def submit(self, batch_script_name):
+        """Submit a batch script, returning its job id"""
+        result = subprocess.run([self.batch_submitter, batch_script_name],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError("{} {} failed : {}".format(
+                self.batch_submitter, batch_script_name,
+                result.stderr.strip()))
+        job_id = self.parse_job_id(result.stdout)
+        self.logger.info("Submitted {} as job {}".format(batch_script_name,
+                                                         job_id))
+        return job_id
+
+    def wait(self, job_id, semaphores, on_done=None):
+        """Wait for the `.done` files of a job
+
+        Parameters
+        ----------
+        job_id : str
+            Job id, None if unknown
+        semaphores : list
+            `.done` files of the job tasks
+        on_done : callable, optional
+            Function called with the index and exit code of each task as soon
+            as its `.done` file is written, by default None
+
+        Raises
+        ------
+        JobError
+            If a task exited with a non-zero code, or if the job ended
+            without writing the `.done` file of a task
+        """
+        job_alive = None
+        if job_id is not None:
+            def job_alive():
+                return self.job_alive(job_id)
+        on_file = None
+        if on_done is not None:
+            indexes = {path: i for i, path in enumerate(semaphores)}
+            def on_file(path, code):
+                on_done(indexes[path], code)
+        codes = wait_files(semaphores, job_alive=job_alive,
+                           state_interval=self.state_interval,
+                           grace=self.grace, on_file=on_file)
+        failures = {path: code for path, code in codes.items() if code != 0}
+        if failures:
+            raise JobError(failures)
+
     def single(self, command, args):
         """Run a single command using batch queue."""
 
@@ -32,18 +189,23 @@ class BatchQueue(Runner):
         self.tmpcontext.add_files(batch_script_name)
 
         # run batch
-        result = subprocess.run([self.batch_submitter, batch_script_name])
-        assert result.returncode == 0
+        job_id = self.submit(batch_script_name)
 
         # block until completion
         semaphores = [normpath(self.workdir, '{}.done'.format(task_id))]
         self.tmpcontext.add_files(*semaphores)
-        wait_semaphores(semaphores)
+        self.wait(job_id, semaphores)
         return batch_script_name
 
-    def parallel(self, command, parallel_args=None, args=None):
+    def parallel(self, command, parallel_args=None, args=None, on_done=None,
+                 costs=None):
         """Execute parallel task for batch runners
 
+        Tasks are grouped into the elements of an array job, each running
+        its tasks concurrently on `cores_per_node` cores, and sized from the
+        task costs to end within the `walltime` budget (see
+        `array_elements`). At most `array_throttle` elements run at once.
+
         Parameters
         ----------
         command : str
@@ -52,6 +214,11 @@ class BatchQueue(Runner):
             command line arguments to related to each parallel task, by default None
         args : dict, optional
             command line arguments common to all parallel tasks, by default None
+        on_done : callable, optional
+            Function called with the index and exit code of each task as soon
+            as it ends, by default None
+        costs : list, optional
+            Predicted duration of each task in seconds, by default None
         """
         task_id = uuid.uuid4().hex
         executor_script = normpath(self.workdir, 'batch_executor_{}.py'.format(task_id))
@@ -106,9 +273,35 @@ class BatchQueue(Runner):
         #     notifier.update('{}-{}'.format(command, i), state='WAITING')
         # notifier.update(command, 'RUNNING')
 
+        # a task with worker processes takes as many cores
+        slots = max(1, self.cores_per_node // max(1, int(args.get('workers') or 1)))
+        budget = parse_walltime(self.walltime)
+        elements, durations = array_elements(
+            len(tasks), slots, costs=costs,
+            budget=max(0., budget / self.walltime_margin - self.walltime_startup))
+        if costs is None:
+            walltime = self.walltime
+        else:
+            longest = max(durations, default=0.)
+            walltime = format_walltime(min(
+                budget, longest * self.walltime_margin + self.walltime_startup))
+            if longest * self.walltime_margin + self.walltime_startup > budget:
+                self.logger.warning("Array elements predicted to exceed the "
+                                    "{} walltime budget".format(self.walltime))
+        self.logger.info("{} tasks in {} array elements of {} cores, walltime "
+                         "{}".format(len(tasks), len(elements),
+                                     self.cores_per_node, walltime))
+
+        # each task writes its exit code to its own .done file
+        semaphores = [normpath(self.workdir, f'{task_id}_{i}.done')
+                      for i in range(1, len(tasks)+1)]
+
         # generate batch script
         with open(os.path.join(os.path.dirname(__file__), 'resources', 'executor.py.in'), 'r') as f:
-            batch_executor = f.read().format(tasks=tasks, notification_url='')
+            batch_executor = f.read().format(
+                tasks=tasks, elements=elements, done_files=semaphores,
+                slots=slots,
+                notification_url='')
             # batch_executor = f.read().format(tasks=tasks,
             #                                  notification_url=(notifier.pipeline_url
             #                                                    if notifier.pipeline_url
@@ -117,8 +310,12 @@ class BatchQueue(Runner):
             executor.write(batch_executor)
 
         # generate batch script
-        ntasks = len(tasks)
-        script = self.parallel_script_template.format(jobs=ntasks,
+        throttle = '%{}'.format(self.array_throttle) \
+            if self.array_throttle > 0 else ''
+        script = self.parallel_script_template.format(jobs=len(elements),
+                                                      throttle=throttle,
+                                                      cores=self.cores_per_node,
+                                                      walltime=walltime,
                                                       workdir=normpath(self.workdir),
                                                       venv=self.venv,
                                                       executor_script=executor_script,
@@ -130,13 +327,10 @@ class BatchQueue(Runner):
         self.tmpcontext.add_files(batch_script_name)
 
         # run batch
-        result = subprocess.run([self.batch_submitter, batch_script_name])
-        assert result.returncode == 0
+        job_id = self.submit(batch_script_name)
 
         # wait all sub-tasks
-        semaphores = [normpath(self.workdir, f'{task_id}_{i}.done')
-                      for i in range(1, ntasks+1)]
         self.tmpcontext.add_files(*semaphores)
 
-        wait_semaphores(semaphores)
+        self.wait(job_id, semaphores, on_done=on_done)
         # notifier.update(command, 'SUCCESS')
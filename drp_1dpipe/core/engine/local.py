@@ -34,7 +34,8 @@ class Local(Runner):
     #             notifier.update(node_id, state='SUCCESS')
     #     return process_callback
 
-    def parallel(self, command, parallel_args=None, args=None):
+    def parallel(self, command, parallel_args=None, args=None, on_done=None,
+                 costs=None):
         """Run a parallel command on local host
 
         Parameters
@@ -45,6 +46,11 @@ class Local(Runner):
             command line arguments related to each parallel task, by default None
         args : :obj:`dict`, optional
             command line arguments common to all tasks, by default None
+        on_done : callable, optional
+            Function called with the index and exit code of each task as soon
+            as it ends, by default None
+        costs : list, optional
+            Predicted duration of each task, unused by local runners
         """
         # read list of tasks
         # with open(filelist, 'r') as f:
@@ -89,6 +95,14 @@ class Local(Runner):
                 tasks.append(task)
                 # args['notifier'].update('{}-{}'.format(command, i),
                 #                         state='RUNNING')
+            if on_done is not None:
+                indexes = {f: i for i, f in enumerate(futures)}
+                for f in concurrent.futures.as_completed(futures):
+                    try:
+                        returncode = f.result().returncode
+                    except Exception:
+                        returncode = None
+                    on_done(indexes[f], returncode)
 
         return tasks
         # if any([f.result().returncode != 0 for f in futures]):
@@ -0,0 +1,190 @@
+import importlib
+import multiprocessing
+import traceback
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+from drp_1dpipe.core.argparser import define_global_program_options
+from drp_1dpipe.core.utils import (convert_dl_to_ld, config_update,
+                                   config_save, get_conf_path)
+from drp_1dpipe.core.engine.runner import register_runner
+from drp_1dpipe.core.engine.local import Local
+
+# number of times a task is run again after the crash of its worker
+_crash_retries = 1
+
+# task states shared with the workers of a pool
+_NOT_STARTED, _RUNNING, _ENDED = 0, 1, 2
+_states = None
+
+
+def _module_name(command):
+    """Module of a drp_1dpipe command"""
+    return 'drp_1dpipe.{0}.{0}'.format(command)
+
+
+def run_task(command, task):
+    """Run a drp_1dpipe command in the current process
+
+    The command line is parsed as by the command entry point, then its
+    `main_method` is called. Modules imported and setups cached by a former
+    task are reused.
+
+    Parameters
+    ----------
+    command : str
+        drp_1dpipe command, as `process_spectra`
+    task : list
+        Command line arguments
+
+    Returns
+    -------
+    int, str
+        Exit code of the command, and error message (None on success)
+    """
+    try:
+        module = importlib.import_module(_module_name(command))
+        parser = module.define_specific_program_options()
+        define_global_program_options(parser)
+        args = parser.parse_args(task)
+        config = config_update(
+            module.config_defaults,
+            args=vars(args),
+            install_conf_path=get_conf_path('{}.json'.format(command)))
+        config_save(config, '{}_config.json'.format(command))
+        return module.main_method(config) or 0, None
+    except SystemExit as e:
+        # argparse errors
+        return e.code or 1, 'exit {}'.format(e.code)
+    except Exception:
+        return 1, traceback.format_exc()
+
+
+def _init_worker(states):
+    global _states
+    _states = states
+
+
+def _run_pool_task(command, task, i):
+    """Run a task in a pool worker, flagging it as running until it ends
+
+    A task killing its worker is left flagged as running.
+    """
+    _states[i] = _RUNNING
+    result = run_task(command, task)
+    _states[i] = _ENDED
+    return result
+
+
+class LocalPool(Local):
+    """Local runner keeping worker processes warm across tasks
+
+    Parallel tasks of drp_1dpipe commands are run by a pool of long-lived
+    processes, forked once the command module is imported, calling the
+    command `main_method` task after task instead of starting a new
+    interpreter per task. Setups cached by the command, as the amazed
+    catalogs and parameter stores of process_spectra, are kept across tasks.
+
+    A failing task does not stop the others. When a worker crashes, the whole
+    pool breaks : tasks not started yet are run again in a new pool, and
+    tasks which were running are run again one at a time, so that a crash is
+    only counted against the task that caused it. Failed tasks are saved in `failures` and
+    reported by a `RuntimeError` once all tasks are done.
+    """
+
+    def parallel(self, command, parallel_args=None, args=None, on_done=None,
+                 costs=None):
+        """Run a parallel command in warm worker processes
+
+        Parameters
+        ----------
+        command : str
+            drp_1dpipe command to execute
+        parallel_args : :obj:`dict`, optional
+            command line arguments related to each parallel task, by default None
+        args : :obj:`dict`, optional
+            command line arguments common to all tasks, by default None
+        on_done : callable, optional
+            Function called with the index and exit code of each task as soon
+            as it ends, by default None
+        costs : list, optional
+            Predicted duration of each task, unused by local runners
+
+        Returns
+        -------
+        list
+            Command line of each task
+
+        Raises
+        ------
+        RuntimeError
+            If any task failed
+        """
+        pll_args = convert_dl_to_ld(parallel_args)
+        extra_args = ['--{}={}'.format(k, v) for k, v in (args or {}).items()]
+        tasks = [['--{}={}'.format(k, v) for k, v in arg_value.items()]
+                 + extra_args for arg_value in pll_args]
+
+        # imported once, before workers are forked
+        importlib.import_module(_module_name(command))
+        concurrency = self.concurrency if self.concurrency > 0 else None
+        self.failures = []
+        context = multiprocessing.get_context('fork')
+        pending = list(range(len(tasks)))
+        # tasks running when a pool broke, to be run alone
+        suspects = []
+        crashes = [0] * len(tasks)
+        while pending or suspects:
+            if suspects:
+                batch, workers = [suspects.pop(0)], 1
+            else:
+                batch, workers, pending = pending, concurrency, []
+            states = context.RawArray('b', len(tasks))
+            broken = []
+            with concurrent.futures.ProcessPoolExecutor(
+                    workers, mp_context=context, initializer=_init_worker,
+                    initargs=(states,)) as executor:
+                futures = {executor.submit(_run_pool_task, command, tasks[i],
+                                           i): i
+                           for i in batch}
+                for future in concurrent.futures.as_completed(futures):
+                    i = futures[future]
+                    try:
+                        returncode, message = future.result()
+                    except BrokenProcessPool:
+                        broken.append(i)
+                        continue
+                    if returncode != 0:
+                        self._fail(command, tasks[i], message)
+                    if on_done is not None:
+                        on_done(i, returncode)
+            if len(batch) > 1 and broken:
+                running = [i for i in broken
+                           if states[i] == _RUNNING] or broken
+                pending.extend(i for i in broken if i not in running)
+                if len(running) > 1:
+                    # any of them may have crashed the pool
+                    suspects.extend(running)
+                    continue
+                broken = running
+            for i in broken:
+                crashes[i] += 1
+                if crashes[i] <= _crash_retries:
+                    pending.append(i)
+                    continue
+                self._fail(command, tasks[i], 'worker crashed')
+                if on_done is not None:
+                    on_done(i, None)
+
+        if self.failures:
+            raise RuntimeError("{} of {} {} tasks failed".format(
+                len(self.failures), len(tasks), command))
+        return [[command] + task for task in tasks]
+
+    def _fail(self, command, task, message):
+        self.logger.error("{} {} failed : {}".format(command, ' '.join(task),
+                                                     message))
+        self.failures.append(([command] + task, message))
+
+
+register_runner(LocalPool)
@@ -19,14 +19,30 @@ class PBS(BatchQueue):
 
     parallel_script_template = textwrap.dedent("""\
                 #PBS -N {executor_script}
-                #PBS -l nodes=1:ppn=1
-                #PBS -l walltime=01:00:00
-                #PBS -t 1-{jobs}
+                #PBS -l nodes=1:ppn={cores}
+                #PBS -l walltime={walltime}
+                #PBS -t 1-{jobs}{throttle}
                 cd {workdir}
                 source {venv}/bin/activate
                 /usr/bin/env python3 {executor_script} ${{PBS_ARRAYID}} >> out-{task_id}-${{PBS_ARRAYID}}.txt
-                echo "$?" >> {workdir}/{task_id}_${{PBS_ARRAYID}}.done
                 """)
 
+    def parse_job_id(self, output):
+        # <id>.<server>, or <id>[].<server> for job arrays
+        return output.strip() or None
+
+    def job_state_command(self, job_id):
+        return ['qstat', '-t', job_id]
+
+    def job_ended(self, result):
+        if result.returncode == 0:
+            # completed jobs kept in the queue
+            rows = [line.split() for line in result.stdout.splitlines()]
+            states = [row[4] for row in rows
+                      if len(row) > 4 and row[0][0].isdigit()]
+            return bool(states) and all(s in ('C', 'F') for s in states)
+        return ('Unknown Job Id' in result.stderr
+                or 'has finished' in result.stderr)
+
 
 register_runner(PBS)
@@ -86,7 +86,8 @@ class Runner:
         """        
         raise NotImplementedError
 
-    def parallel(self, command, parallel_args, args):
+    def parallel(self, command, parallel_args, args, on_done=None,
+                 costs=None):
         """Run a parallel command task.
 
         Parameters
@@ -97,6 +98,12 @@ class Runner:
             command line arguments related to each parallel task
         args : [type]
             command line arguments common to all parallel tasks
+        on_done : callable, optional
+            Function called with the index and exit code of each task as soon
+            as it ends, the exit code being None when unknown
+        costs : list, optional
+            Predicted duration of each task in seconds, used by batch runners
+            to size their jobs
 
         Raises
         ------
@@ -26,15 +26,28 @@ class Slurm(BatchQueue):
                 #!/bin/bash
                 #SBATCH --export=NONE
                 #SBATCH --job-name={executor_script}
-                #SBATCH --time=01:00:00
+                #SBATCH --time={walltime}
                 #SBATCH --ntasks=1
-                #SBATCH --array=1-{jobs}
+                #SBATCH --cpus-per-task={cores}
+                #SBATCH --array=1-{jobs}{throttle}
 
                 cd {workdir}
                 source {venv}/bin/activate
                 /usr/bin/env python3 {executor_script} ${{SLURM_ARRAY_TASK_ID}} >> out-{task_id}-${{SLURM_ARRAY_TASK_ID}}.txt
-                echo "$?" >> {workdir}/{task_id}_${{SLURM_ARRAY_TASK_ID}}.done
                 """)
 
+    def parse_job_id(self, output):
+        # Submitted batch job <id>
+        words = output.split()
+        return words[-1] if words else None
+
+    def job_state_command(self, job_id):
+        return ['squeue', '--noheader', '--jobs', job_id, '--format', '%T']
+
+    def job_ended(self, result):
+        if result.returncode == 0:
+            return not result.stdout.strip()
+        return 'Invalid job id' in result.stderr
+
 
 register_runner(Slurm)
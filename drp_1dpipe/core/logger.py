@@ -18,6 +18,10 @@ def init_logger(process_name, logdir, loglevel, console=False):
 
     logger = logging.getLogger(process_name)
     logger.setLevel(loglevel)
+    # a process running several tasks logs each one to its own file
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
     formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
 
     # file handler
@@ -0,0 +1,160 @@
+import time
+import queue
+import threading
+import concurrent.futures
+
+_end_of_items = object()
+
+
+class Prefetcher:
+    """Iterate over items loaded ahead of time in a background thread
+
+    At most `depth` loaded items wait in the queue. Iterating gives
+    `(item, result, error)` tuples in `items` order, where `error` is the
+    exception raised by `load` if any.
+
+    Attributes
+    ----------
+    stall_time : float
+        Time spent by the consumer waiting for a loaded item, in seconds
+    depths : list
+        Queue depth seen by the consumer at each item
+    """
+
+    def __init__(self, items, load, depth):
+        """Constructor
+
+        Parameters
+        ----------
+        items : iterable
+            Items to load
+        load : callable
+            Function called on each item in the background thread
+        depth : int
+            Maximum number of loaded items waiting to be consumed
+        """
+        self._items = items
+        self._load = load
+        self._queue = queue.Queue(maxsize=max(1, int(depth)))
+        self._stop = threading.Event()
+        self.stall_time = 0.
+        self.depths = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, value):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        for item in self._items:
+            try:
+                value = (item, self._load(item), None)
+            except Exception as e:
+                value = (item, None, e)
+            if not self._put(value):
+                return
+        self._put(_end_of_items)
+
+    def __iter__(self):
+        try:
+            while True:
+                self.depths.append(self._queue.qsize())
+                start = time.perf_counter()
+                value = self._queue.get()
+                self.stall_time += time.perf_counter() - start
+                if value is _end_of_items:
+                    return
+                yield value
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the background thread"""
+        self._stop.set()
+        self._thread.join()
+
+    def report(self):
+        """One line summary of queue depths and stall time"""
+        mean_depth = (sum(self.depths) / len(self.depths)) if self.depths else 0.
+        return ("prefetch : mean queue depth {:.2f}, max queue depth {}, "
+                "stall time {:.3f}s".format(mean_depth, max(self.depths, default=0),
+                                            self.stall_time))
+
+
+class WriteBehind:
+    """Run tasks in a background thread, off the critical path
+
+    At most `depth` tasks are pending; submitting more blocks until the
+    oldest one completes. Results are collected in submission order.
+
+    Attributes
+    ----------
+    stall_time : float
+        Time spent by the submitter waiting for pending tasks, in seconds
+    max_pending : int
+        Maximum number of pending tasks seen at submission
+    """
+
+    def __init__(self, depth):
+        """Constructor
+
+        Parameters
+        ----------
+        depth : int
+            Maximum number of pending tasks
+        """
+        self.depth = max(1, int(depth))
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._futures = []
+        self._done = 0
+        self.stall_time = 0.
+        self.max_pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _pending(self):
+        while self._done < len(self._futures) and self._futures[self._done].done():
+            self._done += 1
+        return len(self._futures) - self._done
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit a task, waiting if too many tasks are pending"""
+        pending = self._pending()
+        self.max_pending = max(self.max_pending, pending)
+        if pending >= self.depth:
+            start = time.perf_counter()
+            concurrent.futures.wait(self._futures[self._done:len(self._futures) - self.depth + 1])
+            self.stall_time += time.perf_counter() - start
+        self._futures.append(self._executor.submit(fn, *args, **kwargs))
+
+    def results(self):
+        """Wait for all tasks and return their results in submission order
+
+        Raises
+        ------
+        Exception
+            The first exception raised by a task
+        """
+        try:
+            return [f.result() for f in self._futures]
+        finally:
+            self.close()
+
+    def close(self):
+        """Wait for the tasks already submitted and stop the thread"""
+        self._executor.shutdown(wait=True)
+
+    def report(self):
+        """One line summary of pending tasks and stall time"""
+        return ("write-behind : max pending writes {}, "
+                "stall time {:.3f}s".format(self.max_pending, self.stall_time))
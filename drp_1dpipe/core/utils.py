@@ -1,11 +1,10 @@
 import os
 import shutil
-import copy
 import logging
-import time
 import datetime
 
 from drp_1dpipe.core.config import ConfigJson
+from drp_1dpipe.core.watcher import wait_files
 
 _loglevels = {
     'ERROR': logging.ERROR,
@@ -112,22 +111,17 @@ def normpath(*args):
     return os.path.normpath(os.path.expanduser(os.path.expandvars(os.path.join(*args))))
 
 
-def wait_semaphores(semaphores, timeout=4.354e17, tick=60):
+def wait_semaphores(semaphores, timeout=None, tick=5):
     """Wait all files are created.
 
+    See :obj:`drp_1dpipe.core.watcher.wait_files`.
+
     :param semaphores: List of files to watch for creation.
-    :param timeout: Maximun wait time, in seconds.
+    :param timeout: Maximun wait time, in seconds, by default no limit.
+    :param tick: Maximum interval between two checks, in seconds.
     """
-    start = time.time()
-    # we have to copy the semaphore list as some other thread may use it
-    _semaphores = copy.copy(semaphores)
-    while _semaphores:
-        if time.time() - start > timeout:
-            raise TimeoutError(_semaphores)
-        if os.path.exists(_semaphores[0]):
-            del _semaphores[0]
-            continue
-        time.sleep(tick)
+    wait_files(semaphores, read=lambda path: os.path.exists(path) or None,
+               timeout=timeout, max_tick=tick)
 
 
 def convert_dl_to_ld(args):
@@ -0,0 +1,262 @@
+"""
+Watch files written at the end of batch jobs.
+
+Batch job scripts write the exit code of their task to a `.done` file.
+The watcher wakes up as soon as a file is written to a watched directory,
+through inotify when available, and reads the files named by the events.
+It also lists the watched directories with a backoff from `min_tick` to
+`max_tick` seconds, reading the listed files, as inotify does not see files
+written by other hosts of a network filesystem. The state of the batch job
+can be checked every `state_interval` seconds, so that a job ended without
+writing its files (killed, out of memory, over its walltime) is detected
+without waiting for a timeout. Files are only declared lost `grace`
+seconds after the job end, leaving time for the attribute cache of a
+network filesystem to show them.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+
+# batch jobs are watched by the scheduler
+logger = logging.getLogger("scheduler")
+
+# inotify events of a file written or moved in a directory
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
+# inotify_event header : wd, mask, cookie, len
+_event_header = struct.Struct('iIII')
+
+
+class JobError(RuntimeError):
+    """Batch tasks failed
+
+    Parameters
+    ----------
+    failures : dict
+        Exit code of each failed task by `.done` file, None for a task whose
+        job ended without writing it
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__("{} task(s) failed : {}".format(
+            len(failures), ', '.join('{} ({})'.format(
+                os.path.basename(path),
+                'no exit code' if code is None else 'exit {}'.format(code))
+                for path, code in sorted(failures.items()))))
+
+
+class _Inotify:
+    """Minimal inotify binding, watching file writes in directories"""
+
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories = {}
+        try:
+            for directory in directories:
+                wd = libc.inotify_add_watch(
+                    self.fd, os.fsencode(directory),
+                    _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "inotify_add_watch failed on {}".format(
+                                      directory))
+                self._directories[wd] = directory
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    def wait(self, timeout):
+        """Wait for events at most `timeout` seconds
+
+        Returns
+        -------
+        set
+            Paths of the files written or moved since the former call
+        """
+        paths = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return paths
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                if not data:
+                    break
+                offset = 0
+                while offset < len(data):
+                    wd, _, _, length = _event_header.unpack_from(data, offset)
+                    offset += _event_header.size
+                    name = data[offset:offset + length].rstrip(b'\0')
+                    offset += length
+                    if wd in self._directories and name:
+                        paths.add(os.path.join(self._directories[wd],
+                                               os.fsdecode(name)))
+        except BlockingIOError:
+            pass
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _inotify(directories):
+    """An inotify watcher of `directories`, None if unavailable"""
+    try:
+        return _Inotify(directories)
+    except (OSError, AttributeError) as e:
+        logger.debug("inotify unavailable, polling : {}".format(e))
+        return None
+
+
+def read_exit_code(path):
+    """Exit code saved in a `.done` file
+
+    Returns
+    -------
+    int
+        Last exit code of the file, None if the file is missing or not
+        written yet
+    """
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().split()
+    except FileNotFoundError:
+        return None
+    try:
+        return int(lines[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _listed(pending):
+    """Pending files found by listing their directories"""
+    found = set()
+    for directory in pending:
+        if not pending[directory]:
+            continue
+        try:
+            names = set(os.listdir(directory))
+        except FileNotFoundError:
+            continue
+        found.update(path for path in pending[directory]
+                     if os.path.basename(path) in names)
+    return found
+
+
+def wait_files(paths, read=read_exit_code, timeout=None, min_tick=0.1,
+               max_tick=5., job_alive=None, state_interval=5., grace=60.,
+               on_file=None):
+    """Wait until all files are written
+
+    Parameters
+    ----------
+    paths : list
+        Files to wait for
+    read : callable, optional
+        Function reading a file, returning None while it is not written, by
+        default `read_exit_code`
+    timeout : float, optional
+        Maximum wait time in seconds, by default no limit
+    min_tick, max_tick : float, optional
+        Bounds of the interval between directory listings in seconds, by
+        default 0.1 and 5
+    job_alive : callable, optional
+        Function telling whether the job writing the files is still queued
+        or running. Files still missing `grace` seconds after the job is
+        found ended are given a None value.
+    state_interval : float, optional
+        Interval between job state checks in seconds, by default 5
+    grace : float, optional
+        Time left after the job end for its files to show up in seconds, by
+        default 60, the largest default attribute cache time of NFS
+    on_file : callable, optional
+        Function called with each file and its value as soon as it is read,
+        or given a None value
+
+    Returns
+    -------
+    dict
+        Value read from each file by `read`
+
+    Raises
+    ------
+    TimeoutError
+        If files are still missing after `timeout` seconds
+    """
+    # pending files by absolute directory
+    pending = {}
+    absolute = {}
+    for path in paths:
+        directory, name = os.path.split(os.path.abspath(path))
+        pending.setdefault(directory, set()).add(path)
+        absolute[os.path.join(directory, name)] = path
+    values = {}
+    notifier = _inotify(sorted(pending))
+    start = time.monotonic()
+    last_check = start
+    ended_at = None
+    tick = min_tick
+    next_listing = start
+    candidates = set()
+    try:
+        while any(pending.values()):
+            now = time.monotonic()
+            if now >= next_listing:
+                candidates |= _listed(pending)
+                next_listing = now + tick
+                tick = min(max_tick, 2 * tick)
+            for path in candidates:
+                value = read(path)
+                if value is not None:
+                    values[path] = value
+                    pending[os.path.dirname(os.path.abspath(path))].discard(
+                        path)
+                    if on_file is not None:
+                        on_file(path, value)
+            candidates = set()
+            if not any(pending.values()):
+                break
+            now = time.monotonic()
+            if timeout is not None and now - start > timeout:
+                raise TimeoutError(sorted(p for ps in pending.values()
+                                          for p in ps))
+            if job_alive is not None and now - last_check >= state_interval:
+                last_check = now
+                if job_alive():
+                    ended_at = None
+                elif ended_at is None:
+                    ended_at = now
+                elif now - ended_at >= grace:
+                    # still missing after the grace period, files are lost
+                    for path in sorted(p for ps in pending.values()
+                                       for p in ps):
+                        values[path] = None
+                        if on_file is not None:
+                            on_file(path, None)
+                    break
+            wait = max(0., next_listing - time.monotonic())
+            if job_alive is not None:
+                wait = min(wait, max(0., last_check + state_interval -
+                                     time.monotonic()))
+            if notifier is not None:
+                candidates = {absolute[p] for p in notifier.wait(wait)
+                              if p in absolute and absolute[p] in
+                              pending[os.path.dirname(p)]}
+            else:
+                time.sleep(wait)
+    finally:
+        if notifier is not None:
+            notifier.close()
+    return values
@@ -0,0 +1,237 @@
+"""
+Indexed catalog of the products of a run.
+
+The catalog is an SQLite database with one row per product, giving its
+decoded identifiers (catId, tract, patch, objId, nVisit, pfsVisitHash), its
+location (a file, or a byte range of a container) and its row in the run
+redshift summary. Identifiers are indexed, so that an object is found in
+logarithmic time without listing the data directory nor parsing file names.
+"""
+
+import os
+import sqlite3
+
+from astropy.io import fits
+
+from drp_1dpipe.io.container import read_product
+
+_identity = ('catId', 'tract', 'patch', 'objId', 'nVisit', 'pfsVisitHash')
+
+catalog_columns = (('catId', 'INTEGER'), ('tract', 'INTEGER'),
+                   ('patch', 'TEXT'), ('objId', 'INTEGER'),
+                   ('nVisit', 'INTEGER'), ('pfsVisitHash', 'INTEGER'),
+                   ('filename', 'TEXT'), ('path', 'TEXT'),
+                   ('container', 'TEXT'), ('hdu', 'INTEGER'),
+                   ('nhdu', 'INTEGER'), ('offset', 'INTEGER'),
+                   ('size', 'INTEGER'), ('summary_row', 'INTEGER'))
+
+_indexes = (('products_objId', ('objId', 'catId')),
+            ('products_tract', ('tract', 'patch')),
+            ('products_filename', ('filename',)))
+
+
+def parse_product_name(name):
+    """Decode the identifiers of a pfsObject or pfsZcandidates file name
+
+    Parameters
+    ----------
+    name : str
+        File name, formatted as
+        <head>-%03d-%05d-%s-%016x-%03d-0x%016x.fits
+
+    Returns
+    -------
+    tuple
+        catId, tract, patch, objId, nVisit, pfsVisitHash
+
+    Raises
+    ------
+    ValueError
+        If the name does not follow the format
+    """
+    basename = os.path.splitext(os.path.basename(name))[0]
+    head, catId, tract, patch, objId, nvisit, pfsVisitHash = basename.split('-')
+    return (int(catId), int(tract), patch, int(objId, 16), int(nvisit),
+            int(pfsVisitHash, 16))
+
+
+def _summary_rows(spectra):
+    """Row of each object identity in a summary spectrum column"""
+    rows = {}
+    for row, spectrum in enumerate(spectra):
+        try:
+            rows[parse_product_name(spectrum)] = row
+        except ValueError:
+            continue
+    return rows
+
+
+def build_catalog(path, output_dir, locations=(), entries=(), spectra=()):
+    """Build the product catalog of a run
+
+    The catalog is written to a temporary file and renamed, so that readers
+    never see a partial catalog.
+
+    Parameters
+    ----------
+    path : str
+        Catalog file
+    output_dir : str
+        Run output directory, product locations are saved relative to it
+    locations : iterable, optional
+        (name, location) of each product file
+    entries : iterable, optional
+        Container index entries, container paths being relative to the
+        output data directory
+    spectra : iterable, optional
+        Spectrum column of the run redshift summary, in row order
+
+    Returns
+    -------
+    int
+        Number of products in the catalog
+    """
+    rows = _summary_rows(spectra)
+    data_dir = os.path.join(output_dir, 'data')
+    # products share a few directories, made relative once each
+    directories = {}
+
+    def relpath(location):
+        directory, name = os.path.split(location)
+        if directory not in directories:
+            directories[directory] = os.path.relpath(directory, output_dir)
+        return os.path.join(directories[directory], name)
+
+    def records():
+        for name, location in locations:
+            try:
+                identity = parse_product_name(name)
+            except ValueError:
+                continue
+            yield identity + (name, relpath(location), None, None, None, None,
+                              None, rows.get(identity))
+        for entry in entries:
+            identity = tuple(entry[key] for key in _identity)
+            container = os.path.relpath(
+                os.path.join(data_dir, entry['container']), output_dir)
+            yield identity + (entry['filename'], None, container,
+                              entry['hdu'], entry['nhdu'], entry['offset'],
+                              entry['size'], rows.get(identity))
+
+    part = path + '.part'
+    if os.path.exists(part):
+        os.remove(part)
+    db = sqlite3.connect(part)
+    try:
+        db.execute('PRAGMA journal_mode=OFF')
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('CREATE TABLE products ({})'.format(
+            ', '.join('"{}" {}'.format(*c) for c in catalog_columns)))
+        db.executemany('INSERT INTO products VALUES ({})'.format(
+            ', '.join('?' * len(catalog_columns))), records())
+        # indexes are built once all rows are inserted
+        for name, columns in _indexes:
+            db.execute('CREATE INDEX {} ON products ({})'.format(
+                name, ', '.join(columns)))
+        count = db.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+        db.commit()
+    finally:
+        db.close()
+    os.replace(part, path)
+    return count
+
+
+class ProductCatalog:
+    """Read-only access to a product catalog
+
+    Parameters
+    ----------
+    path : str
+        Catalog file
+    output_dir : str, optional
+        Run output directory, by default the catalog directory
+    """
+
+    def __init__(self, path, output_dir=None):
+        if not os.path.exists(path):
+            raise FileNotFoundError("Product catalog not found : {}".format(path))
+        self.path = path
+        self.output_dir = output_dir or os.path.dirname(os.path.abspath(path))
+        self._db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True,
+                                   check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def find(self, **identity):
+        """Find products by identifiers
+
+        Parameters
+        ----------
+        identity
+            Values of any of catId, tract, patch, objId, nVisit and
+            pfsVisitHash
+
+        Returns
+        -------
+        list
+            Catalog records, as dict
+
+        Raises
+        ------
+        ValueError
+            If an unknown identifier is given
+        """
+        unknown = set(identity) - set(_identity)
+        if unknown:
+            raise ValueError("Unknown identifiers : {}".format(
+                ', '.join(sorted(unknown))))
+        query = 'SELECT * FROM products'
+        if identity:
+            query += ' WHERE ' + ' AND '.join('"{}" = ?'.format(key)
+                                              for key in identity)
+        return [dict(row) for row in
+                self._db.execute(query, tuple(identity.values()))]
+
+    def get(self, objId, catId=None):
+        """Product record of an object, None if not found
+
+        Raises
+        ------
+        LookupError
+            If several products match
+        """
+        if catId is None:
+            records = self.find(objId=objId)
+        else:
+            records = self.find(objId=objId, catId=catId)
+        if len(records) > 1:
+            raise LookupError("{} products for objId {}".format(len(records),
+                                                                objId))
+        return records[0] if records else None
+
+    def open(self, record):
+        """Open the product of a catalog record
+
+        Returns
+        -------
+        :obj:`astropy.io.fits.HDUList`
+            The product
+        """
+        if record['path'] is not None:
+            return fits.open(os.path.join(self.output_dir, record['path']))
+        entry = dict(record)
+        entry['container'] = os.path.basename(record['container'])
+        return read_product(os.path.join(self.output_dir,
+                                         os.path.dirname(record['container'])),
+                            entry)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,331 @@
+"""
+Bunch-level product containers.
+
+A container is a multi-extension FITS file holding the products of many
+objects. Each product is stored as a `PRODUCT` image HDU, without data,
+carrying the product primary header, followed by the product table HDUs.
+An index (one JSON line per product, appended as products are written)
+gives for each object the product file name, the first HDU number, the
+number of HDUs and the byte range of the product in the container.
+"""
+
+import io
+import os
+import glob
+import json
+import zlib
+import shutil
+
+import numpy as np
+from astropy.io import fits
+
+_index_suffix = '.index.jsonl'
+
+# size of an empty primary HDU, that starts a serialized HDU list
+_primary_size = 2880
+
+index_columns = (('filename', 'S128'), ('catId', 'i4'), ('tract', 'i4'),
+                 ('patch', 'S16'), ('objId', 'i8'), ('nVisit', 'i4'),
+                 ('pfsVisitHash', 'i8'), ('container', 'S128'), ('hdu', 'i4'),
+                 ('nhdu', 'i4'), ('offset', 'i8'), ('size', 'i8'),
+                 ('checksum', 'S8'))
+
+
+def container_path(output_dir, name=None):
+    """Path of a product container in a bunch output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch output directory
+    name : str, optional
+        Container name suffix, used by workers of a bunch
+
+    Returns
+    -------
+    str
+        Container file path
+    """
+    if name:
+        return os.path.join(output_dir, 'products-{}.fits'.format(name))
+    return os.path.join(output_dir, 'products.fits')
+
+
+def index_path(path):
+    """Path of the index of a container"""
+    return os.path.splitext(path)[0] + _index_suffix
+
+
+def _read_index(path):
+    """Read index entries, ignoring a truncated last line"""
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r') as f:
+        for l in f:
+            try:
+                entries.append(json.loads(l))
+            except ValueError:
+                continue
+    return entries
+
+
+class ProductContainer:
+    """A multi-extension FITS file holding the products of a bunch
+
+    Products are appended one after the other. When an existing container is
+    reopened, bytes written after the last indexed product and a partial
+    index line, as left by a killed job, are discarded.
+    """
+
+    def __init__(self, path):
+        """Constructor
+
+        Parameters
+        ----------
+        path : str
+            Container file path
+        """
+        self.path = path
+        self.index_path = index_path(path)
+        self.entries = _read_index(self.index_path)
+        if self.entries:
+            last = self.entries[-1]
+            end = last['offset'] + last['size']
+            self.next_hdu = last['hdu'] + last['nhdu']
+        else:
+            primary = io.BytesIO()
+            fits.PrimaryHDU().writeto(primary)
+            with open(path, 'wb') as f:
+                f.write(primary.getvalue())
+            end = len(primary.getvalue())
+            self.next_hdu = 1
+        self._file = open(path, 'r+b')
+        self._file.truncate(end)
+        self._file.seek(end)
+        # rewrite the index, dropping a partially written last line
+        self._index = open(self.index_path, 'w')
+        for entry in self.entries:
+            self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+
+    def add(self, filename, hdul, identity):
+        """Append a product
+
+        Parameters
+        ----------
+        filename : str
+            Product file name
+        hdul : list
+            Product HDUs, starting with its primary HDU
+        identity : dict
+            Object identity (catId, tract, patch, objId, nVisit, pfsVisitHash)
+
+        Returns
+        -------
+        dict
+            Index entry of the product
+        """
+        product = fits.ImageHDU(header=hdul[0].header, name='PRODUCT')
+        buffer = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), product] + list(hdul[1:])).writeto(buffer)
+        data = buffer.getvalue()[_primary_size:]
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        entry = dict(identity)
+        entry.update(filename=filename,
+                     container=os.path.basename(self.path),
+                     hdu=self.next_hdu,
+                     nhdu=len(hdul),
+                     offset=offset,
+                     size=len(data),
+                     checksum='{:08x}'.format(zlib.crc32(data) & 0xffffffff))
+        self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        # the product is journaled once added: it must be on disk by then
+        os.fsync(self._index.fileno())
+        self.next_hdu += len(hdul)
+        self.entries.append(entry)
+        return entry
+
+    def verify(self, filename, checksum):
+        """Whether a product is indexed and its data intact on disk
+
+        Parameters
+        ----------
+        filename : str
+            Product file name
+        checksum : str
+            Expected checksum of the product data
+        """
+        for entry in reversed(self.entries):
+            if entry['filename'] == filename:
+                break
+        else:
+            return False
+        if entry['checksum'] != checksum:
+            return False
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['size'])
+        return len(data) == entry['size'] and \
+            '{:08x}'.format(zlib.crc32(data) & 0xffffffff) == checksum
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+
+def load_indexes(output_dir):
+    """Load the indexes of all containers of a directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory holding containers and their indexes
+
+    Returns
+    -------
+    list
+        Index entries. Only the last entry of a product written again by a
+        continued processing is kept.
+    """
+    entries = {}
+    pattern = os.path.join(output_dir, 'products*' + _index_suffix)
+    for path in sorted(glob.glob(pattern)):
+        for entry in _read_index(path):
+            entries[entry['filename']] = entry
+    return list(entries.values())
+
+
+def remove_containers(output_dir):
+    """Remove all containers and indexes of a bunch output directory"""
+    for path in glob.glob(os.path.join(output_dir, 'products*.fits')):
+        os.remove(path)
+    for path in glob.glob(os.path.join(output_dir, 'products*' + _index_suffix)):
+        os.remove(path)
+
+
+def write_index(entries, path):
+    """Save index entries as a FITS binary table
+
+    Parameters
+    ----------
+    entries : list
+        Index entries
+    path : str
+        Output FITS file
+    """
+    table = np.zeros(len(entries), dtype=list(index_columns))
+    for name, dtype in index_columns:
+        table[name] = [entry[name] for entry in entries]
+    fits.BinTableHDU(name='INDEX', data=table).writeto(path, overwrite=True)
+
+
+def read_index(path):
+    """Read index entries saved by `write_index`"""
+    with fits.open(path) as hdul:
+        table = hdul['INDEX'].data
+        names = table.columns.names
+        columns = [table[name].tolist() for name in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def move_containers(bunch, data_dir, relocate=None):
+    """Move the containers of a bunch to `data_dir`
+
+    Containers are renamed after their bunch, one move per container.
+
+    Parameters
+    ----------
+    bunch : str
+        Bunch output directory
+    data_dir : str
+        Destination directory
+    relocate : callable, optional
+        Function relocating a container given its path and destination
+        name, and returning its new location, by default a move to
+        `data_dir`
+
+    Returns
+    -------
+    list
+        Index entries of the moved containers, with container paths
+        relative to `data_dir`
+    """
+    if relocate is None:
+        def relocate(source, name):
+            return shutil.move(source, os.path.join(data_dir, name))
+    bunch_name = os.path.basename(os.path.normpath(bunch))
+    moved = {}
+    entries = load_indexes(bunch)
+    for entry in entries:
+        container = entry['container']
+        if container not in moved:
+            location = relocate(os.path.join(bunch, container),
+                                '{}-{}'.format(bunch_name, container))
+            moved[container] = os.path.relpath(location, data_dir)
+            if os.path.abspath(location) != os.path.abspath(
+                    os.path.join(bunch, container)):
+                os.remove(index_path(os.path.join(bunch, container)))
+        entry['container'] = moved[container]
+    return entries
+
+
+def read_product(container_dir, entry):
+    """Read a product from its container
+
+    Parameters
+    ----------
+    container_dir : str
+        Directory of the container
+    entry : dict
+        Index entry of the product
+
+    Returns
+    -------
+    :obj:`astropy.io.fits.HDUList`
+        The product, as it would be written to its own file
+    """
+    with open(os.path.join(container_dir, entry['container']), 'rb') as f:
+        f.seek(entry['offset'])
+        data = f.read(entry['size'])
+    hdul = fits.HDUList.fromstring(data)
+    header = hdul[0].header.copy(strip=True)
+    for key in ('EXTNAME', 'EXTVER'):
+        header.remove(key, ignore_missing=True)
+    return fits.HDUList([fits.PrimaryHDU(header=header)] + hdul[1:])
+
+
+def export_products(container_dir, entries, output_dir, objIds=None):
+    """Write products stored in containers to their own files
+
+    Parameters
+    ----------
+    container_dir : str
+        Directory of the containers
+    entries : list
+        Index entries, from `read_index` or `load_indexes`
+    output_dir : str
+        Output directory
+    objIds : iterable, optional
+        Objects to export, by default all of them
+
+    Returns
+    -------
+    list
+        Names of the written files
+    """
+    if objIds is not None:
+        objIds = set(objIds)
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for entry in entries:
+        if objIds is not None and entry['objId'] not in objIds:
+            continue
+        read_product(container_dir, entry).writeto(
+            os.path.join(output_dir, entry['filename']), overwrite=True)
+        written.append(entry['filename'])
+    return written
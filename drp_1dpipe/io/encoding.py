@@ -0,0 +1,277 @@
+"""
+Compact encoding of pfsZcandidates products.
+
+In the full encoding, a product stores its model fluxes and zPDF as float64
+and repeats its wavelength and redshift grids. In the compact encoding:
+
+* MODELFLUX is stored as float32
+* MODELWL has no rows, its `GRIDHASH` keyword references the wavelength
+  grid
+* ZPDF holds a float32 PDF column, truncated to the redshift range where
+  the posterior is above `threshold` times its peak. Its `ZGRID` keyword
+  references the redshift grid and `ZOFFSET` gives the grid index of its
+  first row
+
+Grids are saved once per run in a grid directory, as `<kind>-<hash>.npy`
+files named after the SHA-1 of their values. The accuracy loss against the
+full encoding is saved in header keywords: `FLUXERR` (ZCANDIDATES) is the
+largest relative error of model fluxes, `ZPDFERR` (ZPDF) the largest error
+of the stored log posterior and `ZPDFLOSS` (ZPDF) the fraction of
+probability left out by the truncation. :obj:`expand_product` rebuilds a
+product in the full encoding.
+"""
+
+import os
+import glob
+import shutil
+import threading
+import hashlib
+
+import numpy as np
+from astropy.io import fits
+
+product_encodings = ('full', 'compact')
+
+
+def grid_hash(grid):
+    """Hash of the values of a grid, 16 hexadecimal digits"""
+    return hashlib.sha1(np.ascontiguousarray(grid).tobytes()).hexdigest()[:16]
+
+
+def grid_path(grid_dir, kind, hash_):
+    """Path of a grid file"""
+    return os.path.join(grid_dir, '{}-{}.npy'.format(kind, hash_))
+
+
+def save_grid(grid_dir, kind, grid):
+    """Save a grid once, returning its hash
+
+    Parameters
+    ----------
+    grid_dir : str
+        Grid directory
+    kind : str
+        Grid kind, 'wavelength' or 'redshift'
+    grid : :obj:`numpy.ndarray`
+        Grid values
+
+    Returns
+    -------
+    str
+        Grid hash
+    """
+    hash_ = grid_hash(grid)
+    path = grid_path(grid_dir, kind, hash_)
+    if not os.path.exists(path):
+        os.makedirs(grid_dir, exist_ok=True)
+        # workers of a bunch may save the same grid at once
+        part = '{}.{}.part'.format(path, os.getpid())
+        with open(part, 'wb') as f:
+            np.save(f, grid)
+        os.replace(part, path)
+    return hash_
+
+
+def load_grid(grid_dir, kind, hash_):
+    """Load a grid saved by `save_grid`"""
+    path = grid_path(grid_dir, kind, hash_)
+    if not os.path.exists(path):
+        raise FileNotFoundError("Grid not found : {}".format(path))
+    return np.load(path)
+
+
+def merge_grids(source_dir, grid_dir):
+    """Copy the grids of `source_dir` missing from `grid_dir`
+
+    Returns
+    -------
+    int
+        Number of copied grids
+    """
+    copied = 0
+    for path in glob.glob(os.path.join(source_dir, '*.npy')):
+        destination = os.path.join(grid_dir, os.path.basename(path))
+        if os.path.exists(destination):
+            continue
+        os.makedirs(grid_dir, exist_ok=True)
+        # bunches may be merged by several threads at once
+        part = '{}.{}.{}.part'.format(destination, os.getpid(),
+                                      threading.get_ident())
+        shutil.copy2(path, part)
+        os.replace(part, destination)
+        copied += 1
+    return copied
+
+
+def _interval_mass(redshift, logpdf):
+    """Probability mass of each grid interval, up to a constant factor"""
+    pdf = np.exp(logpdf - np.nanmax(logpdf))
+    return 0.5 * (pdf[1:] + pdf[:-1]) * np.diff(redshift)
+
+
+def truncate_zpdf(redshift, logpdf, threshold):
+    """Range of a zPDF above `threshold` times its peak
+
+    Parameters
+    ----------
+    redshift : :obj:`numpy.ndarray`
+        Redshift grid
+    logpdf : :obj:`numpy.ndarray`
+        Log posterior
+    threshold : float
+        Relative probability threshold
+
+    Returns
+    -------
+    int, int, float
+        First and last (excluded) grid indexes of the kept range, and
+        fraction of probability mass outside of it
+    """
+    logpdf = np.asarray(logpdf, dtype=np.float64)
+    if len(logpdf) < 2:
+        return 0, len(logpdf), 0.
+    if not np.isfinite(logpdf).any():
+        # no peak (all NaN or -inf) : keep the full grid
+        return 0, len(logpdf), 0.
+    kept = np.flatnonzero(logpdf >= np.nanmax(logpdf) + np.log(threshold))
+    if len(kept) == 0:
+        return 0, len(logpdf), 0.
+    start, stop = int(kept[0]), int(kept[-1]) + 1
+    mass = _interval_mass(redshift, logpdf)
+    total = np.nansum(mass)
+    inside = np.nansum(mass[start:max(start, stop - 1)])
+    loss = float(1. - inside / total) if total > 0 else 0.
+    return start, stop, max(loss, 0.)
+
+
+class CompactEncoding:
+    """Compact encoding of the products of a bunch
+
+    Parameters
+    ----------
+    grid_dir : str
+        Directory where grids are saved
+    threshold : float, optional
+        Relative probability threshold of zPDF truncation, by default 1e-8
+
+    Attributes
+    ----------
+    stats : dict
+        Largest accuracy losses of the encoded products
+    """
+
+    def __init__(self, grid_dir, threshold=1e-8):
+        self.grid_dir = grid_dir
+        self.threshold = float(threshold)
+        self.count = 0
+        self.stats = {'FLUXERR': 0., 'ZPDFERR': 0., 'ZPDFLOSS': 0.}
+        # hash of grids already saved, by grid identity
+        self._saved = {}
+
+    def _save(self, kind, grid):
+        grid = np.ascontiguousarray(grid)
+        key = (kind, grid.dtype.str, grid.shape, grid.tobytes())
+        if key not in self._saved:
+            self._saved[key] = save_grid(self.grid_dir, kind, grid)
+        return self._saved[key]
+
+    def _update(self, key, value):
+        self.stats[key] = max(self.stats[key], value)
+        return value
+
+    def model_flux(self, model_flux):
+        """float32 model fluxes and their largest relative error"""
+        compact = model_flux.astype(np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error = np.abs(compact - model_flux) / np.abs(model_flux)
+        error = error[np.isfinite(error)]
+        return compact, self._update('FLUXERR',
+                                     float(error.max()) if error.size else 0.)
+
+    def modelwl_hdu(self, lambda_ranges):
+        """Empty MODELWL HDU referencing the wavelength grid"""
+        hdu = fits.BinTableHDU(name='MODELWL',
+                               data=np.zeros(0, dtype=[('WAVELENGTH', 'f4')]))
+        hdu.header['GRIDHASH'] = (
+            self._save('wavelength', np.asarray(lambda_ranges,
+                                                dtype=np.float32)),
+            'Hash of the wavelength grid')
+        return hdu
+
+    def zpdf_hdu(self, zpdf):
+        """Truncated float32 ZPDF HDU referencing the redshift grid"""
+        redshift = np.ascontiguousarray(zpdf[:, 0], dtype=np.float64)
+        logpdf = zpdf[:, 1]
+        start, stop, loss = truncate_zpdf(redshift, logpdf, self.threshold)
+        pdf = logpdf[start:stop].astype(np.float32)
+        error = np.abs(pdf - logpdf[start:stop])
+        hdu = fits.BinTableHDU(name='ZPDF',
+                               data=np.array(pdf, dtype=[('PDF', 'f4')]))
+        hdu.header['ZGRID'] = (self._save('redshift', redshift),
+                               'Hash of the redshift grid')
+        hdu.header['ZOFFSET'] = (start, 'Grid index of the first row')
+        hdu.header['ZPDFERR'] = (
+            self._update('ZPDFERR', float(error.max()) if error.size else 0.),
+            'Largest error of the log posterior')
+        hdu.header['ZPDFLOSS'] = (self._update('ZPDFLOSS', loss),
+                                  'Probability mass left out')
+        self.count += 1
+        return hdu
+
+    def report(self):
+        """Accuracy loss of the encoded products"""
+        return ("Compact encoding of {} products : largest model flux "
+                "relative error {:.3g}, largest log posterior error {:.3g}, "
+                "largest truncated probability {:.3g}".format(
+                    self.count, self.stats['FLUXERR'], self.stats['ZPDFERR'],
+                    self.stats['ZPDFLOSS']))
+
+
+def expand_product(hdul, grid_dir):
+    """Rebuild a compact product in the full encoding
+
+    Redshifts left out of a truncated zPDF get a log posterior of -inf.
+    Products in the full encoding are returned unchanged.
+
+    Parameters
+    ----------
+    hdul : :obj:`astropy.io.fits.HDUList`
+        Product
+    grid_dir : str
+        Directory of the grids of the run
+
+    Returns
+    -------
+    :obj:`astropy.io.fits.HDUList`
+        Product in the full encoding
+    """
+    if 'ZPDF' not in hdul or 'ZGRID' not in hdul['ZPDF'].header:
+        return hdul
+    hdus = [fits.PrimaryHDU(header=hdul[0].header)]
+    for hdu in hdul[1:]:
+        if hdu.name == 'ZCANDIDATES':
+            data = hdu.data
+            dtype = [(name, 'f8', data.dtype[name].shape)
+                     if name == 'MODELFLUX' else (name, data.dtype[name])
+                     for name in data.dtype.names]
+            table = np.zeros(len(data), dtype=dtype)
+            for name in data.dtype.names:
+                table[name] = data[name]
+            hdus.append(fits.BinTableHDU(name='ZCANDIDATES', data=table))
+        elif hdu.name == 'MODELWL':
+            grid = load_grid(grid_dir, 'wavelength', hdu.header['GRIDHASH'])
+            hdus.append(fits.BinTableHDU(
+                name='MODELWL', data=np.array(grid, dtype=[('WAVELENGTH',
+                                                            'f4')])))
+        elif hdu.name == 'ZPDF':
+            redshift = load_grid(grid_dir, 'redshift', hdu.header['ZGRID'])
+            table = np.zeros(len(redshift), dtype=[('REDSHIFT', 'f8'),
+                                                   ('PDF', 'f8')])
+            table['REDSHIFT'] = redshift
+            table['PDF'] = -np.inf
+            start = hdu.header['ZOFFSET']
+            table['PDF'][start:start + len(hdu.data)] = hdu.data['PDF']
+            hdus.append(fits.BinTableHDU(name='ZPDF', data=table))
+        else:
+            hdus.append(hdu)
+    return fits.HDUList(hdus)
@@ -1,4 +1,5 @@
 import os.path
+from astropy.io import fits
 from pfs.datamodel.drp import PfsObject
 from pylibamazed.redshift import (CSpectrumSpectralAxis,
                                   CSpectrumFluxAxis_withError,
@@ -6,6 +7,80 @@ from pylibamazed.redshift import (CSpectrumSpectralAxis,
 import numpy as np
 
 
+def read_spectrum_arrays(path):
+    """Read the arrays of a pfsObject FITS file used by the pipeline
+
+    The file is memory-mapped and only the WAVELENGTH, FLUX and MASK HDUs and
+    the first row of the COVAR HDU (the variance) are read. Other HDUs are
+    never loaded.
+
+    :param path: FITS file name
+    :return: wavelength, flux, mask and variance arrays. Wavelength and mask
+        are loaded in memory, flux and variance may be memory-mapped.
+    :raises KeyError: if one of the HDUs is missing
+    """
+    with fits.open(path, memmap=True) as fd:
+        wavelength = np.array(fd['WAVELENGTH'].data)
+        mask = np.array(fd['MASK'].data)
+        flux = fd['FLUX'].data
+        variance = fd['COVAR'].data[0]
+    return wavelength, flux, mask, variance
+
+
+def _masked_float32(valid, count, source, ufunc=None, scale=None):
+    """Gather `source[valid]` into a new contiguous float32 array
+
+    When given, `ufunc` is applied (with `scale` as second operand) during the
+    conversion to float32.
+    """
+    out = np.empty(count, dtype=np.float32)
+    if ufunc is None:
+        np.copyto(out, source[valid], casting='same_kind')
+    elif scale is None:
+        ufunc(source[valid], out=out, casting='same_kind')
+    else:
+        ufunc(source[valid], scale, out=out, casting='same_kind')
+    return out
+
+
+class SpectrumHandle:
+    """A pfsObject FITS file read once.
+
+    The handle exposes the CSpectrum given to amazed as well as the raw
+    wavelength grid and mask used to build the products, so that the
+    redshift pass, the line measurement pass and the product writer share
+    a single read of the file.
+
+    :param path: FITS file name
+    :param build_spectrum: whether to build the CSpectrum, defaults to True
+    """
+
+    def __init__(self, path, build_spectrum=True):
+        self.path = path
+        self.name = os.path.basename(path)
+        try:
+            wavelength, flux, mask, variance = read_spectrum_arrays(path)
+        except KeyError:
+            # not the expected HDU layout, let the datamodel read it
+            obj = PfsObject.readFits(path)
+            wavelength, flux, mask, variance = (obj.wavelength, obj.flux,
+                                                obj.mask, obj.covar[0])
+        self.wavelength = wavelength
+        self.mask = mask
+        self.spectrum = None
+        if not build_spectrum:
+            return
+        valid = (mask == 0)
+        count = int(np.count_nonzero(valid))
+        spectralaxis = CSpectrumSpectralAxis(
+            _masked_float32(valid, count, wavelength, np.multiply, 10.0))
+        signal = CSpectrumFluxAxis_withError(
+            _masked_float32(valid, count, flux),
+            _masked_float32(valid, count, variance, np.sqrt))
+        self.spectrum = CSpectrum(spectralaxis, signal)
+        self.spectrum.SetName(self.name)
+
+
 def read_spectrum(path):
     """
     Read a pfsObject FITS file and build a CSpectrum out of it
@@ -13,15 +88,4 @@ def read_spectrum(path):
     :param path: FITS file name
     :rtype: CSpectrum
     """
-
-    obj = PfsObject.readFits(path)
-    mask = obj.mask
-    valid = np.where(mask == 0, True, False)
-    wavelength = np.array(np.extract(valid, obj.wavelength), dtype=np.float32)
-    flux = np.array(np.extract(valid, obj.flux), dtype=np.float32)
-    error = np.array(np.extract(valid, np.sqrt(obj.covar[0][0:])), dtype=np.float32)
-    spectralaxis = CSpectrumSpectralAxis(wavelength * 10.0)
-    signal = CSpectrumFluxAxis_withError(flux, error)
-    spectrum = CSpectrum(spectralaxis, signal)
-    spectrum.SetName(os.path.basename(path))
-    return spectrum
+    return SpectrumHandle(path).spectrum
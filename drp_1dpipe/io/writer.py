@@ -1,117 +1,205 @@
 from astropy.io import fits
 import os.path
+import logging
 import numpy as np
 
+# products are written by process_spectra
+logger = logging.getLogger("process_spectra")
+
+def candidates_filename(catId, tract, patch, objId, nVisit, pfsVisitHash):
+    """Name of the pfsZcandidates file of an object."""
+    return "pfsZcandidates-%03d-%05d-%s-%016x-%03d-0x%016x.fits" % (
+        catId, tract, patch, objId, nVisit % 1000, pfsVisitHash)
+
+
+_header_template = fits.Header([
+    fits.Card('tract', 0, 'Area of the sky'),
+    fits.Card('patch', '', 'Region within tract'),
+    fits.Card('catId', 0, 'Source of the objId'),
+    fits.Card('objId', 0, 'Unique ID for object'),
+    fits.Card('nvisit', 0, 'Number of visit'),
+    fits.Card('vHash', 0, '63-bit SHA-1 list of visits')])
+
+_zcandidates_dtype = [('Z', 'f8'), ('Z_ERR', 'f8'),
+                      ('ZRANK', 'i4'),
+                      ('RELIABILITY', 'f8'),
+                      ('CLASS', 'S15'),
+                      ('SUBCLASS', 'S15')]
+
+_zlines_dtype = np.dtype([('LINENAME', 'S15'),
+                          ('LINEWAVE', 'f8'),
+                          ('LINEZ', 'f8'),
+                          ('LINEZ_ERR', 'f8'),
+                          ('LINESIGMA', 'f8'),
+                          ('LINESIGMA_ERR', 'f8'),
+                          ('LINEVEL', 'f8'),
+                          ('LINEVEL_ERR', 'f8'),
+                          ('LINEFLUX', 'f8'),
+                          ('LINEFLUX_ERR', 'f8'),
+                          ('LINEEW', 'f8'),
+                          ('LINEEW_ERR', 'f8'),
+                          ('LINECONTLEVEL', 'f8'),
+                          ('LINECONTLEVEL_ERR', 'f8')])
+
+# ZLINES columns filled from line measurement fields, others are NaN
+_zlines_columns = {'LINENAME': 'name',
+                   'LINEWAVE': 'lambda_obs',  # TODO: or lambda_rest_beforeOffset ?
+                   'LINESIGMA': 'sigma',
+                   'LINEVEL': 'velocity',
+                   'LINEFLUX': 'flux',
+                   'LINEFLUX_ERR': 'flux_err'}
+
+
+def _column(items, field):
+    """Values of the `field` attribute of each item
+
+    Record arrays give the column itself, other sequences a list.
+    """
+    if isinstance(items, np.ndarray):
+        return items[field]
+    return [getattr(item, field) for item in items]
+
+
+def _zcandidates_table(npix, count, flux_dtype='f8'):
+    """An empty ZCANDIDATES table, with MODELFLUX if npix is not None"""
+    dtype = list(_zcandidates_dtype)
+    if npix is not None:
+        dtype.append(('MODELFLUX', flux_dtype, (npix,)))
+    return np.ndarray((count,), dtype=dtype)
+
+
+def _model_flux(lambda_ranges, mask, models, count):
+    """Models of all candidates on the full wavelength grid
+
+    Masked pixels are set to NaN. All models are scattered at once.
+    """
+    model_flux = np.full((count, len(lambda_ranges)), np.nan)
+    if count:
+        model_flux[:, np.asarray(mask) == 0] = np.asarray(models)[:count]
+    return model_flux
+
+
+def _zlines_table(linemeas):
+    """ZLINES table of line measurements"""
+    zlines = np.ndarray((len(linemeas),), dtype=_zlines_dtype)
+    for name in _zlines_dtype.names:
+        if name in _zlines_columns:
+            zlines[name] = _column(linemeas, _zlines_columns[name])
+        else:
+            zlines[name] = np.nan  # TODO: what is that ?
+    return zlines
+
+
 def write_candidates(output_dir,
                      catId, tract, patch, objId, nVisit, pfsVisitHash,
-                     lambda_ranges, mask, candidates, models, zpdf, linemeas, object_class):
-    """Create a pfsZcandidates FITS file from an amazed output directory."""
+                     lambda_ranges, mask, candidates, models, zpdf, linemeas, object_class,
+                     container=None, encoding=None):
+    """Create a pfsZcandidates FITS file from an amazed output directory.
 
-    path = "pfsZcandidates-%03d-%05d-%s-%016x-%03d-0x%016x.fits" % (
-        catId, tract, patch, objId, nVisit % 1000, pfsVisitHash)
+    When a :obj:`ProductContainer` is given, the product is appended to it
+    instead of being written to its own file in `output_dir`. When a
+    :obj:`CompactEncoding` is given, the product is written in the compact
+    encoding.
+    """
+
+    path = candidates_filename(catId, tract, patch, objId, nVisit,
+                               pfsVisitHash)
+
+    hdul = candidates_hdus(catId, tract, patch, objId, nVisit, pfsVisitHash,
+                           lambda_ranges, mask, candidates, models, zpdf,
+                           linemeas, object_class, encoding=encoding)
+    if container is not None:
+        logger.info("Saving {} redshifts to {}[{}]".format(
+            len(candidates), container.path, path))
+        container.add(path, hdul, dict(catId=catId, tract=tract, patch=patch,
+                                       objId=objId, nVisit=nVisit,
+                                       pfsVisitHash=pfsVisitHash))
+        return path
+
+    logger.info("Saving {} redshifts to {}".format(
+        len(candidates), os.path.join(output_dir, path)))
+    fits.HDUList(hdul).writeto(os.path.join(output_dir, path),
+                               overwrite=True)
+    
+    return path
 
-    print("Saving {} redshifts to {}".format(len(candidates),
-                                             os.path.join(output_dir, path)))
-    header = [fits.Card('tract', tract, 'Area of the sky'),
-              fits.Card('patch', patch, 'Region within tract'),
-              fits.Card('catId', catId, 'Source of the objId'),
-              fits.Card('objId', objId, 'Unique ID for object'),
-              fits.Card('nvisit', nVisit, 'Number of visit'),
-              fits.Card('vHash', pfsVisitHash, '63-bit SHA-1 list of visits')]
 
-    hdr = fits.Header(header)
+def candidates_hdus(catId, tract, patch, objId, nVisit, pfsVisitHash,
+                    lambda_ranges, mask, candidates, models, zpdf, linemeas,
+                    object_class, encoding=None):
+    """Build the HDUs of a pfsZcandidates product.
+
+    Model fluxes, wavelength grid and zPDF are encoded by `encoding`, a
+    :obj:`CompactEncoding`, if given.
+
+    Returns
+    -------
+    list
+        Primary HDU followed by the table HDUs
+    """
+    hdr = _header_template.copy()
+    hdr['tract'] = tract
+    hdr['patch'] = patch
+    hdr['catId'] = catId
+    hdr['objId'] = objId
+    hdr['nvisit'] = nVisit
+    hdr['vHash'] = pfsVisitHash
     primary = fits.PrimaryHDU(header=hdr)
     hdul = [primary]
 
     if object_class == 'GALAXY':
         npix = len(lambda_ranges)
+        count = len(candidates)
 
         # data['PDU'] = np.array([])
 
         # create ZCANDIDATES HDU
-        zcandidates = np.ndarray((len(candidates),),
-                                    dtype=[('Z', 'f8'), ('Z_ERR', 'f8'),
-                                        ('ZRANK', 'i4'),
-                                        ('RELIABILITY', 'f8'),
-                                        ('CLASS', 'S15'),
-                                        ('SUBCLASS', 'S15'),
-                                        ('MODELFLUX', 'f8', (npix,))])
-        for i, candidate in enumerate(candidates):
-            zcandidates[i]['Z'] = candidate.redshift
-            zcandidates[i]['Z_ERR'] = candidate.deltaz
-            zcandidates[i]['ZRANK'] = candidate.rank
-            zcandidates[i]['RELIABILITY'] = candidate.intgProba
-            zcandidates[i]['CLASS'] = object_class
-            zcandidates[i]['SUBCLASS'] = ''
-            model = np.array(lambda_ranges, dtype=np.float64, copy=True)
-            model.fill(np.nan)
-            np.place(model, mask == 0, models[i])
-            zcandidates[i]['MODELFLUX'] = np.array(model)
-        hdul.append(fits.BinTableHDU(name='ZCANDIDATES', data=zcandidates))
+        zcandidates = _zcandidates_table(
+            npix, count, flux_dtype='f8' if encoding is None else 'f4')
+        zcandidates['Z'] = _column(candidates, 'redshift')
+        zcandidates['Z_ERR'] = _column(candidates, 'deltaz')
+        zcandidates['ZRANK'] = _column(candidates, 'rank')
+        zcandidates['RELIABILITY'] = _column(candidates, 'intgProba')
+        zcandidates['CLASS'] = object_class
+        zcandidates['SUBCLASS'] = ''
+        model_flux = _model_flux(lambda_ranges, mask, models, count)
+        if encoding is None:
+            zcandidates['MODELFLUX'] = model_flux
+            hdul.append(fits.BinTableHDU(name='ZCANDIDATES', data=zcandidates))
 
-        # create LAMBDA_SCALE HDU
-        lambda_scale = np.array(lambda_ranges, dtype=[('WAVELENGTH', 'f4')])
-        hdul.append(fits.BinTableHDU(name='MODELWL', data=lambda_scale))
+            # create LAMBDA_SCALE HDU
+            lambda_scale = np.array(lambda_ranges, dtype=[('WAVELENGTH', 'f4')])
+            hdul.append(fits.BinTableHDU(name='MODELWL', data=lambda_scale))
 
-        # create ZPDF HDU
-        zpdf_hdu = np.ndarray(len(zpdf), buffer=zpdf,
-                            dtype=[('REDSHIFT', 'f8'), ('PDF', 'f8')])
-        hdul.append(fits.BinTableHDU(name='ZPDF', data=zpdf_hdu))
+            # create ZPDF HDU
+            zpdf_hdu = np.ndarray(len(zpdf), buffer=zpdf,
+                                dtype=[('REDSHIFT', 'f8'), ('PDF', 'f8')])
+            hdul.append(fits.BinTableHDU(name='ZPDF', data=zpdf_hdu))
+        else:
+            zcandidates['MODELFLUX'], flux_error = encoding.model_flux(model_flux)
+            zcandidates_hdu = fits.BinTableHDU(name='ZCANDIDATES',
+                                               data=zcandidates)
+            zcandidates_hdu.header['FLUXERR'] = (
+                flux_error, 'Largest relative error of MODELFLUX')
+            hdul.append(zcandidates_hdu)
+            hdul.append(encoding.modelwl_hdu(lambda_ranges))
+            hdul.append(encoding.zpdf_hdu(np.asarray(zpdf)))
 
         # create ZLINES HDU
         if linemeas is not None :
-            zlines = np.ndarray((len(linemeas),),
-                                dtype=[('LINENAME', 'S15'),
-                                        ('LINEWAVE', 'f8'),
-                                        ('LINEZ', 'f8'),
-                                        ('LINEZ_ERR', 'f8'),
-                                        ('LINESIGMA', 'f8'),
-                                        ('LINESIGMA_ERR', 'f8'),
-                                        ('LINEVEL', 'f8'),
-                                        ('LINEVEL_ERR', 'f8'),
-                                        ('LINEFLUX', 'f8'),
-                                        ('LINEFLUX_ERR', 'f8'),
-                                        ('LINEEW', 'f8'),
-                                        ('LINEEW_ERR', 'f8'),
-                                        ('LINECONTLEVEL', 'f8'),
-                                        ('LINECONTLEVEL_ERR', 'f8')])
-            for i, lm in enumerate(linemeas):
-                zlines[i]['LINENAME'] = lm.name
-                zlines[i]['LINEWAVE'] = lm.lambda_obs  # TODO: or lambda_rest_beforeOffset ?
-                zlines[i]['LINEZ'] = np.nan  # TODO: what is that ?
-                zlines[i]['LINEZ_ERR'] = np.nan  # TODO: what is that ?
-                zlines[i]['LINESIGMA'] = lm.sigma
-                zlines[i]['LINESIGMA_ERR'] = np.nan  # TODO: what is that ?
-                zlines[i]['LINEVEL'] = lm.velocity
-                zlines[i]['LINEVEL_ERR'] = np.nan  # TODO: what is that
-                zlines[i]['LINEFLUX'] = lm.flux
-                zlines[i]['LINEFLUX_ERR'] = lm.flux_err
-                zlines[i]['LINEEW'] = np.nan  # TODO: what is that
-                zlines[i]['LINEEW_ERR'] = np.nan  # TODO: what is that
-                zlines[i]['LINECONTLEVEL'] = np.nan  # TODO: what is that
-                zlines[i]['LINECONTLEVEL_ERR'] = np.nan  # TODO: what is that
-            hdul.append(fits.BinTableHDU(name='ZLINES', data=zlines))
+            hdul.append(fits.BinTableHDU(name='ZLINES',
+                                         data=_zlines_table(linemeas)))
 
     elif object_class == 'STAR':
 
         # create ZCANDIDATES HDU
-        zcandidates = np.ndarray((len(candidates),),
-                                    dtype=[('Z', 'f8'), ('Z_ERR', 'f8'),
-                                        ('ZRANK', 'i4'),
-                                        ('RELIABILITY', 'f8'),
-                                        ('CLASS', 'S15'),
-                                        ('SUBCLASS', 'S15')])
-        for i, candidate in enumerate(candidates):
-            zcandidates[i]['Z'] = candidate.redshift
-            zcandidates[i]['Z_ERR'] = 0.
-            zcandidates[i]['ZRANK'] = 0
-            zcandidates[i]['RELIABILITY'] = candidate.intgProba
-            zcandidates[i]['CLASS'] = object_class
-            zcandidates[i]['SUBCLASS'] = candidate.template
+        zcandidates = _zcandidates_table(None, len(candidates))
+        zcandidates['Z'] = _column(candidates, 'redshift')
+        zcandidates['Z_ERR'] = 0.
+        zcandidates['ZRANK'] = 0
+        zcandidates['RELIABILITY'] = _column(candidates, 'intgProba')
+        zcandidates['CLASS'] = object_class
+        zcandidates['SUBCLASS'] = _column(candidates, 'template')
         hdul.append(fits.BinTableHDU(name='ZCANDIDATES', data=zcandidates))
 
-
-    fits.HDUList(hdul).writeto(os.path.join(output_dir, path),
-                               overwrite=True)
-    
-    return path
+    return hdul
@@ -0,0 +1,231 @@
+"""
+Stacked zPDF cubes.
+
+A cube holds the zPDF of many objects on a shared redshift grid. It is made
+of three files sharing a prefix:
+
+* `<prefix>.f32` : N x Nz float32 array, row-major, without header
+* `<prefix>.index.bin` : N object identities, as `index_dtype` records
+* `<prefix>.grid.npy` : redshift grid, Nz float64
+
+Rows are appended one object at a time during processing, and one bunch
+at a time during merge, so that cubes are never held in memory. Cubes are
+read back through memory maps with :obj:`ZpdfCube`. Values are the `PDF`
+column of the products ZPDF HDU.
+"""
+
+import os
+import glob
+import shutil
+import logging
+
+import numpy as np
+
+# cubes are written by process_spectra
+logger = logging.getLogger("process_spectra")
+
+index_dtype = np.dtype([('catId', 'i4'), ('tract', 'i4'), ('patch', 'S16'),
+                        ('objId', 'i8'), ('nVisit', 'i4'),
+                        ('pfsVisitHash', 'i8')])
+
+_data_suffix = '.f32'
+_index_suffix = '.index.bin'
+_grid_suffix = '.grid.npy'
+
+# rows converted at once when merging cubes of different grids
+_merge_rows = 1024
+
+
+def cube_prefix(output_dir, name=None):
+    """Prefix of the zPDF cube of a directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch or run output directory
+    name : str, optional
+        Cube name suffix, used by workers of a bunch
+
+    Returns
+    -------
+    str
+        Cube files prefix
+    """
+    if name:
+        return os.path.join(output_dir, 'zpdf-{}'.format(name))
+    return os.path.join(output_dir, 'zpdf')
+
+
+def list_cubes(output_dir):
+    """Prefixes of the zPDF cubes of a directory, sorted"""
+    return sorted(path[:-len(_grid_suffix)] for path in
+                  glob.glob(os.path.join(output_dir, 'zpdf*' + _grid_suffix)))
+
+
+def remove_cubes(output_dir):
+    """Remove all zPDF cubes of a directory"""
+    for suffix in (_data_suffix, _index_suffix, _grid_suffix):
+        for path in glob.glob(os.path.join(output_dir, 'zpdf*' + suffix)):
+            os.remove(path)
+
+
+class ZpdfCubeWriter:
+    """Append zPDF to a cube
+
+    The redshift grid is set by the first zPDF. zPDF on another grid are
+    interpolated on it. When an existing cube is reopened, rows only
+    partly written by a killed job are discarded.
+
+    Parameters
+    ----------
+    prefix : str
+        Cube files prefix
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.grid = None
+        self.count = 0
+        self._data = None
+        self._index = None
+        self._warned = False
+        if os.path.exists(prefix + _grid_suffix):
+            self._open(np.load(prefix + _grid_suffix))
+
+    def _open(self, grid):
+        """Open cube files for a redshift grid, keeping complete rows"""
+        self.grid = np.asarray(grid, dtype=np.float64)
+        row_size = 4 * len(self.grid)
+        data_path = self.prefix + _data_suffix
+        index_path = self.prefix + _index_suffix
+        if not os.path.exists(self.prefix + _grid_suffix):
+            np.save(self.prefix + _grid_suffix, self.grid)
+        for path in (data_path, index_path):
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+        self.count = min(os.path.getsize(data_path) // row_size,
+                         os.path.getsize(index_path) // index_dtype.itemsize)
+        self._data = open(data_path, 'r+b')
+        self._data.truncate(self.count * row_size)
+        self._data.seek(0, os.SEEK_END)
+        self._index = open(index_path, 'r+b')
+        self._index.truncate(self.count * index_dtype.itemsize)
+        self._index.seek(0, os.SEEK_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _on_grid(self, redshift, pdf):
+        """`pdf` on the cube grid"""
+        if len(redshift) == len(self.grid) and np.array_equal(redshift,
+                                                               self.grid):
+            return pdf
+        if not self._warned:
+            logger.warning("zPDF grid differs from {} grid, zPDF are "
+                           "interpolated".format(self.prefix))
+            self._warned = True
+        return np.interp(self.grid, redshift, pdf)
+
+    def add(self, identity, redshift, pdf):
+        """Append the zPDF of an object
+
+        Parameters
+        ----------
+        identity : tuple
+            catId, tract, patch, objId, nVisit, pfsVisitHash
+        redshift : :obj:`numpy.ndarray`
+            Redshift grid of the zPDF
+        pdf : :obj:`numpy.ndarray`
+            zPDF values
+        """
+        if self.grid is None:
+            self._open(redshift)
+        row = np.asarray(self._on_grid(redshift, pdf), dtype=np.float32)
+        self._data.write(row.tobytes())
+        self._index.write(np.array([identity], dtype=index_dtype).tobytes())
+        self.count += 1
+
+    def append_cube(self, prefix):
+        """Append all rows of another cube
+
+        Rows of a cube on the same grid are copied as raw blocks, other ones
+        are interpolated a block of rows at a time.
+
+        Parameters
+        ----------
+        prefix : str
+            Prefix of the cube to append
+        """
+        cube = ZpdfCube(prefix)
+        if self.grid is None:
+            self._open(cube.redshift)
+        if np.array_equal(cube.redshift, self.grid):
+            for suffix, f in ((_data_suffix, self._data),
+                              (_index_suffix, self._index)):
+                with open(prefix + suffix, 'rb') as source:
+                    shutil.copyfileobj(source, f, 1 << 20)
+            # a bunch cube may end with a partial row
+            self._data.truncate((self.count + len(cube)) * 4 * len(self.grid))
+            self._index.truncate((self.count + len(cube))
+                                 * index_dtype.itemsize)
+            self._data.seek(0, os.SEEK_END)
+            self._index.seek(0, os.SEEK_END)
+            self.count += len(cube)
+            return
+        for start in range(0, len(cube), _merge_rows):
+            for identity, pdf in zip(cube.index[start:start + _merge_rows],
+                                     cube.pdf[start:start + _merge_rows]):
+                self.add(identity.tolist(), cube.redshift, pdf)
+
+    def close(self):
+        for f in (self._data, self._index):
+            if f is not None:
+                f.close()
+        self._data = self._index = None
+
+
+class ZpdfCube:
+    """Memory-mapped access to a zPDF cube
+
+    Parameters
+    ----------
+    prefix : str
+        Cube files prefix
+
+    Attributes
+    ----------
+    redshift : :obj:`numpy.ndarray`
+        Redshift grid
+    pdf : :obj:`numpy.memmap`
+        N x Nz zPDF
+    index : :obj:`numpy.memmap`
+        N object identities
+    """
+
+    def __init__(self, prefix):
+        if not os.path.exists(prefix + _grid_suffix):
+            raise FileNotFoundError("zPDF cube not found : {}".format(prefix))
+        self.prefix = prefix
+        self.redshift = np.load(prefix + _grid_suffix)
+        nz = len(self.redshift)
+        count = min(os.path.getsize(prefix + _data_suffix) // (4 * nz),
+                    os.path.getsize(prefix + _index_suffix)
+                    // index_dtype.itemsize)
+        if count:
+            self.pdf = np.memmap(prefix + _data_suffix, dtype=np.float32,
+                                 mode='r', shape=(count, nz))
+            self.index = np.memmap(prefix + _index_suffix, dtype=index_dtype,
+                                   mode='r', shape=(count,))
+        else:
+            self.pdf = np.empty((0, nz), dtype=np.float32)
+            self.index = np.empty((0,), dtype=index_dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    def rows(self, objId):
+        """Rows of the cube holding the zPDF of `objId`"""
+        return np.flatnonzero(self.index['objId'] == objId)
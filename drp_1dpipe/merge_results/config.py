@@ -11,5 +11,10 @@ config_defaults = {
     'log_level': 30,
     # Specific programm options
     'bunch_listfile': 'reduce.json',
-    'output_dir':'output'
+    'output_dir':'output',
+    'summary_format': 'csv',
+    'workers': 1,
+    'relocation': 'move',
+    'catalog': 'off',
+    'stitch': 'off'
     }
\ No newline at end of file
@@ -4,6 +4,8 @@ from collections import namedtuple
 import argparse
 import shutil
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from drp_1dpipe import VERSION
 from drp_1dpipe.core.config import ConfigJson
@@ -11,9 +13,18 @@ from drp_1dpipe.core.logger import init_logger
 from drp_1dpipe.core.argparser import define_global_program_options, AbspathAction
 from drp_1dpipe.core.utils import normpath, get_conf_path, config_update, config_save
 from drp_1dpipe.merge_results.config import config_defaults
-from drp_1dpipe.process_spectra.results import SpectrumResults, RedshiftSummary, StellarSummary, QsoSummary
+from drp_1dpipe.process_spectra.results import SpectrumResults, RedshiftSummary, StellarSummary, QsoSummary, SummaryWriter, summary_formats
+from drp_1dpipe.process_spectra.timing import load_timings, timing_report
+from drp_1dpipe.io.container import (move_containers, write_index,
+                                     read_index)
+from drp_1dpipe.io.catalog import build_catalog
+from drp_1dpipe.io.zpdf_cube import (ZpdfCubeWriter, cube_prefix, list_cubes,
+                                     remove_cubes)
+from drp_1dpipe.io.encoding import merge_grids
+from drp_1dpipe.merge_results.relocate import (Relocator, relocation_modes,
+                                               write_manifest)
 
-logger = logging.getLogger("mergs_results")
+logger = logging.getLogger("merge_results")
 
 
 def define_specific_program_options():
@@ -32,6 +43,23 @@ def define_specific_program_options():
                         help='List of bunch.')
     parser.add_argument('--output_dir', '-o', metavar='DIR', action=AbspathAction,
                         help='Output directory.')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='Number of threads relocating products and '
+                        'reading summaries of bunches.')
+    parser.add_argument('--relocation', choices=list(relocation_modes),
+                        help='How products reach the output data directory: '
+                        'moved, hard linked, or left in bunches and listed in '
+                        'data-manifest.json.')
+    parser.add_argument('--catalog', choices=['on', 'off'],
+                        help='Whether to build products.sqlite, an indexed '
+                        'catalog of products.')
+    parser.add_argument('--summary_format', choices=list(summary_formats),
+                        help='Format of the merged redshift, stellar and qso '
+                        'summaries. parquet and feather need pyarrow.')
+    parser.add_argument('--stitch', choices=['on', 'off'],
+                        help='Whether bunch products were already relocated '
+                        'bunch by bunch, leaving only summaries, zPDF cubes, '
+                        'indexes and catalog to merge.')
 
     return parser
 
@@ -39,6 +67,271 @@ def define_specific_program_options():
 def concat_summury_files():
     pass
 
+
+def _ordered_map(pool, fn, items, window):
+    """Map `fn` on `items` in `pool`, yielding results in `items` order
+
+    At most `window` items are submitted ahead of the consumed result, so
+    that results waiting for an earlier one stay bounded.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _merged_paths(bunch):
+    """Files saving the relocation of a bunch merged by `merge_bunch_products`"""
+    return (os.path.join(bunch, 'merged.json'),
+            os.path.join(bunch, 'merged-index.fits'))
+
+
+def merge_bunch_products(bunch, output_dir, relocation='move', workers=1):
+    """Relocate the products of a single bunch into the run output directory
+
+    Products and product containers of the bunch are relocated to the run
+    data directory and its grids copied to the run grid directory, as soon
+    as the bunch is processed. Product locations and container index
+    entries are saved in the bunch `merged.json` and `merged-index.fits`,
+    read back by `merge_bunches` with `stitch`.
+
+    Parameters
+    ----------
+    bunch : str
+        Bunch output directory
+    output_dir : str
+        Run output directory
+    relocation : str, optional
+        Relocation mode of products, see :obj:`Relocator`, by default 'move'
+    workers : int, optional
+        Number of threads copying products, by default 1
+
+    Returns
+    -------
+    list, list
+        Index entries of the bunch product containers, and (name, location)
+        of the bunch product files
+
+    Raises
+    ------
+    FileNotFoundError
+        If the bunch or its data directory is not found
+    """
+    _check_bunch(bunch)
+    data_dir = os.path.join(output_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    with Relocator(data_dir, mode=relocation, workers=workers) as relocator:
+        entries, locations = _relocate_bunch(bunch, relocator)
+    merge_grids(os.path.join(bunch, 'grids'), os.path.join(output_dir, 'grids'))
+    merged_json, merged_index = _merged_paths(bunch)
+    if entries:
+        write_index(entries, merged_index)
+    with open(merged_json, 'w') as ff:
+        json.dump({'locations': locations, 'containers': len(entries) > 0},
+                  ff)
+    return entries, locations
+
+
+def load_merged_bunch(bunch):
+    """Relocation of a bunch saved by `merge_bunch_products`
+
+    Returns
+    -------
+    list, list
+        Index entries of the bunch product containers, and (name, location)
+        of the bunch product files
+
+    Raises
+    ------
+    FileNotFoundError
+        If the bunch was not merged
+    """
+    merged_json, merged_index = _merged_paths(bunch)
+    if not os.path.exists(merged_json):
+        raise FileNotFoundError("Bunch not merged : {}".format(bunch))
+    with open(merged_json, 'r') as ff:
+        merged = json.load(ff)
+    entries = read_index(merged_index) if merged['containers'] else []
+    return entries, [tuple(location) for location in merged['locations']]
+
+
+def _check_bunch(bunch):
+    if not os.path.exists(bunch):
+        raise FileNotFoundError("Bunch directory not found : {}".format(bunch))
+    bunch_data_dir = os.path.join(bunch, "data")
+    if not os.path.exists(bunch_data_dir):
+        raise FileNotFoundError("Bunch data directory not found : {}".format(bunch_data_dir))
+
+
+def _relocate_bunch(bunch, relocator):
+    """Relocate the product files and containers of a bunch"""
+    locations = relocator.relocate_bunch(bunch)
+    # bunch product containers are moved, not split
+    entries = move_containers(bunch, relocator.data_dir,
+                              relocate=relocator.relocate_file)
+    return entries, locations
+
+
+def merge_bunch(bunch, relocator, writers):
+    """Relocate the products of a bunch and prepare its summaries
+
+    Parameters
+    ----------
+    bunch : str
+        Bunch output directory
+    relocator : :obj:`Relocator`
+        Product relocator, None for a bunch already merged by
+        `merge_bunch_products`
+    writers : list
+        Redshift, stellar and qso :obj:`SummaryWriter`
+
+    Returns
+    -------
+    tuple
+        Summary chunks, one per writer (None for a skipped summary), index
+        entries of the bunch product containers and (name, location) of the
+        bunch products
+
+    Raises
+    ------
+    FileNotFoundError
+        If the bunch, its data directory or its redshift summary is not found
+    """
+    _check_bunch(bunch)
+    if relocator is None:
+        entries, locations = load_merged_bunch(bunch)
+    else:
+        entries, locations = _relocate_bunch(bunch, relocator)
+
+    try:
+        chunks = [writers[0].prepare(bunch)]
+    except FileNotFoundError:
+        raise FileNotFoundError("Redshift summary file not found in {}".format(bunch))
+    for writer in writers[1:]:
+        try:
+            chunks.append(writer.prepare(bunch))
+        except Exception as e:
+            logger.warning("Skipping {} summary of {} : {}".format(
+                writer.summary_class.__summary_name__, bunch, e))
+            chunks.append(None)
+    return chunks, entries, locations
+
+
+def merge_bunches(bunch_list, output_dir, summary_format='csv', workers=1,
+                  relocation='move', stitch=False):
+    """Merge bunch products and summaries into the run output directory
+
+    Bunches are relocated and their summaries read by a pool of `workers`
+    threads (see `merge_bunch`). Summaries are streamed to the run summaries
+    by a single writer, in `bunch_list` order, and so are bunch zPDF cubes
+    to the run zPDF cube and bunch grids of compact products to the run
+    grid directory, if any.
+
+    Parameters
+    ----------
+    bunch_list : list
+        Bunch output directories
+    output_dir : str
+        Output directory
+    summary_format : str, optional
+        Format of the run summaries, by default 'csv'
+    workers : int, optional
+        Number of threads, by default 1
+    relocation : str, optional
+        Relocation mode of products, see :obj:`Relocator`, by default 'move'.
+        With 'manifest', product locations are saved in data-manifest.json.
+    stitch : bool, optional
+        Whether bunches were already relocated by `merge_bunch_products`,
+        by default False
+
+    Returns
+    -------
+    list, list
+        Index entries of the bunch product containers, and (name, location)
+        of the bunch product files
+    """
+    data_dir = os.path.join(output_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    workers = max(1, int(workers))
+    writers = [SummaryWriter(summary_class, output_dir, format=summary_format)
+               for summary_class in (RedshiftSummary, StellarSummary,
+                                     QsoSummary)]
+    entries = []
+    locations = []
+    remove_cubes(output_dir)
+    zpdf_cube = None
+    try:
+        with Relocator(data_dir, mode=relocation, workers=workers) as relocator, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            merged = _ordered_map(
+                pool, lambda bunch: merge_bunch(
+                    bunch, None if stitch else relocator, writers),
+                bunch_list, 2 * workers)
+            for bunch, (chunks, bunch_entries, bunch_locations) in zip(
+                    bunch_list, merged):
+                for writer, chunk in zip(writers, chunks):
+                    if chunk is not None:
+                        writer.write(chunk)
+                entries.extend(bunch_entries)
+                locations.extend(bunch_locations)
+                for prefix in list_cubes(bunch):
+                    if zpdf_cube is None:
+                        zpdf_cube = ZpdfCubeWriter(cube_prefix(output_dir))
+                    zpdf_cube.append_cube(prefix)
+                merge_grids(os.path.join(bunch, 'grids'),
+                            os.path.join(output_dir, 'grids'))
+    finally:
+        for writer in writers:
+            writer.close()
+        if zpdf_cube is not None:
+            zpdf_cube.close()
+    if relocation == 'manifest':
+        write_manifest(locations, output_dir,
+                       os.path.join(output_dir, 'data-manifest.json'))
+    return entries, locations
+
+
+def write_timing_report(bunch_list, output_dir, slowest=10):
+    """Merge bunch timing files into a run-level timing report
+
+    The report is written to `timing_report.json` in `output_dir`.
+
+    Parameters
+    ----------
+    bunch_list : list
+        Bunch output directories
+    output_dir : str
+        Output directory
+    slowest : int, optional
+        Number of slowest spectra to report, by default 10
+
+    Returns
+    -------
+    dict
+        Timing report, None if no bunch has a timing file
+    """
+    records = []
+    for bunch in bunch_list:
+        for record in load_timings(bunch):
+            record['bunch'] = os.path.basename(os.path.normpath(bunch))
+            records.append(record)
+    if not records:
+        return None
+    report = timing_report(records, slowest=slowest)
+    with open(os.path.join(output_dir, 'timing_report.json'), 'w') as ff:
+        json.dump(report, ff, indent=4)
+    for name, stats in report['stages'].items():
+        logger.info("{:<14} total {:10.2f}s  p50 {:8.3f}s  p90 {:8.3f}s  "
+                    "p99 {:8.3f}s  max {:8.3f}s".format(name, stats['total'],
+                                                        stats['p50'],
+                                                        stats['p90'],
+                                                        stats['p99'],
+                                                        stats['max']))
+    return report
+
 def main_method(config):
     """main_method
 
@@ -64,54 +357,25 @@ def main_method(config):
     with open(config.bunch_listfile, "r") as ff :
         bunch_list = json.load(ff)
     
-    data_dir = os.path.join(config.output_dir, 'data')
-    os.makedirs(data_dir, exist_ok=True)
-    galaxy_summary_list = []
-    stellar_summary_list = []
-    qso_summary_list = []
-    for bunch in bunch_list:
-        if not os.path.exists(bunch):
-            raise FileNotFoundError("Bunch directory not found : {}".format(bunch))
-        bunch_data_dir = os.path.join(bunch, "data")
-        if not os.path.exists(bunch_data_dir):
-            raise FileNotFoundError("Bunch data directory not found : {}".format(bunch_data_dir))
-        to_merge = os.listdir(bunch_data_dir)
-        for pfs_candidate in to_merge:
-            shutil.move(
-                os.path.join(bunch_data_dir, pfs_candidate),
-                os.path.join(data_dir, pfs_candidate))
+    entries, locations = merge_bunches(bunch_list, config.output_dir,
+                                       summary_format=config.summary_format,
+                                       workers=config.workers,
+                                       relocation=config.relocation,
+                                       stitch=config.stitch == 'on')
+    if entries:
+        write_index(entries, os.path.join(config.output_dir, 'products-index.fits'))
+    if config.catalog == 'on':
+        summary = RedshiftSummary(output_dir=config.output_dir,
+                                  format=config.summary_format)
+        summary.read()
+        count = build_catalog(os.path.join(config.output_dir, 'products.sqlite'),
+                              config.output_dir, locations=locations,
+                              entries=entries,
+                              spectra=summary.table['spectrum'])
+        logger.info("{} products in catalog".format(count))
 
-        try:
-            amazed_results = RedshiftSummary(output_dir=bunch)
-            amazed_results.read()
-            galaxy_summary_list.extend(amazed_results.summary)
-        except FileNotFoundError:
-            raise FileNotFoundError("Redshift summary file not found in {}".format(bunch))
+    write_timing_report(bunch_list, config.output_dir)
 
-        try:
-            amazed_results = StellarSummary(output_dir=bunch)
-            amazed_results.read()
-            stellar_summary_list.extend(amazed_results.summary)
-        except:
-            pass
-
-        try:
-            amazed_results = QsoSummary(output_dir=bunch)
-            amazed_results.read()
-            qso_summary_list.extend(amazed_results.summary)
-        except:
-            pass
-
-    gsr = RedshiftSummary(output_dir=config.output_dir)
-    gsr.summary = galaxy_summary_list
-    gsr.write()
-    ssr = StellarSummary(output_dir=config.output_dir)
-    ssr.summary = stellar_summary_list
-    ssr.write()
-    qsr = QsoSummary(output_dir=config.output_dir)
-    qsr.summary = qso_summary_list
-    qsr.write()
-    
     return 0
 
 
@@ -0,0 +1,203 @@
+"""
+Relocation of bunch products to the run data directory.
+
+Products of a bunch are listed from its `output.json`. Within a filesystem
+they are renamed (or hard linked) one after the other, without any copy.
+Across filesystems they are copied by a pool of threads, through a
+temporary file so that a killed merge never leaves a truncated product.
+In manifest mode, files are not touched and only their location is
+recorded.
+"""
+
+import os
+import json
+import glob
+import errno
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("merge_results")
+
+relocation_modes = ('move', 'hardlink', 'manifest')
+
+
+def bunch_products(bunch):
+    """Names of the product files of a bunch
+
+    Products are read from the `output.json` list written by
+    process_spectra. Products stored in containers are not files of the
+    bunch data directory and are left out. Without `output.json`, the bunch
+    data directory is listed.
+
+    Parameters
+    ----------
+    bunch : str
+        Bunch output directory
+
+    Returns
+    -------
+    list
+        Product file names, relative to the bunch data directory
+    """
+    path = os.path.join(bunch, 'output.json')
+    if not os.path.exists(path):
+        return sorted(os.listdir(os.path.join(bunch, 'data')))
+    if glob.glob(os.path.join(bunch, 'products*.index.jsonl')):
+        return []
+    with open(path, 'r') as ff:
+        return json.load(ff)
+
+
+def _copy_file(source, destination, remove_source):
+    """Copy `source` to `destination` through a temporary file"""
+    part = destination + '.part'
+    shutil.copy2(source, part)
+    os.replace(part, destination)
+    if remove_source:
+        os.remove(source)
+
+
+class Relocator:
+    """Relocate products to the run data directory
+
+    Parameters
+    ----------
+    data_dir : str
+        Run data directory
+    mode : str, optional
+        One of `relocation_modes`, by default 'move'
+    workers : int, optional
+        Number of threads copying files across filesystems, by default 4
+    """
+
+    def __init__(self, data_dir, mode='move', workers=4):
+        if mode not in relocation_modes:
+            raise ValueError("Unknown relocation mode : {}".format(mode))
+        self.data_dir = data_dir
+        self.mode = mode
+        self._device = os.stat(data_dir).st_dev
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fast(self, source, destination):
+        """Rename or link `source` within a filesystem"""
+        if self.mode == 'move':
+            os.rename(source, destination)
+        else:
+            part = destination + '.part'
+            if os.path.lexists(part):
+                os.remove(part)
+            os.link(source, part)
+            os.replace(part, destination)
+
+    def _relocate(self, source, destination, same_device):
+        """Relocate a file, returning a copy future if it has to be copied"""
+        if same_device:
+            try:
+                self._fast(source, destination)
+                return None
+            except FileNotFoundError:
+                if os.path.exists(destination):
+                    # relocated by a former merge
+                    return None
+                raise
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        return self._pool.submit(_copy_file, source, destination,
+                                 self.mode == 'move')
+
+    def relocate_files(self, sources):
+        """Relocate files to the data directory
+
+        Parameters
+        ----------
+        sources : list
+            Paths of the files to relocate, all in the same directory
+
+        Returns
+        -------
+        list
+            Locations of the files after relocation
+        """
+        if self.mode == 'manifest' or not sources:
+            return list(sources)
+        same_device = (os.stat(os.path.dirname(sources[0])).st_dev
+                       == self._device)
+        locations = []
+        copies = []
+        for source in sources:
+            destination = os.path.join(self.data_dir, os.path.basename(source))
+            future = self._relocate(source, destination, same_device)
+            if future is not None:
+                copies.append(future)
+            locations.append(destination)
+        for future in copies:
+            future.result()
+        if copies:
+            logger.info("Copied {} products across filesystems".format(
+                len(copies)))
+        return locations
+
+    def relocate_file(self, source, name):
+        """Relocate a file to the data directory under `name`
+
+        Returns
+        -------
+        str
+            Location of the file after relocation
+        """
+        if self.mode == 'manifest':
+            return source
+        destination = os.path.join(self.data_dir, name)
+        same_device = (os.stat(os.path.dirname(source)).st_dev
+                       == self._device)
+        future = self._relocate(source, destination, same_device)
+        if future is not None:
+            future.result()
+        return destination
+
+    def relocate_bunch(self, bunch):
+        """Relocate the products of a bunch
+
+        Parameters
+        ----------
+        bunch : str
+            Bunch output directory
+
+        Returns
+        -------
+        list
+            (name, location) of each product
+        """
+        names = bunch_products(bunch)
+        bunch_data_dir = os.path.join(bunch, 'data')
+        locations = self.relocate_files([os.path.join(bunch_data_dir, name)
+                                         for name in names])
+        return list(zip(names, locations))
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def write_manifest(locations, output_dir, path):
+    """Save product locations, relative to `output_dir`
+
+    Parameters
+    ----------
+    locations : list
+        (name, location) of each product
+    output_dir : str
+        Run output directory
+    path : str
+        Manifest JSON file
+    """
+    with open(path, 'w') as ff:
+        json.dump({name: os.path.relpath(location, output_dir)
+                   for name, location in locations}, ff, indent=0)
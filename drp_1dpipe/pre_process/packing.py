@@ -0,0 +1,134 @@
+"""
+Cost-aware packing of spectra in bunches.
+
+The processing cost of each spectrum is predicted from its number of
+unmasked pixels, read from the memory-mapped MASK HDU, or from its file
+size when it can not be read. When spectrum timings of former runs are
+given, the recorded runtime of a spectrum is used as its cost, and the
+cost of other spectra is scaled to seconds by the median runtime per
+pixel. Spectra are then packed in bunches of equal predicted cost, longest
+first.
+"""
+
+import os
+import glob
+import heapq
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from drp_1dpipe.process_spectra.timing import load_timings
+
+logger = logging.getLogger("pre_process")
+
+packing_modes = ('count', 'cost')
+
+
+def unmasked_pixels(path):
+    """Number of unmasked pixels of a pfsObject file, None if unreadable"""
+    try:
+        with fits.open(path, memmap=True) as fd:
+            return int(np.count_nonzero(fd['MASK'].data == 0))
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+
+
+def load_runtimes(run_dirs):
+    """Recorded runtime of the spectra of former runs
+
+    Parameters
+    ----------
+    run_dirs : list
+        Output directories of former runs, holding bunch directories
+
+    Returns
+    -------
+    dict
+        Total processing time of each spectrum, by file name
+    """
+    runtimes = {}
+    for run_dir in run_dirs:
+        for bunch_dir in sorted(glob.glob(os.path.join(run_dir, 'B*'))):
+            for record in load_timings(bunch_dir):
+                if record.get('spectrum') and record.get('total') is not None:
+                    runtimes[os.path.basename(record['spectrum'])] = \
+                        record['total']
+    return runtimes
+
+
+def estimate_costs(spectra_dir, names, runtimes=None):
+    """Predict the processing cost of spectra
+
+    Parameters
+    ----------
+    spectra_dir : str
+        Spectra directory
+    names : list
+        Spectra file names
+    runtimes : dict, optional
+        Recorded runtimes by file name, see `load_runtimes`
+
+    Returns
+    -------
+    :obj:`numpy.ndarray`, str
+        Predicted costs, in `names` order, and their unit, 'seconds' with
+        runtimes matching some spectra, 'pixels' otherwise
+    """
+    paths = [os.path.join(spectra_dir, name) for name in names]
+    pixels = np.array([unmasked_pixels(p) for p in paths], dtype=np.float64)
+    sizes = np.array([os.path.getsize(p) for p in paths], dtype=np.float64)
+    known = np.isfinite(pixels) & (sizes > 0)
+    # pixels per byte, to estimate unreadable spectra from their size
+    ratio = np.median(pixels[known] / sizes[known]) if known.any() else 1.
+    costs = np.where(np.isfinite(pixels), pixels, sizes * ratio)
+
+    runtimes = runtimes or {}
+    recorded = np.array([runtimes.get(name, np.nan) for name in names],
+                        dtype=np.float64)
+    matched = np.isfinite(recorded) & (costs > 0)
+    if not matched.any():
+        return costs, 'pixels'
+    rate = np.median(recorded[matched] / costs[matched])
+    return np.where(np.isfinite(recorded), recorded, costs * rate), 'seconds'
+
+
+def pack(names, costs, count, capacity=None):
+    """Pack spectra in bunches of equal cost, longest processing time first
+
+    Parameters
+    ----------
+    names : list
+        Spectra file names
+    costs : iterable
+        Cost of each spectrum
+    count : int
+        Number of bunches
+    capacity : int, optional
+        Maximum number of spectra per bunch, by default unbounded
+
+    Returns
+    -------
+    list, list
+        Spectra of each bunch, most costly first, and cost of each bunch
+    """
+    count = max(1, int(count))
+    bunches = [[] for _ in range(count)]
+    loads = [0.] * count
+    # (load, bunch index) of bunches with room left
+    heap = [(0., k) for k in range(count)]
+    order = sorted(range(len(names)), key=lambda i: -costs[i])
+    for i in order:
+        load, k = heapq.heappop(heap)
+        bunches[k].append(names[i])
+        loads[k] = load + costs[i]
+        if capacity is None or len(bunches[k]) < capacity:
+            heapq.heappush(heap, (loads[k], k))
+    kept = [k for k in range(count) if bunches[k]]
+    return [bunches[k] for k in kept], [float(loads[k]) for k in kept]
+
+
+def imbalance(loads):
+    """Ratio of the largest bunch cost to the mean bunch cost"""
+    mean = np.mean(loads) if len(loads) else 0.
+    return float(np.max(loads) / mean) if mean > 0 else 1.
@@ -18,6 +18,8 @@ from drp_1dpipe.core.logger import init_logger
 from drp_1dpipe.core.argparser import define_global_program_options, AbspathAction
 from drp_1dpipe.core.utils import normpath, get_conf_path, config_update, config_save
 from drp_1dpipe.pre_process.config import config_defaults
+from drp_1dpipe.pre_process.packing import (packing_modes, load_runtimes,
+                                            estimate_costs, pack, imbalance)
 
 
 logger = logging.getLogger("pre_process")
@@ -44,6 +46,13 @@ def define_specific_program_options():
                         help='List of files of bunch of astronomical objects.')
     parser.add_argument('--output_dir', '-o', metavar='DIR', action=AbspathAction,
                         help='Output directory.')
+    parser.add_argument('--packing', choices=packing_modes,
+                        help='Whether to cut bunches in directory order or '
+                        'to pack spectra in bunches of equal predicted cost.')
+    parser.add_argument('--cost_history', metavar='DIRS',
+                        help='Comma separated output directories of former '
+                        'runs, whose spectrum timings refine the predicted '
+                        'costs.')
 
     return parser
 
@@ -80,6 +89,39 @@ def bunch(bunch_size, spectra_dir):
         yield _list
 
 
+def cost_bunch(bunch_size, spectra_dir, runtimes=None):
+    """Pack spectra in bunches of equal predicted cost
+
+    As many bunches as with `bunch` are built, of at most `bunch_size`
+    spectra each, with a longest-processing-time-first packing.
+
+    Parameters
+    ----------
+    bunch_size : int
+        The maximum number of spectra per bunch
+    spectra_dir : str
+        Path to spectra directory
+    runtimes : dict, optional
+        Recorded runtimes by spectrum file name, see `load_runtimes`
+
+    Returns
+    -------
+    list, dict
+        Spectra of each bunch, and cost report with the predicted cost of
+        each bunch and the predicted imbalance (largest to mean bunch cost)
+    """
+    names = sorted(os.listdir(spectra_dir))
+    bunch_size = int(bunch_size)
+    costs, unit = estimate_costs(spectra_dir, names, runtimes)
+    bunches, loads = pack(names, costs, -(-len(names) // bunch_size),
+                          capacity=bunch_size)
+    report = {'unit': unit,
+              'imbalance': imbalance(loads),
+              'bunches': [{'spectra': len(b), 'cost': load}
+                          for b, load in zip(bunches, loads)]}
+    return bunches, report
+
+
 def main_method(config):
     """main_method
 
@@ -102,8 +144,25 @@ def main_method(config):
     spectra_dir = normpath(config.workdir, config.spectra_dir)
 
     # bunch
+    costs_file = os.path.join(config.output_dir, 'bunch_costs.json')
+    if config.packing == 'cost':
+        runtimes = load_runtimes([normpath(config.workdir, d.strip())
+                                  for d in config.cost_history.split(',')
+                                  if d.strip()])
+        bunches, report = cost_bunch(config.bunch_size, spectra_dir,
+                                     runtimes=runtimes)
+        with open(costs_file, 'w') as f:
+            json.dump(report, f, indent=4)
+        logger.info("Packed {} bunches, predicted imbalance {:.3f} "
+                    "(largest to mean bunch cost in {})".format(
+                        len(bunches), report['imbalance'], report['unit']))
+    else:
+        bunches = bunch(config.bunch_size, spectra_dir)
+        # costs of a former cost packing don't match these bunches
+        if os.path.exists(costs_file):
+            os.remove(costs_file)
     bunch_list = []
-    for i, spc_list in enumerate(bunch(config.bunch_size, spectra_dir)):
+    for i, spc_list in enumerate(bunches):
         spectralist_file = os.path.join(config.output_dir, 'spectralist_B{}.json'.format(str(i)))
         with open(spectralist_file, "w") as ff:
             json.dump(spc_list, ff)
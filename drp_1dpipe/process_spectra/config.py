@@ -23,5 +23,19 @@ config_defaults = {
     'linemeas_linecatalog': '',
     'lineflux': 'on',
     'continue_': False,
-    'stellar': 'on'
+    'stellar': 'on',
+    'workers': 1,
+    'template_cache_dir': '',
+    'intermediate_results': 'on',
+    'scratch_dir': '',
+    'prefetch': 0,
+    'write_behind': 'off',
+    'product_format': 'files',
+    'zpdf_cube': 'off',
+    'product_encoding': 'full',
+    'spectra_queue': '',
+    'queue_batch': 1,
+    'zpdf_threshold': 1e-8,
+    'synthetic_cost': 'lognormal:1.0,0.5',
+    'synthetic_seed': 0
     }
\ No newline at end of file
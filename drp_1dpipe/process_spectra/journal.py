@@ -0,0 +1,136 @@
+import os
+import glob
+import json
+import zlib
+import threading
+
+_journal_pattern = 'journal*.jsonl'
+
+
+def journal_path(output_dir, name=None):
+    """Path of a journal file in a bunch output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch output directory
+    name : str, optional
+        Journal name suffix, used by workers of a bunch
+
+    Returns
+    -------
+    str
+        Journal file path
+    """
+    if name:
+        return os.path.join(output_dir, 'journal-{}.jsonl'.format(name))
+    return os.path.join(output_dir, 'journal.jsonl')
+
+
+def load_journals(output_dir):
+    """Load all journal entries of a bunch output directory
+
+    Truncated or corrupted lines, as left by a killed job, are ignored.
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch output directory
+
+    Returns
+    -------
+    dict
+        Journal entries keyed by (spectrum, pass)
+    """
+    completed = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, _journal_pattern))):
+        with open(path, 'r') as f:
+            for l in f:
+                try:
+                    entry = json.loads(l)
+                    completed[(entry['spectrum'], entry['pass'])] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return completed
+
+
+def remove_journals(output_dir):
+    """Remove all journal files of a bunch output directory"""
+    for path in glob.glob(os.path.join(output_dir, _journal_pattern)):
+        os.remove(path)
+
+
+def file_checksum(path):
+    """CRC32 checksum of a file, as an hexadecimal string"""
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return '{:08x}'.format(crc & 0xffffffff)
+
+
+class CompletionJournal:
+    """An append-only journal of completed processing steps
+
+    Each completed step of a spectrum (`redshift` pass, `linemeas` pass or
+    `product` writing) is appended as a JSON line and synced to disk before
+    the next step starts, so that a killed job can be resumed from the last
+    recorded step.
+    """
+
+    def __init__(self, path, completed=None):
+        """Constructor
+
+        Parameters
+        ----------
+        path : str
+            Journal file to append to
+        completed : dict, optional
+            Entries of previous runs, as returned by `load_journals`
+        """
+        self.path = path
+        self.completed = dict(completed) if completed else {}
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def is_done(self, spectrum, pass_):
+        """Whether `pass_` is recorded as completed for `spectrum`"""
+        return (spectrum, pass_) in self.completed
+
+    def get(self, spectrum, pass_):
+        """Journal entry of a completed step, or None"""
+        return self.completed.get((spectrum, pass_))
+
+    def record(self, spectrum, pass_, filename=None, checksum=None):
+        """Record a completed step
+
+        Parameters
+        ----------
+        spectrum : str
+            Spectrum file name
+        pass_ : str
+            Completed step. One of redshift, linemeas or product
+        filename : str, optional
+            Name of the file produced by the step
+        checksum : str, optional
+            Checksum of the file produced by the step
+        """
+        entry = {'spectrum': spectrum, 'pass': pass_}
+        if filename is not None:
+            entry['file'] = filename
+        if checksum is not None:
+            entry['checksum'] = checksum
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.completed[(spectrum, pass_)] = entry
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,10 +1,14 @@
 import os
+import glob
 import json
 import logging
 import time
 import argparse
 import shutil
 import traceback
+import multiprocessing
+import tempfile
+from collections import namedtuple
 
 
 from drp_1dpipe import VERSION
@@ -15,16 +19,50 @@ from drp_1dpipe.core.utils import normpath, get_conf_path, config_update, config
 from drp_1dpipe.process_spectra.config import config_defaults
 
 from drp_1dpipe.core.utils import init_environ, normpath, TemporaryFilesSet
-from drp_1dpipe.io.reader import read_spectrum
+from drp_1dpipe.core.staging import Prefetcher, WriteBehind
+from drp_1dpipe.io.reader import SpectrumHandle
+from drp_1dpipe.io.container import (ProductContainer, container_path,
+                                     remove_containers)
+from drp_1dpipe.io.zpdf_cube import ZpdfCubeWriter, cube_prefix, remove_cubes
+from drp_1dpipe.io.encoding import CompactEncoding, product_encodings
 from drp_1dpipe.process_spectra.parameters import default_parameters
 from pylibamazed.redshift import (CProcessFlowContext, CProcessFlow, CLog,
                                   CParameterStore, CClassifierStore,
                                   CLogFileHandler, CRayCatalog,
-                                  CTemplateCatalog, get_version)
-from drp_1dpipe.process_spectra.results import SpectrumResults
+                                  get_version)
+from drp_1dpipe.process_spectra.results import SpectrumResults, redshift_header
+from drp_1dpipe.process_spectra.spectra_queue import SpectraQueue, QueuedSpectra
+from drp_1dpipe.process_spectra.template_cache import TemplateCatalogCache
+from drp_1dpipe.process_spectra.journal import (CompletionJournal, journal_path,
+                                                load_journals, remove_journals,
+                                                file_checksum)
+from drp_1dpipe.process_spectra.timing import (SpectrumTiming, TimingRecorder,
+                                               timing_path, remove_timings)
+from drp_1dpipe.process_spectra.synthetic import (SyntheticCost,
+                                                  write_redshift_results,
+                                                  write_linemeas_results)
 
 logger = logging.getLogger("process_spectra")
 
+AmazedSetup = namedtuple('AmazedSetup',
+                         ['param', 'line_catalog', 'linemeas_param',
+                          'linemeas_line_catalog', 'template_catalog',
+                          'classif'])
+
+# summary files written by amazed in the bunch output directory
+_summary_files = ('redshift.csv', 'stellar.csv', 'qso.csv')
+
+# state shared with forked workers, see _process_spectra_parallel
+_worker_state = {}
+
+# last amazed setup and its key, see _cached_setup
+_setup_cache = {}
+
+# configuration fields the amazed setup depends on
+_setup_fields = ('calibration_dir', 'parameters_file', 'linecatalog',
+                 'linemeas_parameters_file', 'linemeas_linecatalog',
+                 'zclassifier_dir', 'template_dir', 'template_cache_dir')
+
 _map_loglevel = {logging.CRITICAL: CLog.nLevel_Critical,
                  logging.ERROR: CLog.nLevel_Error,
                  logging.WARNING: CLog.nLevel_Warning,
@@ -66,7 +104,8 @@ def define_specific_program_options():
                         help='Specify directory in which zClassifier files are'
                         ' stored.')
     parser.add_argument('--process_method',
-                        help='Process method to use. Whether DUMMY or AMAZED.')
+                        help='Process method to use. Whether DUMMY, AMAZED '
+                        'or SYNTHETIC.')
     parser.add_argument('--output_dir', metavar='DIR', action=AbspathAction,
                         help='Directory where all generated files are going to'
                         ' be stored. Relative to workdir.')
@@ -88,6 +127,55 @@ def define_specific_program_options():
                         '"on" provide stellar results'
                         '"off" do not provide stellar results'
                         '"only" provide only stellar results')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='Number of worker processes sharing the loaded '
+                        'catalogs to process the spectra of the bunch.')
+    parser.add_argument('--template_cache_dir', metavar='DIR', action=AbspathAction,
+                        help='Directory where continuum-removed template '
+                        'catalogs are cached across runs. Needs a pylibamazed '
+                        'CTemplateCatalog with Save and LoadProcessed.')
+    parser.add_argument('--intermediate_results', choices=['on', 'off'],
+                        help='Whether to keep amazed intermediate results in '
+                        'the output directory. '
+                        '"off" writes them to scratch_dir, where they are '
+                        'still parsed to build the product, and removes them '
+                        'once the product is written.')
+    parser.add_argument('--scratch_dir', metavar='DIR', action=AbspathAction,
+                        help='Node-local directory for intermediate results '
+                        'when they are not kept. Defaults to the system '
+                        'temporary directory.')
+    parser.add_argument('--prefetch', metavar='K', type=int,
+                        help='Number of spectra read ahead in a background '
+                        'thread while amazed is running. 0 to disable.')
+    parser.add_argument('--write_behind', choices=['on', 'off'],
+                        help='Whether to write products in a background '
+                        'thread while the next spectrum is processed.')
+    parser.add_argument('--product_format', choices=['files', 'container'],
+                        help='Whether to write one product file per object '
+                        'or a single product container per bunch.')
+    parser.add_argument('--product_encoding', choices=product_encodings,
+                        help='Whether to write products in the full '
+                        'encoding or in the compact one (float32, truncated '
+                        'zPDF, grids saved once and referenced by hash).')
+    parser.add_argument('--zpdf_threshold', type=float, metavar='P',
+                        help='Relative probability under which the zPDF '
+                        'of compact products is truncated.')
+    parser.add_argument('--zpdf_cube', choices=['on', 'off'],
+                        help='Whether to stack the zPDF of the bunch in a '
+                        'zPDF cube.')
+    parser.add_argument('--spectra_queue', metavar='FILE',
+                        help='Spectra queue to pull spectra from until it '
+                        'is empty, instead of processing spectra_listfile. '
+                        'Relative to workdir.')
+    parser.add_argument('--queue_batch', metavar='N', type=int,
+                        help='Number of spectra pulled at once from the '
+                        'spectra queue.')
+    parser.add_argument('--synthetic_cost', metavar='DIST',
+                        help='Per-spectrum cost distribution of the SYNTHETIC '
+                        'process method, as constant:t, uniform:a,b, '
+                        'normal:mu,sigma or lognormal:median,sigma (seconds).')
+    parser.add_argument('--synthetic_seed', metavar='SEED', type=int,
+                        help='Random seed of the SYNTHETIC process method.')
 
     return parser
 
@@ -96,44 +184,47 @@ def _output_path(args, *path):
     return normpath(args.workdir, args.output_dir, *path)
 
 
-def _process_spectrum(output_dir, index, spectrum_path, template_catalog,
-                      line_catalog, param, classif, save_results):
-    try:
-        spectrum = read_spectrum(spectrum_path)
-    except Exception as e:
-        traceback.print_exc()
-        logger.log(logging.ERROR, "Can't load spectrum : {}".format(e))
-        return
+def _process_spectrum(output_dir, index, spectrum_handle, template_catalog,
+                      line_catalog, param, classif, save_results,
+                      summary_dir=None, timing=None):
+    if summary_dir is None:
+        summary_dir = output_dir
+    if timing is None:
+        timing = SpectrumTiming(None)
+    spectrum = spectrum_handle.spectrum
 
     # proc_id = os.path.join(spectrum.GetName(), str(index))
     proc_id, ext = os.path.splitext(spectrum.GetName())
 
     try:
-        ctx = CProcessFlowContext()
-        ctx.Init(spectrum,
-                 proc_id,
-                 template_catalog,
-                 line_catalog,
-                 param,
-                 classif)
+        with timing.stage('init'):
+            ctx = CProcessFlowContext()
+            ctx.Init(spectrum,
+                     proc_id,
+                     template_catalog,
+                     line_catalog,
+                     param,
+                     classif)
     except Exception as e:
         logger.log(logging.ERROR, "Can't init process flow : {}".format(e))
 
     pflow = CProcessFlow()
     try:
-        pflow.Process(ctx)
+        with timing.stage('process'):
+            pflow.Process(ctx)
     except Exception as e:
         logger.log(logging.ERROR, "Can't process : {}".format(e))
 
-    if save_results == 'all':
-        ctx.GetDataStore().SaveRedshiftResult(output_dir)
-        ctx.GetDataStore().SaveStellarResult(output_dir)
-        ctx.GetDataStore().SaveQsoResult(output_dir)
-        ctx.GetDataStore().SaveAllResults(os.path.join(output_dir, proc_id), 'all')
-    elif save_results == 'linemeas':
-        ctx.GetDataStore().SaveAllResults(os.path.join(output_dir, proc_id), 'linemeas')
-    else:
-        raise Exception("Unhandled save_results {}".format(save_results))
+    with timing.stage('save_results'):
+        if save_results == 'all':
+            ctx.GetDataStore().SaveRedshiftResult(summary_dir)
+            ctx.GetDataStore().SaveStellarResult(summary_dir)
+            ctx.GetDataStore().SaveQsoResult(summary_dir)
+            ctx.GetDataStore().SaveAllResults(os.path.join(output_dir, proc_id), 'all')
+        elif save_results == 'linemeas':
+            ctx.GetDataStore().SaveAllResults(os.path.join(output_dir, proc_id), 'linemeas')
+        else:
+            raise Exception("Unhandled save_results {}".format(save_results))
 
 
 def _setup_pass(calibration_dir, parameters_file, line_catalog_file):
@@ -169,20 +260,19 @@ def _setup_pass(calibration_dir, parameters_file, line_catalog_file):
     return param, line_catalog
 
 
-def amazed(config):
-    """Run the full-featured amazed client
+def _setup_amazed(config):
+    """Load parameters, catalogs and classifier used by both passes
 
     Parameters
     ----------
     config : :obj:`Config`
         Configuration object
-    """
-
-    zlog = CLog()
-    logFileHandler = CLogFileHandler(zlog, os.path.join(config.logdir,
-                                                        'amazed.log'))
-    logFileHandler.SetLevelMask(_map_loglevel[config.log_level])
 
+    Returns
+    -------
+    :obj:`AmazedSetup`
+        Parameter stores, line catalogs, template catalog and classifier
+    """
     #
     # Set up param and linecatalog for redshift pass
     #
@@ -216,69 +306,768 @@ def amazed(config):
                                     f"{zclassifier_dir}")
         classif.Load(zclassifier_dir)
 
-    with open(normpath(config.workdir, config.spectra_listfile), 'r') as f:
-        spectra_list = json.load(f)
-
-    template_catalog = CTemplateCatalog(medianRemovalMethod,
-                                        opt_medianKernelWidth,
-                                        opt_nscales, dfBinPath)
-    logger.log(logging.INFO, "Loading %s" % config.template_dir)
-
+    template_cache = TemplateCatalogCache(
+        normpath(config.template_cache_dir)
+        if config.template_cache_dir else None)
     try:
-        template_catalog.Load(normpath(config.template_dir))
+        template_catalog = template_cache.load(normpath(config.template_dir),
+                                               (medianRemovalMethod,
+                                                opt_medianKernelWidth,
+                                                opt_nscales, dfBinPath))
     except Exception as e:
         logger.log(logging.CRITICAL, "Can't load template : {}".format(e))
         raise
 
-    outdir = normpath(config.workdir, config.output_dir)
-    os.makedirs(outdir, exist_ok=True)
+    return AmazedSetup(param, line_catalog, linemeas_param,
+                       linemeas_line_catalog, template_catalog, classif)
 
-    data_dir = os.path.join(outdir, 'data')
-    os.makedirs(data_dir, exist_ok=True)
 
-    outdir_linemeas = None
-    if config.lineflux in ['only', 'on']:
-        outdir_linemeas = '-'.join([outdir, 'lf'])
-        os.makedirs(outdir_linemeas, exist_ok=True)
+def _cached_setup(config):
+    """The amazed setup of `config`, loaded once per process
+
+    A process running several bunches, as a worker of the `localpool`
+    runner, keeps the last setup loaded and reuses it as long as the
+    configuration it depends on is unchanged.
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+
+    Returns
+    -------
+    :obj:`AmazedSetup`
+        Parameter stores, line catalogs, template catalog and classifier
+    """
+    key = tuple(getattr(config, field) for field in _setup_fields)
+    if _setup_cache.get('key') != key:
+        _setup_cache.clear()
+        _setup_cache['setup'] = _setup_amazed(config)
+        _setup_cache['key'] = key
+    else:
+        logger.info("Reusing loaded amazed setup")
+    return _setup_cache['setup']
+
+
+class SpectraProcessor:
+    """Run the redshift and line measurement passes on a list of spectra
+
+    Processing of each spectrum is split in three stages : reading the
+    spectrum file, running amazed and writing the product. Reading can be
+    done ahead of time in a background thread (`config.prefetch` spectra at
+    most) and writing can be done in a background thread while the next
+    spectrum is processed (`config.write_behind`).
+
+    The pylibamazed data store has no result getters : amazed per-spectrum
+    outputs are always saved as text files and parsed back to build the
+    product, the parsing being timed as the `load_results` stage. When
+    intermediate results are disabled, they are saved in a scratch directory
+    and removed once the product is written, so that only products and
+    summary files reach the output directory.
+
+    Completed passes and products are recorded in a `CompletionJournal`.
+    When continuing a previous processing, recorded steps are skipped and
+    steps left half-done by a killed job are done again.
+
+    Time spent in each stage of a spectrum processing is appended to a
+    timing file of the bunch (see `timing_path`).
+
+    With the container product format, products are appended to a
+    :obj:`ProductContainer` of the bunch instead of being written to their
+    own files.
+    """
+
+    def __init__(self, config, setup, summary_dir, completed=None,
+                 journal_name=None):
+        """Constructor
+
+        Parameters
+        ----------
+        config : :obj:`Config`
+            Configuration object
+        setup : :obj:`AmazedSetup`
+            Parameter stores and catalogs returned by `_setup_amazed`
+        summary_dir : str
+            Directory where amazed writes its summary files (redshift.csv, ...)
+        completed : dict, optional
+            Journal entries of a previous processing, by default None
+        journal_name : str, optional
+            Journal and timing files name suffix, by default None
+        """
+        self.config = config
+        self.setup = setup
+        self.summary_dir = summary_dir
+        self.outdir = normpath(config.workdir, config.output_dir)
+        self.data_dir = os.path.join(self.outdir, 'data')
+        self.keep_intermediate = config.intermediate_results == 'on'
+        if config.lineflux == 'only':
+            # redshifts come from a previous run of the whole bunch
+            self.linemeas_catalog = os.path.join(self.outdir, 'redshift.csv')
+        else:
+            self.linemeas_catalog = os.path.join(summary_dir, 'redshift.csv')
+        self.journal_path = journal_path(self.outdir, journal_name)
+        self.timing_path = timing_path(self.outdir, journal_name)
+        self.container_path = container_path(self.outdir, journal_name)
+        self.cube_prefix = cube_prefix(self.outdir, journal_name)
+        self.grid_dir = os.path.join(self.outdir, 'grids')
+        # timings of the spectra read, by index
+        self._timings = {}
+        # redshift summary rows of the bunch, by spectrum
+        self._bunch_redshifts = None
+        self.completed = completed if config.continue_ else None
 
-    products = []
-    for i, spectrum_path in enumerate(spectra_list):
-        spectrum = normpath(config.workdir, config.spectra_dir, spectrum_path)
+    def _is_done(self, spectrum_path, pass_):
+        """Whether a pass can be skipped when continuing a processing"""
+        if not self.config.continue_:
+            return False
+        if pass_ != 'product' and not self.keep_intermediate:
+            # intermediate results of previous processing are not kept
+            return False
+        if pass_ == 'product':
+            return self._product_intact(self.journal.get(spectrum_path,
+                                                         'product'))
+        return self.journal.is_done(spectrum_path, pass_)
+
+    def _product_intact(self, entry):
+        """Whether a journaled product exists and matches its checksum"""
+        if entry is None:
+            return False
+        if self.container is not None:
+            intact = self.container.verify(entry['file'], entry['checksum'])
+        else:
+            path = os.path.join(self.data_dir, entry['file'])
+            intact = os.path.exists(path) and \
+                file_checksum(path) == entry['checksum']
+        if not intact:
+            logger.warning("Product {} missing or corrupted, processing {} "
+                           "again".format(entry['file'], entry['spectrum']))
+        return intact
+
+    def _prepare(self, entry):
+        """Read a spectrum, unless its product already exists
+
+        Returns
+        -------
+        :obj:`SpectrumHandle` or str
+            The spectrum handle, or the product name if the spectrum is
+            already processed
+        """
+        i, spectrum_path = entry
+        if self._is_done(spectrum_path, 'product'):
+            return self.journal.get(spectrum_path, 'product')['file']
+        timing = SpectrumTiming(spectrum_path)
+        with timing.stage('read_spectrum'):
+            spectrum_handle = self._read(normpath(self.config.workdir,
+                                                  self.config.spectra_dir,
+                                                  spectrum_path))
+        self._timings[i] = timing
+        return spectrum_handle
+
+    def _read(self, path):
+        """Read a spectrum file"""
+        return SpectrumHandle(path)
+
+    def _run_pass(self, pass_, i, spectrum_handle, timing):
+        """Run amazed on a spectrum
+
+        Parameters
+        ----------
+        pass_ : str
+            Either redshift or linemeas
+        i : int
+            Spectrum index
+        spectrum_handle : :obj:`SpectrumHandle`
+            Spectrum to process
+        timing : :obj:`SpectrumTiming`
+            Timing of the spectrum
+        """
+        setup = self.setup
+        if pass_ == 'redshift':
+            _process_spectrum(self.work_dir, i, spectrum_handle,
+                              setup.template_catalog,
+                              setup.line_catalog,
+                              setup.param, setup.classif, 'all',
+                              summary_dir=self.summary_dir,
+                              timing=timing)
+        else:
+            setup.linemeas_param.Set_String('linemeascatalog',
+                                            self.linemeas_catalog)
+            with timing.stage('linemeas'):
+                _process_spectrum(self.work_dir_linemeas, i,
+                                  spectrum_handle,
+                                  setup.template_catalog,
+                                  setup.linemeas_line_catalog,
+                                  setup.linemeas_param,
+                                  setup.classif, 'linemeas')
+
+    def _solve(self, i, spectrum_path, spectrum_handle, timing):
+        """Run the redshift and line measurement passes on a spectrum
+
+        Returns
+        -------
+        str, str
+            amazed output directories of both passes
+        """
+        config = self.config
         proc_id, ext = os.path.splitext(spectrum_path)
-        spc_out_dir = os.path.join(outdir, proc_id )    
+        spc_out_dir = os.path.join(self.work_dir, proc_id)
+        spc_out_lin_dir = None
 
         if config.lineflux != 'only':
             # first step : compute redshift
-            to_process = True
-            if os.path.exists(spc_out_dir):
-                if config.continue_:
-                    to_process = False
-                else:
+            if not self._is_done(spectrum_path, 'redshift'):
+                if os.path.exists(spc_out_dir):
                     shutil.rmtree(spc_out_dir)
-            if to_process:
-                _process_spectrum(outdir, i, spectrum, template_catalog,
-                                 line_catalog, param, classif, 'all')
+                self._run_pass('redshift', i, spectrum_handle, timing)
+                if self.keep_intermediate:
+                    self.journal.record(spectrum_path, 'redshift', proc_id)
+            elif config.lineflux == 'on' and \
+                    self.summary_dir != self.outdir and \
+                    not self._is_done(spectrum_path, 'linemeas'):
+                self._carry_redshift(spectrum_path)
 
         if config.lineflux in ['only', 'on']:
             # second step : compute line fluxes
-            to_process_lin = True
-            spc_out_lin_dir = os.path.join(outdir_linemeas, proc_id)
-            if os.path.exists(spc_out_lin_dir):
-                if config.continue_:
-                    to_process_lin = False
-                else:
+            spc_out_lin_dir = os.path.join(self.work_dir_linemeas, proc_id)
+            if not self._is_done(spectrum_path, 'linemeas'):
+                if os.path.exists(spc_out_lin_dir):
                     shutil.rmtree(spc_out_lin_dir)
-            if to_process_lin:
-                linemeas_param.Set_String('linemeascatalog',
-                                        os.path.join(outdir, 'redshift.csv'))
-                _process_spectrum(outdir_linemeas, i, spectrum,
-                                template_catalog,
-                                linemeas_line_catalog, linemeas_param,
-                                classif, 'linemeas')
-            
-        result = SpectrumResults(spectrum, spc_out_dir, output_lines_dir=spc_out_lin_dir, stellar=config.stellar)
-        products.append(result.write(data_dir))
+                self._run_pass('linemeas', i, spectrum_handle, timing)
+                if self.keep_intermediate:
+                    self.journal.record(spectrum_path, 'linemeas', proc_id)
+        return spc_out_dir, spc_out_lin_dir
+
+    def _carry_redshift(self, spectrum_path):
+        """Copy the bunch summary row of a spectrum to the worker summary
+
+        When continuing a processing with workers, the redshift row of a
+        spectrum whose redshift pass is skipped is in the bunch summary, while
+        the line measurement pass reads the summary of the worker. The row
+        appended to the worker summary is deduplicated once the summaries are
+        concatenated.
+        """
+        if self._bunch_redshifts is None:
+            self._bunch_redshifts = {}
+            path = os.path.join(self.outdir, 'redshift.csv')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    for l in f:
+                        if not l.startswith('#') and l.strip():
+                            self._bunch_redshifts[l.split()[0]] = l
+        name = os.path.basename(spectrum_path)
+        row = self._bunch_redshifts.get(name)
+        if row is None:
+            logger.warning("No redshift of {} in the bunch summary for the "
+                           "line measurement".format(name))
+            return
+        path = os.path.join(self.summary_dir, 'redshift.csv')
+        with_header = not os.path.exists(path)
+        with open(path, 'a') as f:
+            if with_header:
+                f.write('\t'.join(redshift_header) + '\n')
+            f.write(row)
+
+    def _write(self, spectrum_path, spectrum_handle, spc_out_dir,
+               spc_out_lin_dir, timing):
+        """Write the product of a spectrum and record its timing
+
+        Returns
+        -------
+        str
+            Product name
+        """
+        with timing.stage('load_results'):
+            result = SpectrumResults(spectrum_handle.path, spc_out_dir,
+                                     output_lines_dir=spc_out_lin_dir,
+                                     stellar=self.config.stellar,
+                                     spectrum_handle=spectrum_handle)
+            result.load()
+        with timing.stage('write'):
+            product = result.write(self.data_dir, container=self.container,
+                                   zpdf_cube=self.zpdf_cube,
+                                   encoding=self.encoding)
+        self.timings.record(timing)
+        if self.container is not None:
+            checksum = self.container.entries[-1]['checksum']
+        else:
+            checksum = file_checksum(os.path.join(self.data_dir, product))
+        self.journal.record(spectrum_path, 'product', product, checksum)
+        if not self.keep_intermediate:
+            shutil.rmtree(spc_out_dir, ignore_errors=True)
+            if spc_out_lin_dir is not None:
+                shutil.rmtree(spc_out_lin_dir, ignore_errors=True)
+        return product
+
+    def run(self, spectra_list):
+        """Process a list of spectra
+
+        Parameters
+        ----------
+        spectra_list : list
+            Spectra file names, relative to `spectra_dir`
+
+        Returns
+        -------
+        list
+            Names of the created products, in `spectra_list` order
+        """
+        config = self.config
+        if self.keep_intermediate:
+            self.work_dir = self.outdir
+        else:
+            self.work_dir = tempfile.mkdtemp(
+                prefix='amazed-',
+                dir=normpath(config.scratch_dir) if config.scratch_dir else None)
+        self.work_dir_linemeas = '-'.join([self.work_dir, 'lf'])
+        if config.lineflux in ['only', 'on']:
+            os.makedirs(self.work_dir_linemeas, exist_ok=True)
+
+        self.journal = CompletionJournal(self.journal_path, self.completed)
+        self.timings = TimingRecorder(self.timing_path)
+        self.container = ProductContainer(self.container_path) \
+            if config.product_format == 'container' else None
+        self.zpdf_cube = ZpdfCubeWriter(self.cube_prefix) \
+            if config.zpdf_cube == 'on' else None
+        self.encoding = CompactEncoding(self.grid_dir, config.zpdf_threshold) \
+            if config.product_encoding == 'compact' else None
+
+        entries = enumerate(spectra_list)
+        if int(config.prefetch) > 0:
+            prefetcher = Prefetcher(entries, self._prepare, config.prefetch)
+            prepared = prefetcher
+        else:
+            prefetcher = None
+            prepared = (self._prepare_inline(entry) for entry in entries)
+        writer = WriteBehind(max(1, int(config.prefetch))) \
+            if config.write_behind == 'on' else None
+
+        products = []
+        try:
+            for (i, spectrum_path), prepared_value, error in prepared:
+                if error is not None:
+                    logger.log(logging.ERROR,
+                               "Can't load spectrum : {}".format(error))
+                    continue
+                if isinstance(prepared_value, str):
+                    # product already written by a previous processing
+                    if writer is not None:
+                        writer.submit(_done_product, prepared_value)
+                    else:
+                        products.append(prepared_value)
+                    continue
+                timing = self._timings.pop(i)
+                spc_out_dir, spc_out_lin_dir = self._solve(i, spectrum_path,
+                                                           prepared_value,
+                                                           timing)
+                if writer is not None:
+                    writer.submit(self._write, spectrum_path, prepared_value,
+                                  spc_out_dir, spc_out_lin_dir, timing)
+                else:
+                    products.append(self._write(spectrum_path, prepared_value,
+                                                spc_out_dir, spc_out_lin_dir,
+                                                timing))
+            if writer is not None:
+                products = writer.results()
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+                logger.info(prefetcher.report())
+            if writer is not None:
+                # queued writes end before the journal and outputs close
+                writer.close()
+                logger.info(writer.report())
+            self.journal.close()
+            self.timings.close()
+            if self.container is not None:
+                self.container.close()
+            if self.zpdf_cube is not None:
+                self.zpdf_cube.close()
+            if self.encoding is not None:
+                logger.info(self.encoding.report())
+            if not self.keep_intermediate:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                shutil.rmtree(self.work_dir_linemeas, ignore_errors=True)
+        return products
+
+    def _prepare_inline(self, entry):
+        try:
+            return entry, self._prepare(entry), None
+        except Exception as e:
+            return entry, None, e
+
+
+class SyntheticSpectraProcessor(SpectraProcessor):
+    """Process spectra with synthetic amazed results
+
+    Spectra are read as in a real processing but amazed is replaced by a
+    sleep drawn from a cost distribution, followed by the writing of
+    synthetic results in amazed formats (see
+    `drp_1dpipe.process_spectra.synthetic`). The setup is a
+    :obj:`SyntheticCost`.
+    """
+
+    def _read(self, path):
+        return SpectrumHandle(path, build_spectrum=False)
+
+    def _run_pass(self, pass_, i, spectrum_handle, timing):
+        cost = self.setup
+        name = spectrum_handle.name
+        rng = cost.rng(name)
+        if pass_ == 'redshift':
+            with timing.stage('process'):
+                time.sleep(cost.sample(name))
+            with timing.stage('save_results'):
+                write_redshift_results(self.work_dir, self.summary_dir, name,
+                                       spectrum_handle.wavelength,
+                                       spectrum_handle.mask, rng,
+                                       stellar=self.config.stellar)
+        else:
+            with timing.stage('linemeas'):
+                time.sleep(cost.sample(name + '-lf'))
+                write_linemeas_results(self.work_dir_linemeas, name, rng)
+
+
+def _done_product(product):
+    """Write-behind task of an already written product"""
+    return product
+
+
+def _dedup_summaries(outdir):
+    """Keep the last summary row of each spectrum
+
+    When continuing a processing, spectra whose redshift pass was written to
+    the summaries but not journaled are processed again, appending a second
+    row. Rows keep the position of the first row of their spectrum.
+
+    Parameters
+    ----------
+    outdir : str
+        Bunch output directory
+    """
+    for name in _summary_files:
+        path = os.path.join(outdir, name)
+        if not os.path.exists(path):
+            continue
+        header = []
+        rows = {}
+        with open(path, 'r') as f:
+            for l in f:
+                if l.startswith('#'):
+                    header.append(l)
+                elif l.strip():
+                    rows[l.split('\t', 1)[0].split()[0]] = l
+        with open(path + '.part', 'w') as f:
+            f.writelines(header)
+            f.writelines(rows.values())
+        os.replace(path + '.part', path)
+
+
+def _process_spectra_list(config, setup, spectra_list, summary_dir,
+                          completed=None, journal_name=None,
+                          processor_class=SpectraProcessor):
+    """Process a list of spectra
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+    setup : :obj:`AmazedSetup`
+        Parameter stores and catalogs returned by `_setup_amazed`
+    spectra_list : list
+        Spectra file names, relative to `spectra_dir`
+    summary_dir : str
+        Directory where amazed writes its summary files (redshift.csv, ...)
+    completed : dict, optional
+        Journal entries of a previous processing, by default None
+    journal_name : str, optional
+        Journal name suffix, by default None
+    processor_class : type, optional
+        Spectra processor class, by default :obj:`SpectraProcessor`
+
+    Returns
+    -------
+    list
+        Names of the created products, in `spectra_list` order
+    """
+    processor = processor_class(config, setup, summary_dir,
+                                 completed=completed,
+                                 journal_name=journal_name)
+    return processor.run(spectra_list)
+
+
+def _split_list(items, n):
+    """Split `items` in at most `n` contiguous slices of similar sizes
+
+    Parameters
+    ----------
+    items : list
+        List to split
+    n : int
+        Maximum number of slices
+
+    Returns
+    -------
+    list
+        List of non empty slices, in `items` order
+    """
+    n = max(1, min(int(n), len(items)))
+    size, extra = divmod(len(items), n)
+    slices = []
+    start = 0
+    for k in range(n):
+        stop = start + size + (1 if k < extra else 0)
+        slices.append(items[start:stop])
+        start = stop
+    return [s for s in slices if s]
+
+
+def _concat_summaries(worker_dirs, outdir):
+    """Append worker summary files to the bunch summary files
+
+    Summary files of each worker directory are appended in `worker_dirs`
+    order, keeping a single header. Worker directories are removed afterwards.
+
+    Parameters
+    ----------
+    worker_dirs : list
+        Worker directories, in processing order
+    outdir : str
+        Bunch output directory
+    """
+    for name in _summary_files:
+        sources = [os.path.join(wd, name) for wd in worker_dirs
+                   if os.path.exists(os.path.join(wd, name))]
+        if not sources:
+            continue
+        path = os.path.join(outdir, name)
+        with_header = not os.path.exists(path)
+        with open(path, 'a') as ff:
+            for source in sources:
+                with open(source, 'r') as f:
+                    for l in f:
+                        if l.startswith('#') and not with_header:
+                            continue
+                        ff.write(l)
+                with_header = False
+    for wd in worker_dirs:
+        shutil.rmtree(wd, ignore_errors=True)
+
+
+def _process_worker_slice(k):
+    """Process the k-th slice of spectra in a forked worker
 
+    The worker state (configuration, loaded catalogs, slices) is inherited
+    from the parent process through `_worker_state`.
+    """
+    state = _worker_state
+    worker_dir = state['worker_dirs'][k]
+    os.makedirs(worker_dir, exist_ok=True)
+    spectra = state['slices'][k]
+    products = _process_spectra_list(state['config'], state['setup'],
+                                     spectra, worker_dir,
+                                     completed=state['completed'],
+                                     journal_name=os.path.basename(worker_dir),
+                                     processor_class=state['processor_class'])
+    return products, list(getattr(spectra, 'pulled', spectra))
+
+
+def _process_spectra_parallel(config, setup, spectra_list, workers,
+                              completed=None, processor_class=SpectraProcessor,
+                              owner=None, first=()):
+    """Process a list of spectra with a pool of forked workers
+
+    Catalogs and parameter stores of `setup` are loaded once by the parent
+    process and shared copy-on-write with the workers. Each worker processes
+    a contiguous slice of `spectra_list`, or pulls spectra from a
+    :obj:`SpectraQueue`, and writes its summary files in its own directory.
+    Those are concatenated in worker order once all workers are done, so
+    that summaries and products keep the order of the processed spectra.
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+    setup : :obj:`AmazedSetup`
+        Parameter stores and catalogs returned by `_setup_amazed`
+    spectra_list : list or :obj:`SpectraQueue`
+        Spectra file names, relative to `spectra_dir`, or queue to pull
+        them from
+    workers : int
+        Number of worker processes
+    completed : dict, optional
+        Journal entries of a previous processing, by default None
+    processor_class : type, optional
+        Spectra processor class, by default :obj:`SpectraProcessor`
+    owner : str, optional
+        Name the spectra pulled from a queue are leased to, by default None
+    first : list, optional
+        Spectra already leased to `owner`, processed by the first worker
+        before pulling, by default none
+
+    Returns
+    -------
+    list, list
+        Names of the created products and processed spectra, in processing
+        order
+    """
+    outdir = normpath(config.workdir, config.output_dir)
+    if isinstance(spectra_list, SpectraQueue):
+        slices = [QueuedSpectra(spectra_list, config.queue_batch, owner=owner,
+                                first=first if k == 0 else ())
+                  for k in range(max(1, int(workers)))]
+        logger.info("Processing queued spectra with {} workers".format(
+            len(slices)))
+    else:
+        slices = _split_list(spectra_list, workers)
+        logger.info("Processing {} spectra with {} workers".format(
+            len(spectra_list), len(slices)))
+    worker_dirs = [os.path.join(outdir, 'W{}'.format(k))
+                   for k in range(len(slices))]
+    if config.continue_:
+        # summaries left by the workers of a killed processing hold journaled
+        # redshift rows, read from the bunch summary when continuing
+        stale = [d for d in glob.glob(os.path.join(outdir, 'W*'))
+                 if os.path.basename(d)[1:].isdigit()]
+        _concat_summaries(sorted(stale), outdir)
+
+    _worker_state.update(config=config, setup=setup, slices=slices,
+                         worker_dirs=worker_dirs, completed=completed,
+                         processor_class=processor_class)
+    try:
+        with multiprocessing.get_context('fork').Pool(len(slices)) as pool:
+            results = pool.map(_process_worker_slice, range(len(slices)),
+                               chunksize=1)
+    finally:
+        _worker_state.clear()
+
+    _concat_summaries(worker_dirs, outdir)
+    return ([product for products, _ in results for product in products],
+            [spectrum for _, spectra in results for spectrum in spectra])
+
+
+def _process_bunch(config, setup, processor_class=SpectraProcessor):
+    """Process the spectra of a bunch
+
+    With `config.spectra_queue`, spectra are pulled from the queue until it
+    is empty, instead of being read from `config.spectra_listfile`. The
+    pulled spectra are then saved to `config.spectra_listfile` and
+    acknowledged. When continuing, the bunch first processes the spectra it
+    had pulled and completed, its unfinished pulls being requeued, and the
+    spectra and products of its previous processing are kept in
+    `config.spectra_listfile` and the returned products.
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+    setup : object
+        Setup of `processor_class`
+    processor_class : type, optional
+        Spectra processor class, by default :obj:`SpectraProcessor`
+
+    Returns
+    -------
+    list
+        Names of the created products, in spectra list order
+    """
+    listfile = normpath(config.workdir, config.spectra_listfile)
+    if config.spectra_queue:
+        queue = SpectraQueue(normpath(config.workdir, config.spectra_queue))
+    else:
+        queue = None
+        with open(listfile, 'r') as f:
+            spectra_list = json.load(f)
+
+    outdir = normpath(config.workdir, config.output_dir)
+    os.makedirs(outdir, exist_ok=True)
+
+    data_dir = os.path.join(outdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    if config.continue_:
+        completed = load_journals(outdir)
+    else:
+        remove_journals(outdir)
+        remove_timings(outdir)
+        remove_containers(outdir)
+        remove_cubes(outdir)
+        completed = None
+
+    workers = int(config.workers)
+    if queue is None:
+        if workers > 1 and len(spectra_list) > 1:
+            products = _process_spectra_parallel(
+                config, setup, spectra_list, workers, completed=completed,
+                processor_class=processor_class)[0]
+        else:
+            products = _process_spectra_list(config, setup, spectra_list,
+                                             outdir, completed=completed,
+                                             processor_class=processor_class)
+        if config.continue_:
+            _dedup_summaries(outdir)
+        return products
+
+    owner = os.path.basename(os.path.normpath(outdir))
+    first = []
+    if config.continue_:
+        first = [s for s in queue.leased(owner) if (s, 'product') in completed]
+        requeued = queue.requeue(owner, keep=first)
+        logger.info("Resuming {} pulled spectra, {} unfinished ones "
+                    "requeued".format(len(first), len(requeued)))
+    if workers > 1:
+        products, pulled = _process_spectra_parallel(
+            config, setup, queue, workers, completed=completed,
+            processor_class=processor_class, owner=owner, first=first)
+    else:
+        spectra = QueuedSpectra(queue, config.queue_batch, owner=owner,
+                                first=first)
+        products = _process_spectra_list(config, setup, spectra, outdir,
+                                         completed=completed,
+                                         processor_class=processor_class)
+        pulled = spectra.pulled
+    logger.info("Processed {} queued spectra".format(len(pulled)))
+    if config.continue_:
+        _dedup_summaries(outdir)
+        # spectra processed by a previous processing, as the listfile then
+        # holds either them or the pre-processed bunch
+        pulled_set = set(pulled)
+        previous = [(spectrum, entry['file'])
+                    for (spectrum, pass_), entry in completed.items()
+                    if pass_ == 'product' and spectrum not in pulled_set]
+        pulled = [spectrum for spectrum, _ in previous] + pulled
+        products = [product for _, product in previous] + products
+    part = listfile + '.part'
+    with open(part, 'w') as f:
+        json.dump(pulled, f)
+    os.replace(part, listfile)
+    queue.ack(owner)
+    summary = os.path.join(outdir, 'redshift.csv')
+    if not os.path.exists(summary):
+        # the queue was emptied by other bunches
+        with open(summary, 'w') as f:
+            f.write('\t'.join(redshift_header) + '\n')
+    return products
+
+
+def amazed(config):
+    """Run the full-featured amazed client
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+    """
+
+    zlog = CLog()
+    logFileHandler = CLogFileHandler(zlog, os.path.join(config.logdir,
+                                                        'amazed.log'))
+    logFileHandler.SetLevelMask(_map_loglevel[config.log_level])
+
+    setup = _cached_setup(config)
+
+    products = _process_bunch(config, setup)
+
+    param = setup.param
     with TemporaryFilesSet(keep_tempfiles=config.log_level <= logging.INFO) as tmpcontext:
 
         # save amazed version and parameters file to output dir
@@ -315,6 +1104,25 @@ def dummy(config):
     logger.info("done")
 
 
+def synthetic(config):
+    """A synthetic client, for pipeline load testing purpose.
+
+    Spectra are read and products, summaries and intermediate results are
+    written as with amazed, but amazed results are replaced by synthetic
+    ones after a delay drawn from `config.synthetic_cost`.
+
+    Parameters
+    ----------
+    config : :obj:`Config`
+        Configuration object
+    """
+    cost = SyntheticCost(config.synthetic_cost, config.synthetic_seed)
+    products = _process_bunch(config, cost,
+                              processor_class=SyntheticSpectraProcessor)
+    with open(os.path.join(config.output_dir, "output.json"), 'w') as ff:
+        json.dump(products, ff)
+
+
 def main_method(config):
     """main method for processing spectra.
 
@@ -340,6 +1148,8 @@ def main_method(config):
         amazed(config)
     elif config.process_method.lower() == 'dummy':
         dummy(config)
+    elif config.process_method.lower() == 'synthetic':
+        synthetic(config)
     else:
         raise "Unknown process_method {}".format(config.process_method)
 
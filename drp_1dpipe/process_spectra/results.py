@@ -10,6 +10,9 @@ from drp_1dpipe.core.utils import TemporaryFilesSet
 
 from pfs.datamodel.drp import PfsObject
 
+# summaries are merged by merge_results
+logger = logging.getLogger("merge_results")
+
 RedshiftResult = namedtuple('RedshiftResult',
                             ['spectrum', 'processingid', 'redshift', 'merit',
                              'template', 'method', 'deltaz', 'reliability',
@@ -54,18 +57,139 @@ linemeas_file_type_map = (str, str, str, int, float,
 
 starCandidate_file_type_map = (float, float, float, str)
 
+# column types of amazed result files, for the vectorised readers
+candidates_dtypes = dict(zip(RedshiftCandidate._fields,
+                             (np.int64, str, np.float64, np.float64,
+                              np.int64, np.float64, np.float64, np.float64,
+                              np.float64, np.float64)))
+
+linemeas_dtypes = dict(zip(LineMeasurement._fields,
+                           (str, str, str, np.int64, np.float64,
+                            np.float64, np.float64, np.float64, np.float64,
+                            str,
+                            np.float64, np.float64, np.float64,
+                            np.float64, np.float64, np.float64, np.float64,
+                            np.float64)))
+
+starCandidate_dtypes = dict(zip(StarCandidate._fields,
+                                (np.float64, np.float64, np.float64, str)))
+
+
+def _to_records(df):
+    """Convert a DataFrame to a record array, string columns as objects"""
+    return df.to_records(index=False,
+                         column_dtypes={name: object for name, dtype
+                                        in df.dtypes.items()
+                                        if not pd.api.types.is_numeric_dtype(dtype)})
+
+
+def read_records(path, dtypes, header=False, nrows=None):
+    """Read a whitespace separated amazed result file as a record array
+
+    Lines starting with '#' are skipped and columns after the ones described
+    by `dtypes` are ignored. Parsing is done by the pandas C parser, with
+    the same float rounding as the former per-field Python conversion.
+
+    Parameters
+    ----------
+    path : str
+        File path
+    dtypes : dict
+        Column names and types, in file order
+    header : bool, optional
+        Whether the first non comment line is a header to skip, by default
+        False
+    nrows : int, optional
+        Maximum number of rows to read, by default all of them
+
+    Returns
+    -------
+    :obj:`numpy.recarray`
+        One record per line, fields being accessible as attributes
+
+    Raises
+    ------
+    ValueError
+        If a line can not be parsed with the given types
+    """
+    names = list(dtypes)
+    try:
+        df = pd.read_csv(path, sep=r'\s+', comment='#',
+                         header=0 if header else None, names=names,
+                         usecols=range(len(names)), dtype=dtypes,
+                         nrows=nrows, engine='c',
+                         float_precision='round_trip')
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame({name: pd.Series(dtype=dtype)
+                           for name, dtype in dtypes.items()})
+    return _to_records(df)
+
+
 redshift_header = ["#Spectrum", "ProcessingID", "Redshift", "Merit", "Template", "Method",
     "Deltaz", "Reliability", "snrHa", "lfHa", "snrOII", "lfOII", "Type"]
 
+# summary file schemas : (file column, field, type) of each known column
+redshift_schema = (('Spectrum', 'spectrum', str),
+                   ('ProcessingID', 'processingid', str),
+                   ('Redshift', 'redshift', np.float64),
+                   ('Merit', 'merit', np.float64),
+                   ('Template', 'template', str),
+                   ('Method', 'method', str),
+                   ('Deltaz', 'deltaz', np.float64),
+                   ('Reliability', 'reliability', str),
+                   ('snrHa', 'snrha', np.float64),
+                   ('lfHa', 'lfha', np.float64),
+                   ('snrOII', 'snroII', np.float64),
+                   ('lfOII', 'lfoII', np.float64),
+                   ('Type', 'type_', str))
+
+# amazed writes the same columns in all three summaries
+stellar_schema = tuple(redshift_schema)
+
+qso_schema = tuple(redshift_schema)
+
+# summary file formats and their extensions
+summary_formats = {'csv': 'csv', 'parquet': 'parquet', 'feather': 'feather'}
+
+
+def _write_csv_rows(ff, table):
+    """Write the rows of a summary table to an open csv summary"""
+    table.to_csv(ff, sep='\t', header=False, index=False, na_rep='nan',
+                 lineterminator='\n')
+
+
+def _arrow_schema(schema):
+    """Arrow schema of a summary schema"""
+    import pyarrow as pa
+    return pa.schema([(field, pa.string() if dtype is str
+                       else pa.from_numpy_dtype(dtype))
+                      for _, field, dtype in schema])
+
+
 class SummaryFile:
+    """A redshift, stellar or QSO summary file
 
-    def __init__(self, output_dir=None):
-        """Constructor for SpectrumResults
+    The summary is held as a DataFrame, `table`, with one column per file
+    column. Columns described by the schema of the summary class are named
+    after their field and typed, other ones are kept as strings. `summary`
+    gives the rows as :obj:`RedshiftResult`.
+
+    Summaries are text files (csv) or, when pandas has a parquet engine,
+    columnar parquet or feather files.
+    """
+
+    __summary_name__ = 'undefined'
+    schema = redshift_schema
+
+    def __init__(self, output_dir=None, format='csv'):
+        """Constructor for SummaryFile
 
         Parameters
         ----------
         output_dir : `str`
             Output directory path
+        format : `str`, optional
+            File format, one of `summary_formats`, by default 'csv'
 
         Raises
         ------
@@ -73,62 +197,303 @@ class SummaryFile:
             A FileNotFoundError exception is raised if 
             * output directory is None
             * output directory not found
+        ValueError
+            A ValueError exception is raised if format is unknown
         """
         if output_dir is None:
             raise FileNotFoundError("Output directory is None : {}")
         if not os.path.exists(output_dir):
             raise FileNotFoundError("No output directory detected for : {}".format(os.path.basename(output_dir)))
+        if format not in summary_formats:
+            raise ValueError("Unknown summary format : {}".format(format))
         self.output_dir = output_dir
-        self.__summary_file_name__ = 'undefined'
+        self.format = format
+        self.__summary_file_name__ = '{}.{}'.format(self.__summary_name__,
+                                                    summary_formats[format])
+        self._table = None
+
+    @property
+    def table(self):
+        """Summary rows, as a DataFrame, empty until read or set"""
+        if self._table is None:
+            self._table = self.empty_table()
+        return self._table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+
+    @classmethod
+    def empty_table(cls):
+        """An empty summary table with the schema columns"""
+        return pd.DataFrame({field: pd.Series(dtype=dtype)
+                             for _, field, dtype in cls.schema})
+
+    @property
+    def summary(self):
+        """Summary rows, as a list of RedshiftResult"""
+        fields = [field for _, field, _ in self.schema]
+        table = self.table.reindex(columns=fields)
+        return [RedshiftResult(*row)
+                for row in table.itertuples(index=False, name=None)]
+
+    @summary.setter
+    def summary(self, results):
+        fields = [field for _, field, _ in self.schema]
+        if results:
+            self.table = pd.DataFrame(list(results), columns=fields)
+        else:
+            self.table = self.empty_table()
 
-    def read(self):
-        """Build redshift_results.
+    def _csv_columns(self, path):
+        """Column names of a csv summary, from its header
 
-        redshift_results is a dict RedshiftResult, keyed by spectrum
-        file names.
+        Columns of a header not matching the data are named after the schema.
         """
+        header, ncols = None, None
+        with open(path, 'r') as f:
+            for l in f:
+                if not l.strip():
+                    continue
+                if l.startswith('#'):
+                    if header is None:
+                        header = l[1:].split()
+                    continue
+                ncols = len(l.split())
+                break
+        known = {column: field for column, field, _ in self.schema}
+        if header is not None and (ncols is None or len(header) == ncols):
+            return [known.get(column, column) for column in header]
+        fields = [field for _, field, _ in self.schema]
+        if ncols is None:
+            return fields
+        return fields[:ncols] + ['col{}'.format(i)
+                                 for i in range(len(fields), ncols)]
+
+    def _read_csv(self, path):
+        names = self._csv_columns(path)
+        types = {field: dtype for _, field, dtype in self.schema}
+        dtypes = {name: types.get(name, str) for name in names}
+        try:
+            return pd.read_csv(path, sep=r'\s+', comment='#', header=None,
+                               names=names, dtype=dtypes, engine='c',
+                               float_precision='round_trip')
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame({name: pd.Series(dtype=dtype)
+                                 for name, dtype in dtypes.items()})
+
+    def read(self):
+        """Read the summary file into `table`"""
         path = os.path.join(self.output_dir, self.__summary_file_name__)
         if not os.path.exists(path):
             raise FileNotFoundError("No redshift summary file detected : {}".format(path))
-        with open(path, 'r') as f:
-                self.summary = []
-                for l in f:
-                    if not l.strip() or l.startswith('#'):
-                        continue
-                    _r = [f(x) for f, x in zip(redshift_file_type_map, l.split())]
-                    candidate = RedshiftResult(*_r)
-                    self.summary.append(candidate)
-    
+        if self.format == 'parquet':
+            self.table = pd.read_parquet(path)
+        elif self.format == 'feather':
+            self.table = pd.read_feather(path)
+        else:
+            self.table = self._read_csv(path)
+
     def write(self):
+        """Write `table` to the summary file"""
         path = os.path.join(self.output_dir, self.__summary_file_name__)
-        with open(path, 'w') as ff:
-            header = "\t".join(redshift_header)+"\n"
-            ff.write(header)
-            for elt in self.summary:
-                data = "\t".join([str(i) for i in elt._asdict().values()])+'\n'
-                ff.write(data)
+        table = self.table.reset_index(drop=True)
+        if self.format == 'parquet':
+            table.to_parquet(path, index=False)
+        elif self.format == 'feather':
+            table.to_feather(path)
+        else:
+            columns = {field: column for column, field, _ in self.schema}
+            header = "#" + "\t".join(columns.get(name, name)
+                                      for name in table.columns) + "\n"
+            with open(path, 'w') as ff:
+                ff.write(header)
+                _write_csv_rows(ff, table)
 
 class RedshiftSummary(SummaryFile):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.__summary_file_name__ = 'redshift.csv'
+    __summary_name__ = 'redshift'
+    schema = redshift_schema
 
 class StellarSummary(SummaryFile):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.__summary_file_name__ = 'stellar.csv'
+    __summary_name__ = 'stellar'
+    schema = stellar_schema
 
 class QsoSummary(SummaryFile):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.__summary_file_name__ = 'qso.csv'
+    __summary_name__ = 'qso'
+    schema = qso_schema
+
+
+class SummaryWriter:
+    """Stream the summaries of many directories into a single summary
+
+    Rows of each input are appended to the open output as soon as it is
+    given, so that memory use does not depend on the number of inputs. csv
+    inputs whose header is the schema header are copied to a csv output as
+    raw text, without parsing nor type conversion. Other inputs are read
+    and their schema columns converted, columns out of the schema being
+    dropped with a warning. parquet and feather outputs get one row group or
+    record batch per input.
+
+    Inputs may be prepared concurrently with `prepare`, the chunks being
+    then written in order with `write`.
+    """
+
+    def __init__(self, summary_class, output_dir, format='csv'):
+        """Constructor for SummaryWriter
+
+        Parameters
+        ----------
+        summary_class : type
+            Summary class, :obj:`RedshiftSummary`, :obj:`StellarSummary` or
+            :obj:`QsoSummary`
+        output_dir : `str`
+            Output directory path
+        format : `str`, optional
+            Output file format, one of `summary_formats`, by default 'csv'
+        """
+        self.summary_class = summary_class
+        self.format = format
+        output = summary_class(output_dir=output_dir, format=format)
+        self.path = os.path.join(output_dir, output.__summary_file_name__)
+        self.fields = [field for _, field, _ in summary_class.schema]
+        self.header = "#" + "\t".join(column for column, _, _
+                                       in summary_class.schema) + "\n"
+        self._file = None
+        self._writer = None
+        if format == 'csv':
+            self._file = open(self.path, 'w')
+            self._file.write(self.header)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._arrow_schema = _arrow_schema(summary_class.schema)
+            if format == 'parquet':
+                self._writer = pq.ParquetWriter(self.path, self._arrow_schema)
+            else:
+                self._writer = pa.ipc.new_file(self.path, self._arrow_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _skip_header(self, f):
+        """Skip leading comment lines of `f`
+
+        Returns
+        -------
+        bool
+            Whether the header is the schema header
+        """
+        raw = False
+        while True:
+            position = f.tell()
+            l = f.readline()
+            if not l:
+                return raw
+            if not l.strip():
+                continue
+            if not l.startswith('#'):
+                f.seek(position)
+                return raw
+            raw = raw or l.rstrip('\n') == self.header.rstrip('\n')
+
+    def prepare(self, input_dir):
+        """Prepare the csv summary of a directory for `write`
+
+        Only the input is read, so that inputs may be prepared from several
+        threads.
+
+        Parameters
+        ----------
+        input_dir : `str`
+            Directory of the summary to append
+
+        Returns
+        -------
+        `str` or :obj:`pandas.DataFrame`
+            Path of a summary to copy as raw text, or rows to convert
+
+        Raises
+        ------
+        FileNotFoundError
+            A FileNotFoundError exception is raised if the summary file is
+            not found
+        """
+        source = self.summary_class(output_dir=input_dir)
+        path = os.path.join(input_dir, source.__summary_file_name__)
+        if not os.path.exists(path):
+            raise FileNotFoundError("No redshift summary file detected : {}".format(path))
+        if self._file is not None:
+            with open(path, 'r') as f:
+                if self._skip_header(f):
+                    return path
+        source.read()
+        dropped = [c for c in source.table.columns if c not in self.fields]
+        if dropped:
+            logger.warning("Columns out of the {} summary schema dropped "
+                           "from {} : {}".format(
+                               self.summary_class.__summary_name__, path,
+                               ', '.join(map(str, dropped))))
+        return source.table.reindex(columns=self.fields)
+
+    def write(self, chunk):
+        """Append a chunk returned by `prepare` to the output"""
+        if isinstance(chunk, str):
+            with open(chunk, 'r') as f:
+                self._skip_header(f)
+                self._copy_rows(f)
+        elif self._file is not None:
+            _write_csv_rows(self._file, chunk)
+        else:
+            import pyarrow as pa
+            self._writer.write_table(pa.Table.from_pandas(
+                chunk, schema=self._arrow_schema, preserve_index=False))
+
+    def append(self, input_dir):
+        """Append the csv summary of a directory
+
+        Parameters
+        ----------
+        input_dir : `str`
+            Directory of the summary to append
+
+        Raises
+        ------
+        FileNotFoundError
+            A FileNotFoundError exception is raised if the summary file is
+            not found
+        """
+        self.write(self.prepare(input_dir))
+
+    def _copy_rows(self, f):
+        """Copy the remaining lines of `f` to the output"""
+        last = ''
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            self._file.write(block)
+            last = block[-1]
+        if last and last != '\n':
+            self._file.write('\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
 
 
 class SpectrumResults:
     """A class for mapping spectrum results
     """
 
-    def __init__(self, spectrum_path=None, output_dir=None, output_lines_dir=None, stellar="on"):
+    def __init__(self, spectrum_path=None, output_dir=None, output_lines_dir=None, stellar="on",
+                 spectrum_handle=None):
         """Constructor for SpectrumResults
 
         Parameters
@@ -139,6 +504,8 @@ class SpectrumResults:
             Output directory path
         output_lines_dir : `str`, optional
             Output directory path for lines measurement, by default None
+        spectrum_handle : :obj:`SpectrumHandle`, optional
+            Already read spectrum file, by default None
 
         Raises
         ------
@@ -165,6 +532,8 @@ class SpectrumResults:
                 raise FileNotFoundError("No output lines directory detected for : {}".format(os.path.basename(self.output_dir)))
         self.output_lines_dir = output_lines_dir
         self.stellar = stellar
+        self.spectrum_handle = spectrum_handle
+        self.loaded = False
 
     def _read_candidates(self):
         """Method used to read candidate file produced by amazed
@@ -177,15 +546,8 @@ class SpectrumResults:
         path = os.path.join(self.output_dir, 'candidatesresult.csv')
         if not os.path.exists(path):
             raise FileNotFoundError("No candidates file detected for : {}".format(os.path.basename(self.output_dir)))
-        with open(path, 'r') as f:
-                self.candidates = []
-                for l in f:
-                    if not l.strip() or l.startswith('#'):
-                        continue
-                    # rank	IDs	redshift	intgProba	Rank_PDF	Deltaz	gaussAmp_unused	gaussAmpErr_unused	gaussSigma_unused	gaussSigmaErr_unused
-                    _r = [f(x) for f, x in zip(candidates_file_type_map, l.split())]
-                    candidate = RedshiftCandidate(*_r)
-                    self.candidates.append(candidate)
+        # rank	IDs	redshift	intgProba	Rank_PDF	Deltaz	gaussAmp_unused	gaussAmpErr_unused	gaussSigma_unused	gaussSigmaErr_unused
+        self.candidates = read_records(path, candidates_dtypes)
 
     def _read_models(self):
         """Method used to read models files produced by amazed
@@ -204,19 +566,17 @@ class SpectrumResults:
             path = os.path.join(self.output_dir, 'linemodelsolve.linemodel_spc_extrema_{}.csv'.format(i))
             if not os.path.exists(path):
                 raise FileNotFoundError("No model file detected for : {} candidate number : {}".format(os.path.basename(self.output_dir), i))
-            with open(path, 'r') as f:
-                model = []
-                for l in f:
-                    if not l.strip() or l.startswith('#'):
-                        continue
-                    model.append(l.split()[1])
-            models.append(model)
+            models.append(np.loadtxt(path, dtype=np.float64, comments='#',
+                                     usecols=1, ndmin=1))
         self.models = np.array(models, dtype=np.float64)
 
     def _read_lambda_ranges(self):
         """Method used to read lambda vector from spectrum
         """
-        obj = PfsObject.readFits(self.spectrum_path)
+        if self.spectrum_handle is not None:
+            obj = self.spectrum_handle
+        else:
+            obj = PfsObject.readFits(self.spectrum_path)
         self.lambda_ranges = obj.wavelength
         self.mask = obj.mask
 
@@ -251,13 +611,7 @@ class SpectrumResults:
                             'logposterior.logMargP_Z_data.csv')
         if not os.path.exists(path):
             raise FileNotFoundError("No zPDF file detected for : {}".format(os.path.basename(self.output_dir)))
-        with open(path, 'r') as f:
-            pdf = []
-            for l in f:
-                if not l.strip() or l.startswith('#'):
-                    continue
-                pdf.append(l.split())
-            self.zpdf = np.array(pdf, dtype=float)
+        self.zpdf = np.loadtxt(path, dtype=np.float64, comments='#', ndmin=2)
 
     def _read_lines(self):
         """Method used to read lines file produced by amazed
@@ -275,6 +629,20 @@ class SpectrumResults:
                             'linemodelsolve.linemodel_fit_extrema_0.csv')
         if not os.path.exists(path):
             raise FileNotFoundError("No lines file detected for : {}".format(os.path.basename(self.output_dir)))
+        try:
+            df = pd.DataFrame(read_records(path, linemeas_dtypes))
+        except ValueError:
+            # some lines are malformed, parse line by line to skip them
+            df = pd.DataFrame(self._parse_lines(path),
+                              columns=LineMeasurement._fields)
+            df = df.astype(linemeas_dtypes)
+        df['fit_group'] = df['fit_group'].astype(object).where(
+            df['fit_group'] != '-1', None)
+        self.linemeas = _to_records(df)
+
+    @staticmethod
+    def _parse_lines(path):
+        """Parse lines file line by line, logging and skipping bad lines"""
         with open(path, 'r') as f:
             lm = []
             for l in f:
@@ -283,31 +651,24 @@ class SpectrumResults:
                 try:
                     _r = [f(x) for f, x in zip(linemeas_file_type_map,
                                                 l.split())]
+                    # fit_group is mapped back to '-1' by _read_lines
+                    _r[9] = '-1' if _r[9] is None else _r[9]
                     lm.append(LineMeasurement(*_r))
                 except Exception as e:
                     logging.log(logging.CRITICAL,
                                 "Can't parse line measurement : "
                                 "{}: {}".format(e, l))
                     continue
-            self.linemeas = lm
+        return lm
 
     def _read_star(self):
         """Read star result for each spectrum"""
         path = os.path.join(self.output_dir, 'stellarsolve.stellarresult.csv')
         if not os.path.exists(path):
             raise FileNotFoundError("No stellar candidates file detected for : {}".format(os.path.basename(self.output_dir)))
-        with open(path, 'r') as f:
-            num_line = 0
-            for l in f:
-                if not l.strip() or l.startswith('#'):
-                    continue
-                if num_line == 0 :
-                    num_line = 1
-                    continue
-                else:
-                    _r = [f(x) for f, x in zip( starCandidate_file_type_map, l.split())]
-                    self.star_candidate = [StarCandidate(*_r)]
-                    break
+        # first line is a header, only the best candidate is kept
+        self.star_candidate = read_records(path, starCandidate_dtypes,
+                                           header=True, nrows=1)
 
     def load(self):
         """Method used to load all results produced by amazed for one spectrum
@@ -338,21 +699,30 @@ class SpectrumResults:
                 self._read_star()
             except FileNotFoundError:
                 pass
-            
-    def write(self, path):
+        self.loaded = True
+
+    def write(self, path, container=None, zpdf_cube=None, encoding=None):
         """Method used to write PFS product
 
         Parameters
         ----------
         path : `str`
             Output directory
+        container : :obj:`ProductContainer`, optional
+            Container to append the product to, instead of writing it to
+            its own file in `path`, by default None
+        zpdf_cube : :obj:`ZpdfCubeWriter`, optional
+            Cube to append the product zPDF to, by default None
+        encoding : :obj:`CompactEncoding`, optional
+            Compact encoding of the product, by default the full encoding
 
         Returns
         -------
         `str`
             Name of product file
         """
-        self.load()
+        if not self.loaded:
+            self.load()
         if self.classification.type == 'G' and self.stellar.strip().lower() != 'only':
             object_class = 'GALAXY'
             lambda_scale = self.lambda_ranges
@@ -378,7 +748,12 @@ class SpectrumResults:
                             models,
                             zpdf,
                             linemeas,
-                            object_class)
+                            object_class,
+                            container=container,
+                            encoding=encoding)
+        if zpdf_cube is not None and zpdf is not None:
+            zpdf_cube.add((catId, tract, patch, objId, nvisit, pfsVisitHash),
+                          zpdf[:, 0], zpdf[:, 1])
         return filename
 
     @staticmethod
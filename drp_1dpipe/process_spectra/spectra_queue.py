@@ -0,0 +1,249 @@
+"""
+Shared queue of spectra to process.
+
+Instead of processing a fixed list of spectra, process_spectra workers pull
+spectra from a queue shared by all bunches of a run until it is empty, so
+that slow spectra delay only the worker processing them. The queue is a
+JSON list of spectra and a cursor file giving the number of spectra
+already pulled, updated under an exclusive `fcntl` lock. It can be shared
+by the local processes of a run as well as by the jobs of a batch array,
+as long as the filesystem supports locks.
+
+Spectra pulled by an owner (a bunch) are leased to it, in a lease file
+appended at each pull, until it acknowledges them. The unfinished pulls of
+a failed owner can be requeued, to be pulled again before the rest of the
+queue.
+"""
+
+import os
+import glob
+import json
+import fcntl
+from contextlib import contextmanager
+
+
+class SpectraQueue:
+    """A queue of spectra shared by processes
+
+    Parameters
+    ----------
+    path : str
+        Queue file, a JSON list of spectra
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError("Spectra queue not found : {}".format(path))
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.cursor_path = path + '.cursor'
+        self.requeued_path = path + '.requeued'
+        with open(path, 'r') as f:
+            self.spectra = json.load(f)
+
+    @classmethod
+    def create(cls, path, spectra):
+        """Create a queue, replacing any former one
+
+        Parameters
+        ----------
+        path : str
+            Queue file
+        spectra : list
+            Spectra, in pulling order
+
+        Returns
+        -------
+        :obj:`SpectraQueue`
+            The queue
+        """
+        part = path + '.part'
+        with open(part, 'w') as f:
+            json.dump(list(spectra), f)
+        os.replace(part, path)
+        _write_cursor(path + '.cursor', 0)
+        for lease in glob.glob(glob.escape(path) + '.lease-*'):
+            os.remove(lease)
+        _write_list(path + '.requeued', [])
+        return cls(path)
+
+    def files(self):
+        """Paths of the existing files of the queue"""
+        paths = [self.path, self.cursor_path, self.lock_path,
+                 self.requeued_path]
+        paths += glob.glob(glob.escape(self.path) + '.lease-*')
+        return [path for path in paths if os.path.exists(path)]
+
+    def _read_cursor(self):
+        try:
+            with open(self.cursor_path, 'r') as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def lease_path(self, owner):
+        """Path of the lease file of `owner`"""
+        return '{}.lease-{}'.format(self.path, owner)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def pull(self, count=1, owner=None):
+        """Pull spectra from the queue
+
+        Requeued spectra are pulled first.
+
+        Parameters
+        ----------
+        count : int, optional
+            Maximum number of spectra to pull, by default 1
+        owner : str, optional
+            Name of the puller, the pulled spectra being leased to it until
+            acknowledged with `ack`, by default None for no lease
+
+        Returns
+        -------
+        list
+            Pulled spectra, empty once the queue is empty
+        """
+        count = max(1, int(count))
+        with self._locked():
+            requeued = _read_list(self.requeued_path)
+            pulled = requeued[:count]
+            if pulled:
+                _write_list(self.requeued_path, requeued[len(pulled):])
+            cursor = self._read_cursor()
+            new = self.spectra[cursor:cursor + count - len(pulled)]
+            if new:
+                _write_cursor(self.cursor_path, cursor + len(new))
+            pulled += new
+            if pulled and owner is not None:
+                with open(self.lease_path(owner), 'a') as f:
+                    f.write(json.dumps(pulled) + '\n')
+        return pulled
+
+    def leased(self, owner):
+        """Spectra leased to `owner` and not yet acknowledged"""
+        leased = []
+        try:
+            with open(self.lease_path(owner), 'r') as f:
+                for l in f:
+                    try:
+                        leased.extend(json.loads(l))
+                    except ValueError:
+                        # partial line of a killed puller
+                        continue
+        except FileNotFoundError:
+            pass
+        return leased
+
+    def ack(self, owner):
+        """Acknowledge all the spectra leased to `owner`"""
+        with self._locked():
+            try:
+                os.remove(self.lease_path(owner))
+            except FileNotFoundError:
+                pass
+
+    def requeue(self, owner, keep=()):
+        """Requeue the spectra leased to `owner`
+
+        Parameters
+        ----------
+        owner : str
+            Name of the puller
+        keep : iterable, optional
+            Spectra left leased to `owner`, as the ones it has already
+            processed, by default none
+
+        Returns
+        -------
+        list
+            Requeued spectra
+        """
+        keep = set(keep)
+        with self._locked():
+            leased = self.leased(owner)
+            requeued = [s for s in leased if s not in keep]
+            if requeued:
+                kept = [s for s in leased if s in keep]
+                part = self.lease_path(owner) + '.part'
+                with open(part, 'w') as f:
+                    if kept:
+                        f.write(json.dumps(kept) + '\n')
+                os.replace(part, self.lease_path(owner))
+                _write_list(self.requeued_path,
+                            requeued + _read_list(self.requeued_path))
+        return requeued
+
+    def remaining(self):
+        """Number of spectra left in the queue"""
+        return max(0, len(self.spectra) - self._read_cursor()) + \
+            len(_read_list(self.requeued_path))
+
+
+def _write_cursor(path, cursor):
+    """Replace the cursor file, so that readers never see it empty"""
+    with open(path + '.part', 'w') as f:
+        f.write(str(cursor))
+    os.replace(path + '.part', path)
+
+
+def _read_list(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _write_list(path, spectra):
+    """Replace a JSON list file, so that readers never see it partial"""
+    with open(path + '.part', 'w') as f:
+        json.dump(spectra, f)
+    os.replace(path + '.part', path)
+
+
+class QueuedSpectra:
+    """Spectra pulled from a :obj:`SpectraQueue` while iterated
+
+    Parameters
+    ----------
+    queue : :obj:`SpectraQueue`
+        Queue to pull spectra from
+    batch : int, optional
+        Number of spectra pulled at once, by default 1
+    owner : str, optional
+        Name the spectra are leased to, by default None for no lease
+    first : list, optional
+        Spectra already leased to `owner`, iterated before pulling, by
+        default none
+
+    Attributes
+    ----------
+    pulled : list
+        Spectra pulled so far, in pulling order
+    """
+
+    def __init__(self, queue, batch=1, owner=None, first=()):
+        self.queue = queue
+        self.batch = max(1, int(batch))
+        self.owner = owner
+        self.first = list(first)
+        self.pulled = []
+
+    def __iter__(self):
+        self.pulled.extend(self.first)
+        yield from self.first
+        while True:
+            spectra = self.queue.pull(self.batch, owner=self.owner)
+            if not spectra:
+                return
+            self.pulled.extend(spectra)
+            yield from spectra
@@ -0,0 +1,283 @@
+"""
+Synthetic amazed results, for load testing the pipeline without
+calibration data.
+
+Synthetic results are written in the files and formats amazed produces, so
+that products, summaries and merging follow the same path as a real
+processing.
+"""
+
+import os
+import zlib
+
+import numpy as np
+
+from pfs.datamodel.drp import PfsObject
+from pfs.datamodel.masks import MaskHelper
+from pfs.datamodel.target import Target
+from pfs.datamodel.observations import Observations
+
+from drp_1dpipe.process_spectra.results import SpectrumResults, redshift_header
+
+_cost_distributions = {
+    'constant': 1,
+    'uniform': 2,
+    'normal': 2,
+    'lognormal': 2,
+}
+
+_lines = ('Halpha', 'Hbeta', '[OIII](doublet-1)', '[OII]3726')
+
+_pfsObject_format = "pfsObject-%03d-%05d-%s-%016x-%03d-0x%016x.fits"
+
+
+class SyntheticCost:
+    """A per-spectrum processing cost distribution
+
+    The distribution is described as `name:p1[,p2]`, with name one of
+
+    * `constant:t` : always `t` seconds
+    * `uniform:a,b` : uniform between `a` and `b` seconds
+    * `normal:mu,sigma` : normal, truncated at 0
+    * `lognormal:median,sigma` : log-normal of given median, `sigma` being
+      the standard deviation of the log of the cost
+
+    Costs are drawn from a generator seeded by the seed and the spectrum name,
+    so that they do not depend on the bunching nor on the processing order.
+    """
+
+    def __init__(self, spec, seed=0):
+        """Constructor
+
+        Parameters
+        ----------
+        spec : str
+            Distribution description
+        seed : int, optional
+            Random seed, by default 0
+
+        Raises
+        ------
+        ValueError
+            If `spec` is not a known distribution
+        """
+        name, _, params = spec.partition(':')
+        name = name.strip().lower()
+        if name not in _cost_distributions:
+            raise ValueError("Unknown cost distribution : {}".format(spec))
+        try:
+            self.params = [float(p) for p in params.split(',')] if params else []
+        except ValueError:
+            raise ValueError("Bad cost distribution parameters : {}".format(spec))
+        if len(self.params) != _cost_distributions[name]:
+            raise ValueError("Cost distribution {} expects {} parameters : "
+                             "{}".format(name, _cost_distributions[name], spec))
+        self.name = name
+        self.seed = int(seed)
+
+    def rng(self, key):
+        """Random generator of a spectrum"""
+        return np.random.default_rng([self.seed,
+                                      zlib.crc32(str(key).encode())])
+
+    def sample(self, key):
+        """Draw the cost of `key`, in seconds"""
+        rng = self.rng(key)
+        if self.name == 'constant':
+            cost = self.params[0]
+        elif self.name == 'uniform':
+            cost = rng.uniform(*self.params)
+        elif self.name == 'normal':
+            cost = rng.normal(*self.params)
+        else:
+            cost = self.params[0] * np.exp(rng.normal(0., self.params[1]))
+        return max(0., float(cost))
+
+
+def _summary_row(spectrum, proc_id, redshift, merit, reliability, type_):
+    return [spectrum, proc_id, '{:.6f}'.format(redshift), '{:.4f}'.format(merit),
+            'synthetic.dat', 'synthetic', '{:.6f}'.format(1e-4 * (1 + redshift)),
+            reliability, '-1', '-1', '-1', '-1', type_]
+
+
+def _append_summary(path, row):
+    with_header = not os.path.exists(path)
+    with open(path, 'a') as ff:
+        if with_header:
+            ff.write("\t".join(redshift_header) + "\n")
+        ff.write("\t".join(row) + "\n")
+
+
+def write_redshift_results(output_dir, summary_dir, name, wavelength, mask,
+                           rng, ncandidates=2, stellar='on'):
+    """Write the synthetic results of the redshift pass of a spectrum
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory of per-spectrum results
+    summary_dir : str
+        Directory of summary files (redshift.csv, stellar.csv, qso.csv)
+    name : str
+        Spectrum file name
+    wavelength : :obj:`numpy.ndarray`
+        Wavelength grid of the spectrum
+    mask : :obj:`numpy.ndarray`
+        Mask of the spectrum
+    rng : :obj:`numpy.random.Generator`
+        Random generator
+    ncandidates : int, optional
+        Number of redshift candidates, by default 2
+    stellar : str, optional
+        Stellar mode of the processing, by default 'on'
+    """
+    proc_id, ext = os.path.splitext(name)
+    spc_dir = os.path.join(output_dir, proc_id)
+    os.makedirs(os.path.join(spc_dir, 'zPDF'), exist_ok=True)
+
+    redshifts = np.sort(rng.uniform(0., 3., ncandidates))
+    probas = rng.dirichlet(np.ones(ncandidates))
+    order = np.argsort(probas)[::-1]
+    redshifts, probas = redshifts[order], probas[order]
+
+    _append_summary(os.path.join(summary_dir, 'redshift.csv'),
+                    _summary_row(name, proc_id, redshifts[0], probas[0], 'C1',
+                                 'G'))
+    _append_summary(os.path.join(summary_dir, 'stellar.csv'),
+                    _summary_row(name, proc_id, 0., probas[-1], 'C6', 'S'))
+    _append_summary(os.path.join(summary_dir, 'qso.csv'),
+                    _summary_row(name, proc_id, redshifts[-1], probas[-1], 'C6',
+                                 'Q'))
+
+    with open(os.path.join(spc_dir, 'classificationresult.csv'), 'w') as ff:
+        ff.write("#Type\tEvidenceG\tEvidenceS\tEvidenceQ\n")
+        ff.write("{}\t0.0\t-10.0\t-10.0\n".format('S' if stellar == 'only'
+                                                  else 'G'))
+
+    with open(os.path.join(spc_dir, 'candidatesresult.csv'), 'w') as ff:
+        ff.write("#rank\tIDs\tredshift\tintgProba\tRank_PDF\tDeltaz\t"
+                 "gaussAmp_unused\tgaussAmpErr_unused\tgaussSigma_unused\t"
+                 "gaussSigmaErr_unused\n")
+        for rank, (z, p) in enumerate(zip(redshifts, probas)):
+            ff.write("{}\tEXT{}\t{:.6f}\t{:.6f}\t{}\t{:.6f}\t-1\t-1\t-1\t"
+                     "-1\n".format(rank, rank, z, p, rank, 1e-4 * (1 + z)))
+
+    zgrid = np.arange(0., 3., 1e-3)
+    logpdf = np.full(len(zgrid), -1e3)
+    for z, p in zip(redshifts, probas):
+        logpdf = np.logaddexp(logpdf,
+                              np.log(p) - 0.5 * ((zgrid - z) / 1e-3) ** 2)
+    np.savetxt(os.path.join(spc_dir, 'zPDF', 'logposterior.logMargP_Z_data.csv'),
+               np.column_stack((zgrid, logpdf)), fmt='%.6e', delimiter='\t',
+               header='z\tlogP')
+
+    valid_wavelength = np.extract(mask == 0, wavelength)
+    for rank in range(ncandidates):
+        model = 1. + 0.1 * np.sin(valid_wavelength / (10. * (1 + rank)))
+        np.savetxt(os.path.join(spc_dir,
+                                'linemodelsolve.linemodel_spc_extrema_'
+                                '{}.csv'.format(rank)),
+                   np.column_stack((valid_wavelength, model)), fmt='%.6e',
+                   delimiter='\t', header='lambda\tflux')
+
+    if stellar == 'only':
+        with open(os.path.join(spc_dir, 'stellarsolve.stellarresult.csv'),
+                  'w') as ff:
+            ff.write("#Stellar results\n")
+            ff.write("Redshift\tIntgProba\tEvidenceLog\tTemplate\n")
+            ff.write("0.0\t{:.6f}\t-1.0\tsynthetic_star.dat\n".format(probas[0]))
+
+
+def write_linemeas_results(output_dir, name, rng):
+    """Write the synthetic results of the line measurement pass of a spectrum
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory of per-spectrum line measurement results
+    name : str
+        Spectrum file name
+    rng : :obj:`numpy.random.Generator`
+        Random generator
+    """
+    proc_id, ext = os.path.splitext(name)
+    spc_dir = os.path.join(output_dir, proc_id)
+    os.makedirs(spc_dir, exist_ok=True)
+    with open(os.path.join(spc_dir, 'linemodelsolve.linemodel_fit_extrema_0.csv'),
+              'w') as ff:
+        ff.write("#type\tforce\tname\telt_id\tlambda_rest_beforeOffset\t"
+                 "lambda_obs\tamp\terr\terr_fit\tfit_group\tvelocity\toffset\t"
+                 "sigma\tflux\tflux_err\tflux_di\tcenter_cont_flux\tcont_err\n")
+        for k, line in enumerate(_lines):
+            flux = rng.lognormal(0., 1.)
+            ff.write("E\tS\t{}\t{}\t{:.3f}\t{:.3f}\t{:.6e}\t{:.6e}\t{:.6e}\t-1\t"
+                     "100.0\t0.0\t{:.3f}\t{:.6e}\t{:.6e}\t{:.6e}\t1.0\t"
+                     "0.1\n".format(line, k, 4000. + 500. * k,
+                                    8000. + 1000. * k, flux, 0.1 * flux,
+                                    0.1 * flux, 2.0, flux, 0.1 * flux, flux))
+
+
+def generate_spectra(spectra_dir, count, unique=100, npix=11640, seed=0,
+                     tract=0, patch='0,0'):
+    """Generate fake pfsObject files
+
+    `unique` distinct files are written, the other ones are symbolic links to
+    them, so that millions of spectra can be generated quickly. Each file
+    has its own name, with its own objId.
+
+    Parameters
+    ----------
+    spectra_dir : str
+        Output directory
+    count : int
+        Number of spectra
+    unique : int, optional
+        Number of distinct files, by default 100
+    npix : int, optional
+        Number of pixels of each spectrum, by default 11640
+    seed : int, optional
+        Random seed, by default 0
+    tract : int, optional
+        Tract of the spectra, by default 0
+    patch : str, optional
+        Patch of the spectra, by default '0,0'
+
+    Returns
+    -------
+    list
+        Names of the generated files
+    """
+    os.makedirs(spectra_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    wavelength = np.linspace(380., 1260., npix)
+    observations = Observations(np.array([0]), np.array(['n']), np.array([0]),
+                                np.array([0]), np.array([0]),
+                                np.array([(0.0, 0.0)]), np.array([(0.0, 0.0)]))
+    names = []
+    for objId in range(int(count)):
+        target = Target(catId=0, tract=tract, patch=patch, objId=objId,
+                        ra=0.0, dec=0.0)
+        if objId < unique:
+            obj = PfsObject(target=target,
+                            observations=observations,
+                            wavelength=wavelength,
+                            flux=1. + 0.1 * rng.standard_normal(npix),
+                            mask=np.zeros(npix),
+                            sky=np.zeros(npix),
+                            covar=np.array([np.full(npix, 0.01),
+                                            np.zeros(npix), np.zeros(npix)]),
+                            covar2=np.zeros((2, 2)),
+                            flags=MaskHelper())
+            obj.write(dirName=spectra_dir)
+            name = obj.filenameFormat % obj.getIdentity()
+        else:
+            source = names[objId % unique]
+            catId, tract_, patch_, _, nVisit, pfsVisitHash = \
+                SpectrumResults._parse_pfsObject_name(source)
+            name = _pfsObject_format % (catId, tract_, patch_, objId,
+                                        nVisit % 1000, pfsVisitHash)
+            path = os.path.join(spectra_dir, name)
+            if not os.path.lexists(path):
+                os.symlink(source, path)
+        names.append(name)
+    return names
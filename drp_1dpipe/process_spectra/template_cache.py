@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from pylibamazed.redshift import CTemplateCatalog, get_version
+
+logger = logging.getLogger("process_spectra")
+
+# template catalogs already loaded by this process, keyed by cache key
+_loaded_catalogs = {}
+
+_manifest_name = 'manifest.json'
+
+
+def template_cache_key(template_dir, continuum_removal, version=None):
+    """Compute the cache key of a template catalog
+
+    The key is a hash of the names and contents of the template files, of
+    the continuum removal parameters and of the amazed library version.
+
+    Parameters
+    ----------
+    template_dir : str
+        Path to the template directory
+    continuum_removal : tuple
+        Continuum removal parameters given to `CTemplateCatalog`
+        (method, median kernel width, number of scales, binaries path)
+    version : str, optional
+        amazed library version, by default the one of pylibamazed
+
+    Returns
+    -------
+    str
+        Hexadecimal digest
+    """
+    if version is None:
+        version = get_version()
+    files = []
+    for root, dirs, names in os.walk(template_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            content = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    content.update(block)
+            files.append([os.path.relpath(path, template_dir),
+                          content.hexdigest()])
+    return hashlib.sha1(json.dumps(
+        [str(version), [str(p) for p in continuum_removal], files]).encode()
+    ).hexdigest()
+
+
+def can_cache():
+    """Whether the pylibamazed binding saves and reloads processed catalogs
+
+    The cache needs `CTemplateCatalog.Save`, saving continuum-removed
+    templates, and `CTemplateCatalog.LoadProcessed`, loading them back
+    without continuum removal.
+    """
+    return hasattr(CTemplateCatalog, 'Save') and \
+        hasattr(CTemplateCatalog, 'LoadProcessed')
+
+
+class TemplateCatalogCache:
+    """A persistent cache of continuum-removed template catalogs
+
+    Each entry is a directory named after the cache key (see
+    `template_cache_key`) holding the catalog saved by
+    `CTemplateCatalog.Save`, continuum-removed templates included, and a
+    manifest describing the entry. A cache hit reloads it with
+    `CTemplateCatalog.LoadProcessed`, without continuum removal. Entries are
+    populated in a temporary directory and renamed atomically, so that
+    concurrent bunches can share the same cache directory.
+    """
+
+    def __init__(self, cache_dir=None):
+        """Constructor
+
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Cache directory. If None, only catalogs already loaded by the
+            current process are reused.
+
+        Raises
+        ------
+        NotImplementedError
+            If a cache directory is given and the pylibamazed binding can't
+            save and reload processed catalogs (see `can_cache`)
+        """
+        if cache_dir and not can_cache():
+            raise NotImplementedError(
+                "Template cache needs CTemplateCatalog.Save and "
+                "CTemplateCatalog.LoadProcessed, missing from amazed "
+                "{}".format(get_version()))
+        self.cache_dir = cache_dir
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, template_dir, continuum_removal):
+        """Get the template catalog of `template_dir`
+
+        Parameters
+        ----------
+        template_dir : str
+            Path to the template directory
+        continuum_removal : tuple
+            Continuum removal parameters given to `CTemplateCatalog`
+
+        Returns
+        -------
+        :obj:`CTemplateCatalog`
+            Loaded template catalog
+        """
+        key = template_cache_key(template_dir, continuum_removal)
+        if key in _loaded_catalogs:
+            return _loaded_catalogs[key]
+
+        template_catalog = CTemplateCatalog(*continuum_removal)
+        entry = self._entry_path(key) if self.cache_dir else None
+        if entry and os.path.exists(os.path.join(entry, _manifest_name)):
+            logger.log(logging.INFO,
+                       "Loading {} from cache {}".format(template_dir, entry))
+            template_catalog.LoadProcessed(os.path.join(entry, 'templates'))
+        else:
+            logger.log(logging.INFO, "Loading %s" % template_dir)
+            template_catalog.Load(template_dir)
+            if entry:
+                self._populate(entry, key, template_dir, continuum_removal,
+                               template_catalog)
+        _loaded_catalogs[key] = template_catalog
+        return template_catalog
+
+    def _populate(self, entry, key, template_dir, continuum_removal,
+                  template_catalog):
+        """Save a loaded catalog as a new cache entry"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(prefix='.{}-'.format(key),
+                                     dir=self.cache_dir)
+        try:
+            template_catalog.Save(os.path.join(tmp_entry, 'templates'))
+            with open(os.path.join(tmp_entry, _manifest_name), 'w') as f:
+                json.dump({'key': key,
+                           'template_dir': template_dir,
+                           'continuum_removal': [str(p) for p in continuum_removal],
+                           'amazed-version': get_version()}, f)
+            os.rename(tmp_entry, entry)
+        except OSError as e:
+            # another process populated the entry first
+            logger.log(logging.INFO,
+                       "Template cache entry not created : {}".format(e))
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        except Exception as e:
+            logger.log(logging.WARNING,
+                       "Can't save template catalog to cache : {}".format(e))
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        else:
+            logger.log(logging.INFO,
+                       "Template catalog cached in {}".format(entry))
@@ -0,0 +1,169 @@
+import os
+import glob
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+_timing_pattern = 'timing*.jsonl'
+
+# stages of a spectrum processing, in processing order
+stages = ('read_spectrum', 'init', 'process', 'save_results', 'linemeas',
+          'load_results', 'write')
+
+
+def timing_path(output_dir, name=None):
+    """Path of a timing file in a bunch output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch output directory
+    name : str, optional
+        Timing file name suffix, used by workers of a bunch
+
+    Returns
+    -------
+    str
+        Timing file path
+    """
+    if name:
+        return os.path.join(output_dir, 'timing-{}.jsonl'.format(name))
+    return os.path.join(output_dir, 'timing.jsonl')
+
+
+class SpectrumTiming:
+    """Time spent in each processing stage of a spectrum"""
+
+    def __init__(self, spectrum):
+        """Constructor
+
+        Parameters
+        ----------
+        spectrum : str
+            Spectrum file name
+        """
+        self.spectrum = spectrum
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name`
+
+        Time of a stage entered several times is accumulated.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = (self.stages.get(name, 0.) +
+                                 time.perf_counter() - start)
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def as_dict(self):
+        return {'spectrum': self.spectrum,
+                'total': self.total,
+                'stages': self.stages}
+
+
+class TimingRecorder:
+    """Append spectrum timings to a JSON-lines file"""
+
+    def __init__(self, path):
+        """Constructor
+
+        Parameters
+        ----------
+        path : str
+            Timing file to append to
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, timing):
+        """Append a :obj:`SpectrumTiming`"""
+        with self._lock:
+            self._file.write(json.dumps(timing.as_dict()) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+def load_timings(output_dir):
+    """Load all spectrum timings of a bunch output directory
+
+    Parameters
+    ----------
+    output_dir : str
+        Bunch output directory
+
+    Returns
+    -------
+    list
+        Timing records, as written by `TimingRecorder`. Only the last record
+        of a spectrum processed again by a continued processing is kept.
+    """
+    records = {}
+    for path in sorted(glob.glob(os.path.join(output_dir, _timing_pattern))):
+        with open(path, 'r') as f:
+            for l in f:
+                try:
+                    record = json.loads(l)
+                    records[record['spectrum']] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return list(records.values())
+
+
+def remove_timings(output_dir):
+    """Remove all timing files of a bunch output directory"""
+    for path in glob.glob(os.path.join(output_dir, _timing_pattern)):
+        os.remove(path)
+
+
+def timing_report(records, slowest=10):
+    """Build a timing report from spectrum timing records
+
+    Parameters
+    ----------
+    records : list
+        Timing records, as returned by `load_timings`
+    slowest : int, optional
+        Number of slowest spectra to report, by default 10
+
+    Returns
+    -------
+    dict
+        Number of spectra, per stage statistics (count, total, mean and
+        50th, 90th, 99th percentiles and maximum, in seconds) and the
+        slowest spectra
+    """
+    names = [s for s in stages
+             if any(s in r['stages'] for r in records)]
+    names += sorted(set(s for r in records for s in r['stages']) - set(names))
+    report = {'spectra': len(records), 'stages': {}}
+    for name in names + ['total']:
+        if name == 'total':
+            values = np.array([r['total'] for r in records])
+        else:
+            values = np.array([r['stages'][name] for r in records
+                               if name in r['stages']])
+        if not len(values):
+            continue
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        report['stages'][name] = {'count': int(len(values)),
+                                  'total': float(values.sum()),
+                                  'mean': float(values.mean()),
+                                  'p50': float(p50),
+                                  'p90': float(p90),
+                                  'p99': float(p99),
+                                  'max': float(values.max())}
+    report['slowest'] = sorted(records, key=lambda r: r['total'],
+                               reverse=True)[:slowest]
+    return report
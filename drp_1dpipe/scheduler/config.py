@@ -14,6 +14,9 @@ config_defaults = {
     'scheduler': 'local',
     'venv': '',
     'concurrency': 1,
+    'cores_per_node': 1,
+    'walltime': '01:00:00',
+    'array_throttle': 0,
     'spectra_dir': 'spectra',
     'bunch_size': 8,
     'notification_url': '',
@@ -21,6 +24,24 @@ config_defaults = {
     'parameters_file': get_auxiliary_path("parameters_stellar_galaxy.json"),
     'linemeas_parameters_file': get_auxiliary_path("linemeas-parameters.json"),
     'output_dir':'@AUTO@',
-    'stellar': 'on'
+    'stellar': 'on',
+    'workers': 1,
+    'template_cache_dir': '',
+    'packing': 'count',
+    'cost_history': '',
+    'spectra_queue': 'off',
+    'queue_batch': 1,
+    'product_format': 'files',
+    'zpdf_cube': 'off',
+    'product_encoding': 'full',
+    'zpdf_threshold': 1e-8,
+    'summary_format': 'csv',
+    'merge_workers': 1,
+    'relocation': 'move',
+    'catalog': 'off',
+    'streaming_merge': 'off',
+    'process_method': 'amazed',
+    'synthetic_cost': 'lognormal:1.0,0.5',
+    'synthetic_seed': 0
     }
 
@@ -0,0 +1,155 @@
+"""
+Task graph of a pipeline run.
+
+Tasks run in a thread pool as soon as all the tasks they require are done.
+External tasks, as the process_spectra bunches run by a runner, have no
+function: they are completed by `TaskGraph.complete` when the runner reports
+them. Tasks requiring a failed or skipped task are skipped.
+"""
+
+import time
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("scheduler")
+
+_finished_states = ('done', 'failed', 'skipped')
+
+
+class TaskGraph:
+    """A graph of tasks run as soon as their requirements are done
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of threads running tasks, by default 1
+
+    Attributes
+    ----------
+    errors : dict
+        Error message of each failed task
+    durations : dict
+        Wall time of each task run by the graph, in seconds
+    """
+
+    def __init__(self, workers=1):
+        self._tasks = {}
+        self._dependents = {}
+        self._condition = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        self.errors = {}
+        self.durations = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, name, function=None, requires=()):
+        """Add a task
+
+        Parameters
+        ----------
+        name : str
+            Task name
+        function : callable, optional
+            Function run without argument once all required tasks are done,
+            by default None for an external task
+        requires : iterable, optional
+            Names of the required tasks, already added
+
+        Raises
+        ------
+        ValueError
+            If the task already exists or a required task is unknown
+        """
+        requires = list(requires)
+        with self._condition:
+            if name in self._tasks:
+                raise ValueError("Task already exists : {}".format(name))
+            unknown = [r for r in requires if r not in self._tasks]
+            if unknown:
+                raise ValueError("Unknown required tasks : {}".format(
+                    ', '.join(unknown)))
+            self._tasks[name] = {'function': function, 'requires': requires,
+                                 'state': 'pending'}
+            for required in requires:
+                self._dependents.setdefault(required, []).append(name)
+            self._update(name)
+
+    def state(self, name):
+        """State of a task : pending, running, done, failed or skipped"""
+        with self._condition:
+            return self._tasks[name]['state']
+
+    def complete(self, name, error=None):
+        """Complete an external task
+
+        Tasks already finished are left unchanged.
+
+        Parameters
+        ----------
+        name : str
+            Task name
+        error : str, optional
+            Error message of a failed task, by default None
+        """
+        with self._condition:
+            if self._tasks[name]['state'] not in _finished_states:
+                self._finish(name, error)
+
+    def wait(self):
+        """Wait until all tasks are finished
+
+        External tasks must all be completed.
+
+        Returns
+        -------
+        dict
+            State of each task
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: all(task['state'] in _finished_states
+                            for task in self._tasks.values()))
+            return {name: task['state'] for name, task in self._tasks.items()}
+
+    def close(self):
+        """Wait for running tasks and release the threads"""
+        self._pool.shutdown()
+
+    def _update(self, name):
+        """Start or skip a pending task whose requirements are finished"""
+        task = self._tasks[name]
+        if task['state'] != 'pending':
+            return
+        states = [self._tasks[r]['state'] for r in task['requires']]
+        if any(state in ('failed', 'skipped') for state in states):
+            self._finish(name, None, 'skipped')
+        elif task['function'] is not None and \
+                all(state == 'done' for state in states):
+            task['state'] = 'running'
+            self._pool.submit(self._run, name)
+
+    def _finish(self, name, error, state=None):
+        self._tasks[name]['state'] = state or ('failed' if error else 'done')
+        if error:
+            self.errors[name] = error
+            logger.error("{} failed : {}".format(name, error))
+        for dependent in self._dependents.get(name, []):
+            self._update(dependent)
+        self._condition.notify_all()
+
+    def _run(self, name):
+        start = time.perf_counter()
+        try:
+            self._tasks[name]['function']()
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        with self._condition:
+            self.durations[name] = time.perf_counter() - start
+            self._finish(name, error)
@@ -11,6 +11,10 @@ import os
 import argparse
 import traceback
 import json
+import time
+import shutil
+import functools
+from contextlib import contextmanager
 from datetime import datetime
 
 from drp_1dpipe import VERSION
@@ -20,9 +24,13 @@ from drp_1dpipe.core.utils import ( init_environ, get_args_from_file,
                                     normpath, get_auxiliary_path, get_conf_path,
                                     TemporaryFilesSet, config_update, config_save )
 from drp_1dpipe.core.engine.runner import get_runner, list_runners
-from drp_1dpipe.core.engine import local, pbs, slurm
+from drp_1dpipe.core.engine import local, localpool, pbs, slurm
 from drp_1dpipe.core.notifier import init_notifier
 from drp_1dpipe.scheduler.config import config_defaults
+from drp_1dpipe.process_spectra.spectra_queue import SpectraQueue
+from drp_1dpipe.process_spectra.journal import load_journals
+from drp_1dpipe.merge_results.merge_results import merge_bunch_products
+from drp_1dpipe.scheduler.dag import TaskGraph
 
 
 # logger = logging.getLogger("scheduler")
@@ -48,6 +56,16 @@ def define_specific_program_options():
                         help='Virtual environment path to load before running batch job')
     parser.add_argument('--concurrency', '-j', type=int,
                         help='Concurrency level for local parallel run. -1 means maximum.')
+    parser.add_argument('--cores_per_node', metavar='N', type=int,
+                        help='Number of cores of each batch array element, '
+                        'running as many bunches at once.')
+    parser.add_argument('--walltime', metavar='HH:MM:SS',
+                        help='Walltime budget of batch array elements. '
+                        'Bunches are grouped into elements ending within it '
+                        'from their predicted cost, when known.')
+    parser.add_argument('--array_throttle', metavar='N', type=int,
+                        help='Maximum number of batch array elements running '
+                        'at once. 0 means no limit.')
     parser.add_argument('--spectra_dir', metavar='DIR', action=AbspathAction,
                         help='Base path where to find spectra. '
                         'Relative to workdir.')
@@ -72,6 +90,67 @@ def define_specific_program_options():
                         '"on" provide stellar results'
                         '"off" do not provide stellar results'
                         '"only" provide only stellar results')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='Number of worker processes used inside each '
+                        'process_spectra bunch.')
+    parser.add_argument('--template_cache_dir', metavar='DIR',
+                        action=AbspathAction,
+                        help='Directory where process_spectra bunches cache '
+                        'continuum-removed template catalogs, shared by the '
+                        'bunches of the run and by later runs.')
+    parser.add_argument('--packing', choices=['count', 'cost'],
+                        help='Whether pre_process cuts bunches in directory '
+                        'order or packs spectra in bunches of equal '
+                        'predicted cost.')
+    parser.add_argument('--cost_history', metavar='DIRS',
+                        help='Comma separated output directories of former '
+                        'runs, whose spectrum timings refine predicted '
+                        'costs.')
+    parser.add_argument('--spectra_queue', choices=['on', 'off'],
+                        help='Whether process_spectra bunches pull spectra '
+                        'from a queue shared by the run until it is empty, '
+                        'instead of processing a fixed list each.')
+    parser.add_argument('--queue_batch', metavar='N', type=int,
+                        help='Number of spectra pulled at once from the '
+                        'spectra queue.')
+    parser.add_argument('--product_format', choices=['files', 'container'],
+                        help='Whether process_spectra writes one product file '
+                        'per object or a single product container per bunch.')
+    parser.add_argument('--product_encoding', choices=['full', 'compact'],
+                        help='Whether process_spectra writes products in the '
+                        'full or compact encoding.')
+    parser.add_argument('--zpdf_threshold', type=float, metavar='P',
+                        help='Relative probability under which the zPDF of '
+                        'compact products is truncated.')
+    parser.add_argument('--zpdf_cube', choices=['on', 'off'],
+                        help='Whether process_spectra stacks the zPDF of '
+                        'galaxies in a zPDF cube, merged by merge_results.')
+    parser.add_argument('--summary_format',
+                        choices=['csv', 'parquet', 'feather'],
+                        help='Format of the merged redshift, stellar and qso '
+                        'summaries.')
+    parser.add_argument('--merge_workers', metavar='N', type=int,
+                        help='Number of merge_results threads relocating '
+                        'bunches.')
+    parser.add_argument('--relocation',
+                        choices=['move', 'hardlink', 'manifest'],
+                        help='How merge_results relocates products.')
+    parser.add_argument('--catalog', choices=['on', 'off'],
+                        help='Whether merge_results builds an indexed catalog '
+                        'of products.')
+    parser.add_argument('--streaming_merge', choices=['on', 'off'],
+                        help='Whether the products of each bunch are merged '
+                        'and its aux data removed as soon as the bunch is '
+                        'processed, merge_results only stitching summaries '
+                        'at the end.')
+    parser.add_argument('--process_method',
+                        help='Process method of process_spectra. Whether '
+                        'AMAZED or SYNTHETIC.')
+    parser.add_argument('--synthetic_cost', metavar='DIST',
+                        help='Per-spectrum cost distribution of the SYNTHETIC '
+                        'process method.')
+    parser.add_argument('--synthetic_seed', metavar='SEED', type=int,
+                        help='Random seed of the SYNTHETIC process method.')
 
     return parser
 
@@ -119,6 +198,54 @@ def map_process_spectra_entries(json_bunch_list, output_dir, logdir):
     return bunch_list, output_list, logdir_list
 
 
+def create_spectra_queue(json_bunch_list, path):
+    """Create a queue of the spectra of all bunches
+
+    Parameters
+    ----------
+    json_bunch_list : str
+        Path to JSON file of bunch list
+    path : str
+        Path of the queue file
+
+    Return
+    ------
+    :obj:`SpectraQueue`
+        The queue, holding the spectra of all bunches in bunch order
+    """
+    with open(json_bunch_list, 'r') as f:
+        bunch_list = json.load(f)
+    spectra = []
+    for bunch_file in bunch_list:
+        with open(bunch_file, 'r') as f:
+            spectra.extend(json.load(f))
+    return SpectraQueue.create(path, spectra)
+
+
+def requeue_bunch(queue, output_dir):
+    """Requeue the spectra pulled by a failed bunch and left unprocessed
+
+    Spectra whose product is journaled in the bunch output directory stay
+    leased to the bunch.
+
+    Parameters
+    ----------
+    queue : :obj:`SpectraQueue`
+        Spectra queue of the run
+    output_dir : str
+        Output directory of the bunch
+
+    Return
+    ------
+    list
+        Requeued spectra
+    """
+    completed = load_journals(output_dir)
+    return queue.requeue(os.path.basename(os.path.normpath(output_dir)),
+                         keep=[spectrum for spectrum, pass_ in completed
+                               if pass_ == 'product'])
+
+
 def reduce_process_spectra_output(json_bunch_list, output_dir, json_reduce):
     """Prepare arguments for merge result command
 
@@ -141,6 +268,74 @@ def reduce_process_spectra_output(json_bunch_list, output_dir, json_reduce):
         json.dump(bunch_dir_list, f)
 
 
+def write_stage_timings(timings, path):
+    """Save pipeline stage wall times
+
+    Scheduler overhead is the part of the total wall time that is not spent
+    in any stage.
+
+    Parameters
+    ----------
+    timings : dict
+        Wall time of each stage, in seconds, with the total wall time as
+        `total`
+    path : str
+        Output JSON file
+
+    Return
+    ------
+    dict
+        Saved wall times, with the scheduler overhead as `scheduler`
+    """
+    timings = dict(timings)
+    timings['scheduler'] = timings['total'] - sum(
+        v for k, v in timings.items() if k != 'total')
+    with open(path, 'w') as f:
+        json.dump(timings, f, indent=4)
+    return timings
+
+
+def bunch_aux_data(bunch_file, bunch_dir):
+    """List the aux data directories of a bunch
+
+    Parameters
+    ----------
+    bunch_file : str
+        Path to JSON file of the bunch spectra list
+    bunch_dir : str
+        Path to bunch output directory
+    """
+    with open(bunch_file, 'r') as f:
+        file_list = json.load(f)
+    return [os.path.join(bunch_dir, os.path.splitext(filename)[0])
+            for filename in file_list]
+
+
+def load_bunch_costs(output_dir, nbunches):
+    """Predicted duration of each bunch saved by pre_process
+
+    Parameters
+    ----------
+    output_dir : str
+        Path to output directory, holding bunch_costs.json
+    nbunches : int
+        Number of bunches
+
+    Return
+    ------
+    list
+        Predicted duration of each bunch in seconds, None if unknown
+    """
+    path = os.path.join(output_dir, 'bunch_costs.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        report = json.load(f)
+    if report['unit'] != 'seconds' or len(report['bunches']) != nbunches:
+        return None
+    return [b['cost'] for b in report['bunches']]
+
+
 def list_aux_data(json_bunch_list, output_dir):
     """List all aux data directories
 
@@ -154,14 +349,101 @@ def list_aux_data(json_bunch_list, output_dir):
 
     aux_data_list = []
     for i, arg_value in enumerate(bunch_list):
-        with open(arg_value, 'r') as f:
-            file_list = json.load(f)
-        for filename in file_list:
-            aux_data_list.append(os.path.join(output_dir, 'B{}'.format(str(i)), os.path.splitext(filename)[0]))
+        aux_data_list.extend(bunch_aux_data(
+            arg_value, os.path.join(output_dir, 'B{}'.format(str(i)))))
     
     return aux_data_list
 
 
+def remove_aux_data(bunch_file, bunch_dir):
+    """Remove the aux data directories of a bunch"""
+    for aux_dir in bunch_aux_data(bunch_file, bunch_dir):
+        if os.path.exists(aux_dir):
+            shutil.rmtree(aux_dir)
+
+
+def bunch_task_graph(bunch_list, output_list, output_dir, relocation='move',
+                     workers=1, keep_aux_data=False):
+    """Build the task graph merging each bunch as soon as it is processed
+
+    Each bunch `Bi` gets a `process_spectra-Bi` external task, to complete
+    when the runner reports the bunch done, a `merge-Bi` task relocating its
+    products to the run output directory (see `merge_bunch_products`) and a
+    `cleanup-Bi` task removing its aux data directories.
+
+    Parameters
+    ----------
+    bunch_list : list
+        Paths to JSON files of bunch spectra lists
+    output_list : list
+        Paths to bunch output directories
+    output_dir : str
+        Path to output directory
+    relocation : str, optional
+        Relocation mode of products, by default 'move'
+    workers : int, optional
+        Number of threads merging bunches, by default 1
+    keep_aux_data : bool, optional
+        Whether to keep aux data directories, by default False
+
+    Return
+    ------
+    :obj:`TaskGraph`
+        Task graph of the bunches
+    """
+    graph = TaskGraph(workers=workers)
+    for bunch_file, bunch_dir in zip(bunch_list, output_list):
+        name = os.path.basename(bunch_dir)
+        graph.add('process_spectra-' + name)
+        graph.add('merge-' + name,
+                  functools.partial(merge_bunch_products, bunch_dir,
+                                    output_dir, relocation=relocation),
+                  requires=['process_spectra-' + name])
+        if not keep_aux_data:
+            graph.add('cleanup-' + name,
+                      functools.partial(remove_aux_data, bunch_file,
+                                        bunch_dir),
+                      requires=['merge-' + name])
+    return graph
+
+
+def failed_bunches(graph, states, output_list):
+    """Errors of the bunches of a task graph that were not merged
+
+    Parameters
+    ----------
+    graph : :obj:`TaskGraph`
+        Task graph built by `bunch_task_graph`, finished
+    states : dict
+        State of each task, returned by `TaskGraph.wait`
+    output_list : list
+        Paths to bunch output directories
+
+    Return
+    ------
+    dict
+        Error of each bunch not merged, by output directory
+    """
+    failures = {}
+    for output in output_list:
+        name = os.path.basename(output)
+        if states['merge-' + name] != 'done':
+            failures[output] = graph.errors.get(
+                'process_spectra-' + name,
+                graph.errors.get('merge-' + name, 'not merged'))
+    return failures
+
+
+@contextmanager
+def _timed(timings, stage):
+    """Record the wall time of the enclosed block in `timings[stage]`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
 def main_method(config):
     """Run the 1D Data Reduction Pipeline.
 
@@ -195,20 +477,26 @@ def main_method(config):
     notifier.update('root', 'RUNNING')
     notifier.update('pre_process', 'RUNNING')
 
+    # wall time of each pipeline stage
+    timings = {}
+    start = time.perf_counter()
     with TemporaryFilesSet(keep_tempfiles=config.log_level <= logging.DEBUG) as tmpcontext:
 
         runner = runner_class(config, tmpcontext)
 
         # prepare workdir
         try:
-            runner.single('pre_process',
-                        args={'workdir': normpath(config.workdir),
-                                'logdir': normpath(config.logdir),
-                                'bunch_size': config.bunch_size,
-                                'spectra_dir': normpath(config.spectra_dir),
-                                'bunch_list': json_bunch_list,
-                                'output_dir': normpath(config.output_dir)
-                                })
+            with _timed(timings, 'pre_process'):
+                runner.single('pre_process',
+                            args={'workdir': normpath(config.workdir),
+                                    'logdir': normpath(config.logdir),
+                                    'bunch_size': config.bunch_size,
+                                    'spectra_dir': normpath(config.spectra_dir),
+                                    'bunch_list': json_bunch_list,
+                                    'output_dir': normpath(config.output_dir),
+                                    'packing': config.packing,
+                                    'cost_history': config.cost_history
+                                    })
         except Exception as e:
             traceback.print_exc()
             notifier.update('pre_process', 'ERROR')
@@ -220,39 +508,130 @@ def main_method(config):
         # process spectra
         bunch_list, output_list, logdir_list = map_process_spectra_entries(
             json_bunch_list, config.output_dir, config.logdir)
+        queue = None
+        # process_spectra options given only when used
+        extra_args = {}
+        if config.template_cache_dir:
+            extra_args['template_cache_dir'] = normpath(
+                config.template_cache_dir)
+        costs = load_bunch_costs(config.output_dir, len(bunch_list))
+        if config.spectra_queue == 'on':
+            # bunches share the work, their costs are unknown
+            costs = None
+            # bunches become workers pulling spectra from a shared queue
+            queue = create_spectra_queue(
+                json_bunch_list, normpath(config.output_dir,
+                                          'spectra_queue.json'))
+            extra_args.update(spectra_queue=queue.path,
+                              queue_batch=config.queue_batch)
+        graph = None
+        if config.streaming_merge == 'on':
+            graph = bunch_task_graph(bunch_list, output_list,
+                                     normpath(config.output_dir),
+                                     relocation=config.relocation,
+                                     workers=config.merge_workers,
+                                     keep_aux_data=tmpcontext.keep_tempfiles)
+
+        def on_done(i, returncode):
+            if queue is not None and returncode != 0:
+                # bunches still running pull the unfinished spectra
+                requeued = requeue_bunch(queue, output_list[i])
+                if requeued:
+                    logger.warning("{} spectra of failed bunch {} "
+                                   "requeued".format(len(requeued),
+                                                     output_list[i]))
+            if graph is not None:
+                graph.complete(
+                    'process_spectra-' + os.path.basename(output_list[i]),
+                    None if returncode == 0 else 'exit code {}'.format(
+                        returncode))
         try:
             # runner.parallel('process_spectra', bunch_list,
             #                 'spectra-listfile', ['output-dir','logdir'],
-            runner.parallel('process_spectra',
-                            parallel_args={
-                                'spectra_listfile': bunch_list,
-                                'output_dir': output_list,
-                                'logdir': logdir_list
-                            },
-                            args={
-                                'workdir': normpath(config.workdir),
-                                'lineflux': config.lineflux,
-                                'spectra_dir': normpath(config.spectra_dir),
-                                'parameters_file': config.parameters_file,
-                                'linemeas_parameters_file': config.linemeas_parameters_file,
-                                'stellar': config.stellar
-                            })
+            with _timed(timings, 'process_spectra'):
+                runner.parallel('process_spectra',
+                                parallel_args={
+                                    'spectra_listfile': bunch_list,
+                                    'output_dir': output_list,
+                                    'logdir': logdir_list
+                                },
+                                args={
+                                    'workdir': normpath(config.workdir),
+                                    'lineflux': config.lineflux,
+                                    'spectra_dir': normpath(config.spectra_dir),
+                                    'parameters_file': config.parameters_file,
+                                    'linemeas_parameters_file': config.linemeas_parameters_file,
+                                    'stellar': config.stellar,
+                                    'workers': config.workers,
+                                    'product_format': config.product_format,
+                                    'zpdf_cube': config.zpdf_cube,
+                                    'product_encoding': config.product_encoding,
+                                    'zpdf_threshold': config.zpdf_threshold,
+                                    'process_method': config.process_method,
+                                    'synthetic_cost': config.synthetic_cost,
+                                    'synthetic_seed': config.synthetic_seed,
+                                    **extra_args
+                                },
+                                on_done=on_done,
+                                costs=costs)
         except Exception as e:
             traceback.print_exc()
             notifier.update('root', 'ERROR')
         else:
             notifier.update('root', 'SUCCESS')
-        
+        if queue is not None:
+            if queue.remaining():
+                # the queue is kept for the failed bunches to be resumed
+                logger.error("{} spectra left in {} by failed bunches, resume "
+                             "them with process_spectra --continue".format(
+                                 queue.remaining(), queue.path))
+            else:
+                tmpcontext.add_files(*queue.files())
+
         json_reduce = normpath(config.output_dir, 'reduce.json')
-        reduce_process_spectra_output(json_bunch_list, config.output_dir, json_reduce)
+        failures = {}
+        if graph is None:
+            reduce_process_spectra_output(json_bunch_list, config.output_dir,
+                                          json_reduce)
+        else:
+            # bunches whose end was never reported
+            for output in output_list:
+                graph.complete('process_spectra-' + os.path.basename(output),
+                               'no exit code reported')
+            with _timed(timings, 'merge_bunches'):
+                states = graph.wait()
+            graph.close()
+            failures = failed_bunches(graph, states, output_list)
+            merged = [output for output in output_list
+                      if output not in failures]
+            if failures:
+                # the run fails once the other bunches are merged
+                logger.error("{} of {} bunches not merged : {}".format(
+                    len(failures), len(output_list), ', '.join(
+                        '{} ({})'.format(os.path.basename(output),
+                                         error.strip().splitlines()[-1])
+                        for output, error in failures.items())))
+                with open(normpath(config.output_dir, 'failed_bunches.json'),
+                          'w') as f:
+                    json.dump(failures, f, indent=2)
+                notifier.update('root', 'ERROR')
+            # only summaries are left to merge
+            with open(json_reduce, 'w') as f:
+                json.dump(merged, f)
         try:
-            runner.single('merge_results',
-                            args={
-                                'workdir': normpath(config.workdir),
-                                'logdir': normpath(config.logdir),
-                                'output_dir': normpath(config.output_dir),
-                                'bunch_listfile': json_reduce
-                        })
+            with _timed(timings, 'merge_results'):
+                runner.single('merge_results',
+                                args={
+                                    'workdir': normpath(config.workdir),
+                                    'logdir': normpath(config.logdir),
+                                    'output_dir': normpath(config.output_dir),
+                                    'bunch_listfile': json_reduce,
+                                    'summary_format': config.summary_format,
+                                    'workers': config.merge_workers,
+                                    'relocation': config.relocation,
+                                    'catalog': config.catalog,
+                                    'stitch': config.streaming_merge
+                            })
         except Exception as e:
             traceback.print_exc()
             notifier.update('merge_results', 'ERROR')
@@ -260,12 +639,20 @@ def main_method(config):
         else:
             notifier.update('merge_results', 'SUCCESS')
 
-        aux_data_list = list_aux_data(json_bunch_list, config.output_dir)
-        for aux_dir in aux_data_list:
-            tmpcontext.add_dirs(aux_dir)
+        if graph is None:
+            aux_data_list = list_aux_data(json_bunch_list, config.output_dir)
+            for aux_dir in aux_data_list:
+                tmpcontext.add_dirs(aux_dir)
+
+        # temporary files are removed when leaving the context
+        cleanup_start = time.perf_counter()
 
+    timings['cleanup'] = time.perf_counter() - cleanup_start
+    timings['total'] = time.perf_counter() - start
+    write_stage_timings(timings, normpath(config.output_dir,
+                                          'scheduler_timing.json'))
 
-    return 0
+    return 1 if failures else 0
 
 
 def main():
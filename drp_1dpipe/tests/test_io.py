@@ -1,12 +1,28 @@
 import pytest
+import os
 from tempfile import NamedTemporaryFile
 from tempfile import TemporaryDirectory
 import numpy as np
 
-from drp_1dpipe.io.reader import read_spectrum
-from drp_1dpipe.io.writer import write_candidates
+from drp_1dpipe.io.reader import read_spectrum, read_spectrum_arrays, _masked_float32
+from drp_1dpipe.io.writer import write_candidates, candidates_filename
+from drp_1dpipe.io.container import (ProductContainer, container_path,
+                                     index_path, load_indexes, move_containers,
+                                     write_index, read_index, read_product,
+                                     export_products)
+from drp_1dpipe.io.catalog import build_catalog, ProductCatalog, parse_product_name
+from drp_1dpipe.io.encoding import CompactEncoding, expand_product, truncate_zpdf
+from drp_1dpipe.io.zpdf_cube import (ZpdfCubeWriter, ZpdfCube, cube_prefix,
+                                     list_cubes, remove_cubes)
+from drp_1dpipe.process_spectra.results import RedshiftCandidate, LineMeasurement, StarCandidate
+from astropy.io import fits
 #from .utils import generate_fake_fits, NROW
 
+from pfs.datamodel.drp import PfsObject
+from pfs.datamodel.masks import MaskHelper
+from pfs.datamodel.target import Target
+from pfs.datamodel.observations import Observations
+
 
 def test_reader():
     """
@@ -23,7 +39,282 @@ def test_reader():
     # filename.close()
 
 
+def test_read_spectrum_arrays():
+    fd = TemporaryDirectory()
+    npix = 5
+    target = Target(catId=0, tract=1, patch='2,2', objId=3, ra=0.0, dec=0.0)
+    observations = Observations(np.array([0]), np.array(['n']), np.array([0]),
+                                np.array([0]), np.array([0]),
+                                np.array([(0.0, 0.0)]), np.array([(0.0, 0.0)]))
+    obj = PfsObject(target=target,
+                    observations=observations,
+                    wavelength=np.linspace(400., 800., npix),
+                    flux=np.arange(npix, dtype=float),
+                    mask=np.array([0, 1, 0, 0, 2]),
+                    sky=np.zeros(npix),
+                    covar=np.array([np.full(npix, 4.), np.ones(npix), np.ones(npix)]),
+                    covar2=np.zeros((2, 2)),
+                    flags=MaskHelper())
+    obj.write(dirName=fd.name)
+    path = os.path.join(fd.name, obj.filenameFormat % obj.getIdentity())
+
+    wavelength, flux, mask, variance = read_spectrum_arrays(path)
+    ref = PfsObject.readFits(path)
+    assert np.array_equal(wavelength, ref.wavelength)
+    assert np.array_equal(mask, ref.mask)
+    assert np.array_equal(flux, ref.flux)
+    assert np.array_equal(variance, ref.covar[0])
+
+    valid = mask == 0
+    wl = _masked_float32(valid, 3, wavelength, np.multiply, 10.0)
+    assert wl.dtype == np.float32 and wl.flags['C_CONTIGUOUS']
+    assert np.allclose(wl, [4000., 6000., 7000.])
+    assert np.array_equal(_masked_float32(valid, 3, flux), [0., 2., 3.])
+    assert np.array_equal(_masked_float32(valid, 3, variance, np.sqrt), [2., 2., 2.])
+
+
 def test_writer():
     fd = TemporaryDirectory()
     fname = write_candidates(fd.name, 0, 1, '1,1', 2, 3, 4, [], [], [], [], np.array([]), [], '')
-    assert fname == 'pfsZcandidates-000-00001-1,1-0000000000000002-003-0x0000000000000004.fits'
\ No newline at end of file
+    assert fname == 'pfsZcandidates-000-00001-1,1-0000000000000002-003-0x0000000000000004.fits'
+
+
+def test_candidates_filename():
+    fname = candidates_filename(0, 1, '1,1', 2, 1003, 4)
+    assert fname == 'pfsZcandidates-000-00001-1,1-0000000000000002-003-0x0000000000000004.fits'
+
+
+def test_write_candidates():
+    fd = TemporaryDirectory()
+    lambda_ranges = np.linspace(400., 800., 5)
+    mask = np.array([0, 1, 0, 0, 1])
+    candidates = [RedshiftCandidate(i, 'EXT{}'.format(i), 0.5 + i, 0.6 - 0.2 * i,
+                                    i, 1e-4, -1., -1., -1., -1.)
+                  for i in range(2)]
+    models = np.array([[1., 2., 3.], [4., 5., 6.]])
+    zpdf = np.array([[0., -1.], [1., -2.]])
+    linemeas = [LineMeasurement('E', 'S', 'Halpha', 0, 6562.8, 8000., 1., 0.1,
+                                0.1, None, 100., 0., 2., 3., 0.3, 3., 1., 0.1)]
+    fname = write_candidates(fd.name, 0, 1, '1,1', 2, 3, 4, lambda_ranges,
+                             mask, candidates, models, zpdf, linemeas, 'GALAXY')
+    with fits.open(os.path.join(fd.name, fname)) as hdul:
+        assert hdul[0].header['objId'] == 2
+        assert hdul[0].header['patch'] == '1,1'
+        zcandidates = hdul['ZCANDIDATES'].data
+        assert np.array_equal(zcandidates['Z'], [0.5, 1.5])
+        assert np.array_equal(zcandidates['ZRANK'], [0, 1])
+        assert np.array_equal(zcandidates['MODELFLUX'],
+                              [[1., np.nan, 2., 3., np.nan],
+                               [4., np.nan, 5., 6., np.nan]], equal_nan=True)
+        assert np.array_equal(hdul['ZPDF'].data['PDF'], [-1., -2.])
+        zlines = hdul['ZLINES'].data
+        assert zlines['LINENAME'][0] == 'Halpha'
+        assert zlines['LINEFLUX'][0] == 3.
+        assert np.isnan(zlines['LINEEW'][0])
+
+    stars = [StarCandidate(0., 0.9, -1., 'star.dat')]
+    fname = write_candidates(fd.name, 0, 1, '1,1', 3, 3, 4, None, None, stars,
+                             None, None, None, 'STAR')
+    with fits.open(os.path.join(fd.name, fname)) as hdul:
+        zcandidates = hdul['ZCANDIDATES'].data
+        assert zcandidates['SUBCLASS'][0] == 'star.dat'
+        assert zcandidates['RELIABILITY'][0] == 0.9
+
+
+def test_product_container():
+    fd = TemporaryDirectory()
+    bunch = os.path.join(fd.name, 'B0')
+    os.makedirs(bunch)
+    path = container_path(bunch, 'W0')
+    stars = [StarCandidate(0., 0.9, -1., 'star.dat')]
+    container = ProductContainer(path)
+    for objId in range(2):
+        write_candidates(bunch, 0, 1, '1,1', objId, 3, 4, None, None, stars,
+                         None, None, None, 'STAR', container=container)
+    container.close()
+    assert not [f for f in os.listdir(bunch) if f.startswith('pfsZcandidates')]
+
+    # a killed job leaves bytes after the last indexed product
+    with open(path, 'ab') as f:
+        f.write(b'garbage')
+    with open(index_path(path), 'a') as f:
+        f.write('{"truncated')
+    container = ProductContainer(path)
+    write_candidates(bunch, 0, 1, '1,1', 2, 3, 4, None, None, stars,
+                     None, None, None, 'STAR', container=container)
+    container.close()
+
+    entries = load_indexes(bunch)
+    assert [e['objId'] for e in entries] == [0, 1, 2]
+    with fits.open(path) as hdul:
+        assert len(hdul) == 1 + sum(e['nhdu'] for e in entries)
+        assert hdul[entries[2]['hdu']].header['objId'] == 2
+
+    product = read_product(bunch, entries[1])
+    assert product[0].header['objId'] == 1
+    assert product['ZCANDIDATES'].data['SUBCLASS'][0] == 'star.dat'
+
+    data_dir = os.path.join(fd.name, 'data')
+    os.makedirs(data_dir)
+    entries = move_containers(bunch, data_dir)
+    assert os.path.exists(os.path.join(data_dir, 'B0-products-W0.fits'))
+    index = os.path.join(fd.name, 'products-index.fits')
+    write_index(entries, index)
+    entries = read_index(index)
+    assert entries[2]['filename'] == candidates_filename(0, 1, '1,1', 2, 3, 4)
+    assert entries[2]['container'] == 'B0-products-W0.fits'
+
+    export_dir = os.path.join(fd.name, 'export')
+    assert export_products(data_dir, entries, export_dir, objIds=[2]) == \
+        [entries[2]['filename']]
+    with fits.open(os.path.join(export_dir, entries[2]['filename'])) as hdul:
+        assert hdul[0].header['objId'] == 2
+        assert hdul['ZCANDIDATES'].data['RELIABILITY'][0] == 0.9
+
+
+def test_product_catalog():
+    fd = TemporaryDirectory()
+    output_dir = fd.name
+    data_dir = os.path.join(output_dir, 'data')
+    os.makedirs(data_dir)
+    stars = [StarCandidate(0., 0.9, -1., 'star.dat')]
+    locations = []
+    for objId in range(3):
+        name = write_candidates(data_dir, 0, 1, '1,1', objId, 3, 4, None, None,
+                                stars, None, None, None, 'STAR')
+        locations.append((name, os.path.join(data_dir, name)))
+    container = ProductContainer(os.path.join(data_dir, 'B0-products.fits'))
+    write_candidates(data_dir, 1, 2, '2,2', 10, 3, 4, None, None, stars, None,
+                     None, None, 'STAR', container=container)
+    container.close()
+    entries = [dict(e, container='B0-products.fits') for e in container.entries]
+    spectra = ['pfsObject-000-00001-1,1-0000000000000002-003-0x0000000000000004.fits',
+               'bad name',
+               'pfsObject-001-00002-2,2-000000000000000a-003-0x0000000000000004.fits']
+    path = os.path.join(output_dir, 'products.sqlite')
+    assert build_catalog(path, output_dir, locations, entries, spectra) == 4
+
+    assert parse_product_name(locations[1][0]) == (0, 1, '1,1', 1, 3, 4)
+    with ProductCatalog(path) as catalog:
+        assert len(catalog) == 4
+        assert len(catalog.find(tract=1, patch='1,1')) == 3
+        assert catalog.find(objId=5) == []
+        record = catalog.get(2)
+        assert record['path'] == os.path.join('data', locations[2][0])
+        assert record['summary_row'] == 0
+        with catalog.open(record) as hdul:
+            assert hdul[0].header['objId'] == 2
+        record = catalog.get(10, catId=1)
+        assert record['container'] == os.path.join('data', 'B0-products.fits')
+        assert record['summary_row'] == 2
+        assert catalog.open(record)[0].header['objId'] == 10
+        assert catalog.get(1)['summary_row'] is None
+        with pytest.raises(ValueError):
+            catalog.find(ra=0.)
+
+
+def test_zpdf_cube():
+    fd = TemporaryDirectory()
+    bunch_dir = os.path.join(fd.name, 'B0')
+    os.makedirs(bunch_dir)
+    redshift = np.linspace(0., 6., 61)
+    prefix = cube_prefix(bunch_dir, '1')
+    with ZpdfCubeWriter(prefix) as cube:
+        for objId in range(3):
+            cube.add((0, 1, '1,1', objId, 3, 4), redshift, -redshift * objId)
+    # a row partly written by a killed job is discarded on reopen
+    with open(prefix + '.f32', 'ab') as f:
+        f.write(b'\0' * 10)
+    with ZpdfCubeWriter(prefix) as cube:
+        assert cube.count == 3
+        cube.add((0, 1, '1,1', 3, 3, 4), redshift[::2], -redshift[::2] * 3)
+    assert list_cubes(bunch_dir) == [prefix]
+
+    cube = ZpdfCube(prefix)
+    assert cube.pdf.shape == (4, 61)
+    assert np.array_equal(cube.redshift, redshift)
+    assert cube.index['patch'][0] == b'1,1'
+    assert list(cube.rows(2)) == [2]
+    assert np.allclose(cube.pdf[3], -redshift * 3, atol=1e-5)
+
+    # merge a cube on the same grid and one on another grid
+    other = cube_prefix(bunch_dir, '2')
+    with ZpdfCubeWriter(other) as writer:
+        writer.add((0, 1, '1,1', 9, 3, 4), redshift[:31], -redshift[:31])
+    run_prefix = cube_prefix(fd.name)
+    with ZpdfCubeWriter(run_prefix) as writer:
+        writer.append_cube(prefix)
+        writer.append_cube(other)
+    merged = ZpdfCube(run_prefix)
+    assert len(merged) == 5
+    assert np.array_equal(merged.pdf[:4], cube.pdf)
+    assert merged.index['objId'].tolist() == [0, 1, 2, 3, 9]
+    assert merged.pdf[4][10] == pytest.approx(-1.)
+    remove_cubes(bunch_dir)
+    assert list_cubes(bunch_dir) == []
+    with pytest.raises(FileNotFoundError):
+        ZpdfCube(prefix)
+
+
+def test_compact_encoding():
+    fd = TemporaryDirectory()
+    full_dir = os.path.join(fd.name, 'full')
+    compact_dir = os.path.join(fd.name, 'compact')
+    grid_dir = os.path.join(fd.name, 'grids')
+    os.makedirs(full_dir)
+    os.makedirs(compact_dir)
+    lambda_ranges = np.linspace(400., 800., 2000)
+    mask = np.zeros(2000)
+    mask[::7] = 1
+    candidates = [RedshiftCandidate(i, 'EXT{}'.format(i), 0.5 + i, 0.6, i,
+                                    1e-4, -1., -1., -1., -1.)
+                  for i in range(2)]
+    models = np.random.default_rng(0).normal(1., 0.1, (2, int((mask == 0).sum())))
+    redshift = np.linspace(0., 6., 6001)
+    zpdf = np.column_stack((redshift, -0.5 * ((redshift - 1.2) / 0.05) ** 2))
+
+    assert truncate_zpdf(redshift, np.zeros(6001), 1e-8) == (0, 6001, 0.)
+    # no peak : the full grid is kept
+    assert truncate_zpdf(redshift, np.full(6001, np.nan), 1e-8) == \
+        (0, 6001, 0.)
+    assert truncate_zpdf(redshift, np.full(6001, -np.inf), 1e-8) == \
+        (0, 6001, 0.)
+    logpdf = np.full(6001, np.nan)
+    logpdf[3000:3010] = 0.
+    start, stop, loss = truncate_zpdf(redshift, logpdf, 1e-8)
+    assert (start, stop) == (3000, 3010)
+    assert loss == pytest.approx(0.)
+    encoding = CompactEncoding(grid_dir, threshold=1e-8)
+    names = []
+    for objId in range(2):
+        write_candidates(full_dir, 0, 1, '1,1', objId, 3, 4, lambda_ranges,
+                         mask, candidates, models, zpdf, None, 'GALAXY')
+        names.append(write_candidates(compact_dir, 0, 1, '1,1', objId, 3, 4,
+                                      lambda_ranges, mask, candidates, models,
+                                      zpdf, None, 'GALAXY', encoding=encoding))
+    # grids are saved once
+    assert len(os.listdir(grid_dir)) == 2
+    assert os.path.getsize(os.path.join(compact_dir, names[0])) < \
+        os.path.getsize(os.path.join(full_dir, names[0])) / 2
+
+    with fits.open(os.path.join(full_dir, names[0])) as full, \
+            fits.open(os.path.join(compact_dir, names[0])) as compact:
+        assert len(compact['MODELWL'].data) == 0
+        assert len(compact['ZPDF'].data) < 6001
+        loss = compact['ZPDF'].header['ZPDFLOSS']
+        assert 0. < loss < 1e-6
+        assert compact['ZCANDIDATES'].header['FLUXERR'] < 1e-7
+        expanded = expand_product(compact, grid_dir)
+        assert [hdu.name for hdu in expanded] == [hdu.name for hdu in full]
+        assert np.array_equal(expanded['MODELWL'].data['WAVELENGTH'],
+                              full['MODELWL'].data['WAVELENGTH'])
+        assert np.allclose(expanded['ZCANDIDATES'].data['MODELFLUX'],
+                           full['ZCANDIDATES'].data['MODELFLUX'],
+                           rtol=1e-7, equal_nan=True)
+        pdf = expanded['ZPDF'].data['PDF']
+        kept = np.isfinite(pdf)
+        assert np.array_equal(expanded['ZPDF'].data['REDSHIFT'], redshift)
+        assert np.allclose(pdf[kept], full['ZPDF'].data['PDF'][kept])
+        assert full['ZPDF'].data['PDF'][~kept].max() < np.log(1e-8)
+    assert encoding.stats['ZPDFLOSS'] == pytest.approx(loss)
+    assert 'Compact encoding of 2 products' in encoding.report()
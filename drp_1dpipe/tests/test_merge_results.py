@@ -9,8 +9,12 @@ import glob
 from drp_1dpipe.core.utils import normpath, config_update
 from drp_1dpipe.core.config import Config
 
-from drp_1dpipe.merge_results.merge_results import concat_summury_files, main_method
+from drp_1dpipe.merge_results.merge_results import concat_summury_files, main_method, write_timing_report, merge_bunch_products
+from drp_1dpipe.process_spectra.timing import SpectrumTiming, TimingRecorder, timing_path
 from drp_1dpipe.merge_results.config import config_defaults
+from drp_1dpipe.merge_results.relocate import Relocator, bunch_products
+from drp_1dpipe.process_spectra.results import RedshiftSummary, StellarSummary, redshift_header
+from drp_1dpipe.io.zpdf_cube import ZpdfCube, ZpdfCubeWriter, cube_prefix
 
 
 def test_config_update_none():
@@ -33,6 +37,7 @@ def test_main_method():
     wd = tempfile.TemporaryDirectory()
     config = Config(config_defaults)
     config.workdir = wd.name
+    config.logdir = wd.name
     config.output_dir = wd.name
     
     with pytest.raises(FileNotFoundError):
@@ -67,3 +72,181 @@ def test_main_method():
     assert len(dl) == 2
     assert "0.file" in dl
     assert "1.file" in dl
+
+
+@pytest.mark.parametrize('summary_format', ['csv', 'parquet'])
+def test_merge_summaries(summary_format):
+    if summary_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    wd = tempfile.TemporaryDirectory()
+    config = Config(config_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.output_dir = os.path.join(wd.name, 'output')
+    config.summary_format = summary_format
+    config.workers = 3
+    os.makedirs(config.output_dir)
+    bunch_list = []
+    for b in range(7):
+        bd = os.path.join(wd.name, 'B{}'.format(b))
+        os.makedirs(os.path.join(bd, 'data'))
+        bunch_list.append(bd)
+        with open(os.path.join(bd, 'redshift.csv'), 'w') as ff:
+            ff.write("\t".join(redshift_header) + "\n")
+            for i in range(3):
+                ff.write("spc{0}{1}\tspc{0}{1}\t{1}.5\t0.9\tt.dat\tm\t0.1\t"
+                         "C1\t-1\t-1\t-1\t-1\tG\n".format(b, i))
+        with ZpdfCubeWriter(cube_prefix(bd)) as cube:
+            for i in range(3):
+                cube.add((0, 1, '1,1', 10 * b + i, 1, 0), [0., 1., 2.],
+                         [-1., -b, -i])
+    with open(os.path.join(bunch_list[0], 'stellar.csv'), 'w') as ff:
+        ff.write("\t".join(redshift_header) + "\n")
+    config.bunch_listfile = os.path.join(wd.name, 'reduce.json')
+    with open(config.bunch_listfile, 'w') as ff:
+        json.dump(bunch_list, ff)
+    assert main_method(config) == 0
+
+    summary = RedshiftSummary(output_dir=config.output_dir,
+                              format=summary_format)
+    summary.read()
+    assert list(summary.table['spectrum']) == ['spc{}{}'.format(b, i)
+                                               for b in range(7)
+                                               for i in range(3)]
+    assert list(summary.table['redshift']) == [0.5, 1.5, 2.5] * 7
+    stellar = StellarSummary(output_dir=config.output_dir,
+                             format=summary_format)
+    stellar.read()
+    assert len(stellar.summary) == 0
+    cube = ZpdfCube(cube_prefix(config.output_dir))
+    assert cube.index['objId'].tolist() == [10 * b + i for b in range(7)
+                                            for i in range(3)]
+    assert cube.pdf[-1].tolist() == [-1., -6., -2.]
+
+
+def test_write_timing_report():
+    od = tempfile.TemporaryDirectory()
+    bunch_list = []
+    for b in range(2):
+        bd = os.path.join(od.name, "B{}".format(b))
+        os.makedirs(bd)
+        recorder = TimingRecorder(timing_path(bd))
+        for i in range(5):
+            timing = SpectrumTiming("spc{}{}.fits".format(b, i))
+            timing.stages = {'read_spectrum': 0.1, 'process': float(b * 5 + i)}
+            recorder.record(timing)
+        recorder.close()
+        bunch_list.append(bd)
+
+    assert write_timing_report(bunch_list[:0], od.name) is None
+    report = write_timing_report(bunch_list, od.name, slowest=2)
+    assert os.path.exists(os.path.join(od.name, 'timing_report.json'))
+    assert report['spectra'] == 10
+    assert list(report['stages'].keys()) == ['read_spectrum', 'process', 'total']
+    assert report['stages']['process']['max'] == 9.0
+    assert report['stages']['process']['p50'] == 4.5
+    assert [r['spectrum'] for r in report['slowest']] == ['spc14.fits', 'spc13.fits']
+    assert report['slowest'][0]['bunch'] == 'B1'
+
+
+def _make_bunch(root, name, products):
+    bunch = os.path.join(root, name)
+    os.makedirs(os.path.join(bunch, 'data'))
+    for product in products:
+        with open(os.path.join(bunch, 'data', product), 'w') as ff:
+            ff.write(product)
+    with open(os.path.join(bunch, 'output.json'), 'w') as ff:
+        json.dump(products, ff)
+    return bunch
+
+
+@pytest.mark.parametrize('mode', ['move', 'hardlink', 'manifest', 'copy'])
+def test_relocator(mode):
+    wd = tempfile.TemporaryDirectory()
+    data_dir = os.path.join(wd.name, 'data')
+    os.makedirs(data_dir)
+    bunch = _make_bunch(wd.name, 'B0', ['p0.fits', 'p1.fits'])
+    # not listed in output.json, left in place
+    with open(os.path.join(bunch, 'data', 'other'), 'w') as ff:
+        ff.write('other')
+    assert bunch_products(bunch) == ['p0.fits', 'p1.fits']
+
+    with Relocator(data_dir, mode='move' if mode == 'copy' else mode,
+                   workers=2) as relocator:
+        if mode == 'copy':
+            # as if the data directory were on another filesystem
+            relocator._device = -1
+        locations = relocator.relocate_bunch(bunch)
+        # a second relocation finds products already moved
+        if mode == 'move':
+            assert relocator.relocate_bunch(bunch) == locations
+
+    sources = [os.path.join(bunch, 'data', p) for p in ['p0.fits', 'p1.fits']]
+    targets = [os.path.join(data_dir, p) for p in ['p0.fits', 'p1.fits']]
+    if mode == 'manifest':
+        assert locations == list(zip(['p0.fits', 'p1.fits'], sources))
+        assert os.listdir(data_dir) == []
+        return
+    assert locations == list(zip(['p0.fits', 'p1.fits'], targets))
+    assert sorted(os.listdir(data_dir)) == ['p0.fits', 'p1.fits']
+    with open(targets[1]) as ff:
+        assert ff.read() == 'p1.fits'
+    assert all(os.path.exists(s) for s in sources) == (mode == 'hardlink')
+    if mode == 'hardlink':
+        assert os.stat(targets[0]).st_ino == os.stat(sources[0]).st_ino
+    assert os.path.exists(os.path.join(bunch, 'data', 'other'))
+
+
+def test_main_method_manifest():
+    wd = tempfile.TemporaryDirectory()
+    config = Config(config_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.output_dir = os.path.join(wd.name, 'output')
+    config.relocation = 'manifest'
+    os.makedirs(config.output_dir)
+    bunch = _make_bunch(config.output_dir, 'B0', ['p0.fits'])
+    with open(os.path.join(bunch, 'redshift.csv'), 'w') as ff:
+        ff.write("#com\n")
+    config.bunch_listfile = os.path.join(wd.name, 'reduce.json')
+    with open(config.bunch_listfile, 'w') as ff:
+        json.dump([bunch], ff)
+    assert main_method(config) == 0
+    with open(os.path.join(config.output_dir, 'data-manifest.json')) as ff:
+        assert json.load(ff) == {'p0.fits': os.path.join('B0', 'data', 'p0.fits')}
+
+
+def test_main_method_stitch():
+    wd = tempfile.TemporaryDirectory()
+    config = Config(config_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.output_dir = os.path.join(wd.name, 'output')
+    config.stitch = 'on'
+    bunches = []
+    for b in range(2):
+        bunch = _make_bunch(config.output_dir, 'B{}'.format(b),
+                            ['p{}.fits'.format(b)])
+        with open(os.path.join(bunch, 'redshift.csv'), 'w') as ff:
+            ff.write("\t".join(redshift_header) + "\n")
+            ff.write("spc{0}\tspc{0}\t0.5\t0.9\tt.dat\tm\t0.1\t"
+                     "C1\t-1\t-1\t-1\t-1\tG\n".format(b))
+        bunches.append(bunch)
+    config.bunch_listfile = os.path.join(wd.name, 'reduce.json')
+    with open(config.bunch_listfile, 'w') as ff:
+        json.dump(bunches, ff)
+    # stitching a bunch not merged yet
+    with pytest.raises(FileNotFoundError):
+        main_method(config)
+
+    for b in reversed(range(2)):
+        name = 'p{}.fits'.format(b)
+        entries, locations = merge_bunch_products(bunches[b], config.output_dir)
+        assert entries == []
+        assert locations == [(name, os.path.join(config.output_dir, 'data', name))]
+    assert sorted(os.listdir(os.path.join(config.output_dir, 'data'))) == ['p0.fits', 'p1.fits']
+    assert main_method(config) == 0
+    summary = RedshiftSummary(output_dir=config.output_dir)
+    summary.read()
+    # stitched in bunch list order
+    assert list(summary.table['spectrum']) == ['spc0', 'spc1']
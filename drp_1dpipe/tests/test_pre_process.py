@@ -8,7 +8,10 @@ import types
 from drp_1dpipe.core.utils import normpath, config_update
 from drp_1dpipe.core.config import Config
 
-from drp_1dpipe.pre_process.pre_process import bunch, main_method
+from drp_1dpipe.pre_process.pre_process import bunch, cost_bunch, main_method
+from drp_1dpipe.pre_process.packing import pack, imbalance, load_runtimes
+from drp_1dpipe.process_spectra.timing import SpectrumTiming, TimingRecorder, timing_path
+from drp_1dpipe.process_spectra.synthetic import generate_spectra
 from drp_1dpipe.pre_process.config import config_defaults
 
 
@@ -85,3 +88,61 @@ def test_main_method():
     assert len(total[1]) == 1
 
 
+
+
+def test_pack():
+    bunches, loads = pack(list('abcdefg'), [7, 6, 5, 4, 3, 2, 1], 3,
+                          capacity=3)
+    assert bunches == [['a', 'f', 'g'], ['b', 'e'], ['c', 'd']]
+    assert loads == [10., 9., 9.]
+    assert imbalance(loads) == pytest.approx(10. / (28. / 3))
+    assert [len(b) for b in pack(list('abcd'), [9, 1, 1, 1], 2,
+                                 capacity=2)[0]] == [2, 2]
+
+
+def test_cost_bunch():
+    wd = tempfile.TemporaryDirectory()
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 2, npix=100)
+    # unreadable spectra are estimated from their size
+    for i, size in enumerate((100, 2000, 50000, 70000)):
+        with open(os.path.join(spectra_dir, 'raw{}.fits'.format(i)), 'wb') as ff:
+            ff.write(b'\0' * size)
+    bunches, report = cost_bunch(3, spectra_dir)
+    assert report['unit'] == 'pixels'
+    assert sorted(len(b) for b in bunches) == [3, 3]
+    assert report['imbalance'] >= 1.
+    assert {'raw2.fits', 'raw3.fits'} & set(bunches[0]) == {'raw3.fits'}
+
+    # recorded runtimes of a former run
+    bunch_dir = os.path.join(wd.name, 'run', 'B0')
+    os.makedirs(bunch_dir)
+    recorder = TimingRecorder(timing_path(bunch_dir))
+    for name, total in ((names[0], 100.), ('raw3.fits', 1.)):
+        timing = SpectrumTiming(name)
+        timing.stages = {'process': total}
+        recorder.record(timing)
+    recorder.close()
+    runtimes = load_runtimes([os.path.join(wd.name, 'run')])
+    assert runtimes[names[0]] == pytest.approx(100., rel=1e-3)
+    bunches, report = cost_bunch(3, spectra_dir, runtimes=runtimes)
+    assert report['unit'] == 'seconds'
+    assert bunches[0][0] == names[0]
+
+    config = Config(config_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.output_dir = wd.name
+    config.bunch_list = os.path.join(wd.name, 'spectralist.json')
+    config.bunch_size = 3
+    config.packing = 'cost'
+    config.cost_history = os.path.join(wd.name, 'run')
+    assert main_method(config) == 0
+    with open(os.path.join(wd.name, 'bunch_costs.json')) as ff:
+        assert json.load(ff) == report
+
+    # count packing in the same output directory
+    config.packing = 'count'
+    assert main_method(config) == 0
+    assert not os.path.exists(os.path.join(wd.name, 'bunch_costs.json'))
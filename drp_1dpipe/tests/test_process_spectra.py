@@ -9,8 +9,21 @@ import numpy as np
 from drp_1dpipe.core.utils import normpath, config_update
 from drp_1dpipe.core.config import Config
 
-from drp_1dpipe.process_spectra.process_spectra import main_method
+from drp_1dpipe.process_spectra.process_spectra import main_method, _split_list, _concat_summaries
+from drp_1dpipe.process_spectra import template_cache
+from drp_1dpipe.process_spectra.process_spectra import SyntheticSpectraProcessor
+from drp_1dpipe.process_spectra.template_cache import template_cache_key, TemplateCatalogCache
+from drp_1dpipe.process_spectra.synthetic import SyntheticCost, generate_spectra
+from drp_1dpipe.process_spectra.results import RedshiftSummary
+from drp_1dpipe.process_spectra.timing import load_timings
+from drp_1dpipe.io.container import load_indexes
+from drp_1dpipe.io.zpdf_cube import ZpdfCube, list_cubes
+from drp_1dpipe.process_spectra.spectra_queue import SpectraQueue, QueuedSpectra
+from drp_1dpipe.process_spectra.journal import (CompletionJournal, journal_path,
+                                                load_journals, remove_journals,
+                                                file_checksum)
 from drp_1dpipe.pre_process.config import config_defaults
+from drp_1dpipe.process_spectra.config import config_defaults as process_spectra_defaults
 
 
 def test_config_update_none():
@@ -165,4 +178,367 @@ def test_main_method():
 #     assert ar.linemeas['0000'][0].flux_err == 11.0
 #     assert ar.linemeas['0000'][0].flux_di == 12.0
 #     assert ar.linemeas['0000'][0].center_cont_flux == 13.0
-#     assert ar.linemeas['0000'][0].cont_err == 14.0
\ No newline at end of file
+#     assert ar.linemeas['0000'][0].cont_err == 14.0
+
+def test_split_list():
+    slices = _split_list(list(range(10)), 3)
+    assert slices == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert _split_list([0, 1], 4) == [[0], [1]]
+    assert _split_list([], 4) == []
+
+
+def test_concat_summaries():
+    od = tempfile.TemporaryDirectory()
+    worker_dirs = []
+    for k in range(2):
+        wd = os.path.join(od.name, 'W{}'.format(k))
+        os.makedirs(wd)
+        with open(os.path.join(wd, 'redshift.csv'), 'w') as ff:
+            ff.write("#header\nspc{}\t1.0\n".format(k))
+        worker_dirs.append(wd)
+    _concat_summaries(worker_dirs, od.name)
+    with open(os.path.join(od.name, 'redshift.csv'), 'r') as ff:
+        lines = ff.readlines()
+    assert lines == ["#header\n", "spc0\t1.0\n", "spc1\t1.0\n"]
+    assert not os.path.exists(os.path.join(od.name, 'stellar.csv'))
+    assert not os.path.exists(worker_dirs[0])
+
+
+def test_template_cache_key():
+    td = tempfile.TemporaryDirectory()
+    os.makedirs(os.path.join(td.name, 'galaxy'))
+    with open(os.path.join(td.name, 'galaxy', 'tpl.dat'), 'w') as ff:
+        ff.write("1.0 2.0\n")
+    params = ('zero', 75.0, 8.0, '')
+    key = template_cache_key(td.name, params, version='v1')
+    assert key == template_cache_key(td.name, params, version='v1')
+    assert key != template_cache_key(td.name, params, version='v2')
+    assert key != template_cache_key(td.name, ('zero', 80.0, 8.0, ''),
+                                     version='v1')
+    # same size and modification time, other content
+    path = os.path.join(td.name, 'galaxy', 'tpl.dat')
+    stat = os.stat(path)
+    with open(path, 'w') as ff:
+        ff.write("1.0 3.0\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert key != template_cache_key(td.name, params, version='v1')
+
+
+class _FakeCatalog:
+    """Template catalog counting loads with continuum removal"""
+    loads = 0
+
+    def __init__(self, *params):
+        self.path = None
+
+    def Load(self, path):
+        _FakeCatalog.loads += 1
+        self.path = path
+
+    def LoadProcessed(self, path):
+        self.path = path
+
+    def Save(self, path):
+        os.makedirs(path)
+
+
+def test_template_cache(monkeypatch):
+    td = tempfile.TemporaryDirectory()
+    template_dir = os.path.join(td.name, 'templates')
+    os.makedirs(template_dir)
+    with open(os.path.join(template_dir, 'tpl.dat'), 'w') as ff:
+        ff.write("1.0 2.0\n")
+    cache_dir = os.path.join(td.name, 'cache')
+    params = ('zero', 75.0, 8.0, '')
+    monkeypatch.setattr(template_cache, 'CTemplateCatalog', _FakeCatalog)
+    monkeypatch.setattr(_FakeCatalog, 'loads', 0)
+    monkeypatch.setattr(template_cache, '_loaded_catalogs', {})
+    TemplateCatalogCache(cache_dir).load(template_dir, params)
+    assert _FakeCatalog.loads == 1
+    # as in another process: the hit skips continuum removal
+    monkeypatch.setattr(template_cache, '_loaded_catalogs', {})
+    catalog = TemplateCatalogCache(cache_dir).load(template_dir, params)
+    assert _FakeCatalog.loads == 1
+    assert catalog.path.startswith(cache_dir)
+
+    # the binding can't save processed catalogs
+    monkeypatch.delattr(_FakeCatalog, 'LoadProcessed')
+    with pytest.raises(NotImplementedError):
+        TemplateCatalogCache(cache_dir)
+    TemplateCatalogCache().load(template_dir, params)
+
+
+def test_completion_journal():
+    od = tempfile.TemporaryDirectory()
+    product = os.path.join(od.name, 'product.fits')
+    with open(product, 'wb') as ff:
+        ff.write(b'data')
+    with CompletionJournal(journal_path(od.name)) as journal:
+        journal.record('spc0.fits', 'redshift', '0-spc0')
+        journal.record('spc0.fits', 'product', 'product.fits',
+                       file_checksum(product))
+    with CompletionJournal(journal_path(od.name, 'W1')) as journal:
+        journal.record('spc1.fits', 'linemeas', '0-spc1')
+    # truncated line left by a killed job
+    with open(journal_path(od.name, 'W1'), 'a') as ff:
+        ff.write('{"spectrum": "spc1.fits", "pa')
+
+    completed = load_journals(od.name)
+    assert set(completed.keys()) == {('spc0.fits', 'redshift'),
+                                     ('spc0.fits', 'product'),
+                                     ('spc1.fits', 'linemeas')}
+    assert completed[('spc0.fits', 'product')]['checksum'] == '{:08x}'.format(
+        0xadf3f363)
+    journal = CompletionJournal(journal_path(od.name), completed)
+    assert journal.is_done('spc0.fits', 'product')
+    assert not journal.is_done('spc1.fits', 'product')
+    assert journal.get('spc0.fits', 'product')['file'] == 'product.fits'
+    journal.close()
+
+    remove_journals(od.name)
+    assert load_journals(od.name) == {}
+
+
+def test_continue_corrupted_product():
+    wd = tempfile.TemporaryDirectory()
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 3, npix=100)
+    with open(os.path.join(wd.name, 'spectra.json'), 'w') as ff:
+        json.dump(names, ff)
+    config = Config(process_spectra_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.spectra_listfile = 'spectra.json'
+    config.output_dir = os.path.join(wd.name, 'B0')
+    config.process_method = 'synthetic'
+    config.synthetic_cost = 'constant:0'
+    assert main_method(config) == 0
+    with open(os.path.join(config.output_dir, 'output.json'), 'r') as ff:
+        products = json.load(ff)
+    # product truncated by a crash
+    corrupted = os.path.join(config.output_dir, 'data', products[1])
+    with open(corrupted, 'r+b') as ff:
+        ff.truncate(100)
+
+    config.continue_ = True
+    assert main_method(config) == 0
+    completed = load_journals(config.output_dir)
+    entry = completed[(names[1], 'product')]
+    assert file_checksum(corrupted) == entry['checksum']
+    assert os.path.getsize(corrupted) > 100
+    # the redshift pass run again replaced its summary row
+    with open(os.path.join(config.output_dir, 'redshift.csv')) as ff:
+        rows = [l.split()[0] for l in ff if not l.startswith('#')]
+    assert rows == names
+
+
+def test_continue_parallel_linemeas(monkeypatch):
+    wd = tempfile.TemporaryDirectory()
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 4, npix=100)
+    with open(os.path.join(wd.name, 'spectra.json'), 'w') as ff:
+        json.dump(names, ff)
+    config = Config(process_spectra_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.spectra_listfile = 'spectra.json'
+    config.output_dir = os.path.join(wd.name, 'B0')
+    config.process_method = 'synthetic'
+    config.synthetic_cost = 'constant:0'
+    config.workers = 2
+    config.lineflux = 'off'
+    assert main_method(config) == 0
+    data_dir = os.path.join(config.output_dir, 'data')
+    for product in os.listdir(data_dir):
+        os.remove(os.path.join(data_dir, product))
+    # rows left in its directory by a worker of a killed job with 3 workers
+    summary = os.path.join(config.output_dir, 'redshift.csv')
+    with open(summary) as ff:
+        lines = ff.readlines()
+    with open(summary, 'w') as ff:
+        ff.writelines(lines[:3])
+    os.makedirs(os.path.join(config.output_dir, 'W2'))
+    with open(os.path.join(config.output_dir, 'W2', 'redshift.csv'), 'w') as ff:
+        ff.writelines(lines[:1] + lines[3:])
+
+    run_pass = SyntheticSpectraProcessor._run_pass
+
+    def checked_run_pass(self, pass_, i, spectrum_handle, timing):
+        if pass_ == 'linemeas':
+            # the redshift of the spectrum is read by the linemeas pass
+            with open(self.linemeas_catalog) as ff:
+                rows = [l.split()[0] for l in ff if not l.startswith('#')]
+            assert spectrum_handle.name in rows
+        return run_pass(self, pass_, i, spectrum_handle, timing)
+
+    monkeypatch.setattr(SyntheticSpectraProcessor, '_run_pass',
+                        checked_run_pass)
+    config.continue_ = True
+    config.lineflux = 'on'
+    assert main_method(config) == 0
+    assert len(os.listdir(data_dir)) == 4
+    with open(os.path.join(config.output_dir, 'redshift.csv')) as ff:
+        rows = [l.split()[0] for l in ff if not l.startswith('#')]
+    assert rows == names
+
+
+def test_synthetic_cost():
+    cost = SyntheticCost('constant:0.5')
+    assert cost.sample('spc0') == 0.5
+    cost = SyntheticCost('uniform:1,2', seed=3)
+    assert cost.sample('spc0') == cost.sample('spc0')
+    assert 1. <= cost.sample('spc1') <= 2.
+    assert SyntheticCost('normal:-10,0.1').sample('spc0') == 0.
+    assert SyntheticCost('lognormal:1,0.5').sample('spc0') > 0.
+    with pytest.raises(ValueError):
+        SyntheticCost('gamma:1,2')
+    with pytest.raises(ValueError):
+        SyntheticCost('uniform:1')
+
+
+def test_synthetic():
+    wd = tempfile.TemporaryDirectory()
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 5, unique=2, npix=100)
+    assert len(set(names)) == 5
+    assert os.path.islink(os.path.join(spectra_dir, names[4]))
+    with open(os.path.join(wd.name, 'spectra.json'), 'w') as ff:
+        json.dump(names, ff)
+
+    config = Config(process_spectra_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.spectra_listfile = 'spectra.json'
+    config.output_dir = os.path.join(wd.name, 'B0')
+    config.process_method = 'synthetic'
+    config.synthetic_cost = 'constant:0'
+    config.workers = 2
+    assert main_method(config) == 0
+
+    with open(os.path.join(config.output_dir, 'output.json'), 'r') as ff:
+        products = json.load(ff)
+    assert len(products) == 5
+    assert sorted(os.listdir(os.path.join(config.output_dir, 'data'))) == sorted(products)
+    summary = RedshiftSummary(output_dir=config.output_dir)
+    summary.read()
+    assert [r.spectrum for r in summary.summary] == names
+    timings = load_timings(config.output_dir)
+    assert len(timings) == 5
+    assert all('load_results' in t['stages'] for t in timings)
+
+    config.output_dir = os.path.join(wd.name, 'B1')
+    config.product_format = 'container'
+    config.zpdf_cube = 'on'
+    config.product_encoding = 'compact'
+    assert main_method(config) == 0
+    assert len(os.listdir(os.path.join(config.output_dir, 'grids'))) == 2
+    assert os.listdir(os.path.join(config.output_dir, 'data')) == []
+    entries = load_indexes(config.output_dir)
+    assert sorted(e['filename'] for e in entries) == sorted(products)
+    assert len(set(e['container'] for e in entries)) == 2
+    cubes = [ZpdfCube(prefix) for prefix in list_cubes(config.output_dir)]
+    assert len(cubes) == 2
+    assert sorted(objId for cube in cubes for objId in cube.index['objId']) \
+        == sorted(e['objId'] for e in entries)
+
+
+def test_spectra_queue():
+    wd = tempfile.TemporaryDirectory()
+    path = os.path.join(wd.name, 'queue.json')
+    queue = SpectraQueue.create(path, ['spc{}'.format(i) for i in range(5)])
+    assert queue.pull(2) == ['spc0', 'spc1']
+    other = SpectraQueue(path)
+    assert other.remaining() == 3
+    spectra = QueuedSpectra(other, batch=2)
+    assert list(spectra) == ['spc2', 'spc3', 'spc4']
+    assert spectra.pulled == ['spc2', 'spc3', 'spc4']
+    assert queue.pull() == []
+
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 6, npix=100)
+    SpectraQueue.create(path, names)
+    config = Config(process_spectra_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.spectra_queue = 'queue.json'
+    config.process_method = 'synthetic'
+    config.synthetic_cost = 'constant:0'
+    pulled = []
+    for b, workers in enumerate((2, 1)):
+        config.spectra_listfile = 'B{}.json'.format(b)
+        config.output_dir = os.path.join(wd.name, 'B{}'.format(b))
+        config.workers = workers
+        assert main_method(config) == 0
+        with open(os.path.join(wd.name, config.spectra_listfile)) as ff:
+            pulled.append(json.load(ff))
+        summary = RedshiftSummary(output_dir=config.output_dir)
+        summary.read()
+        assert [r.spectrum for r in summary.summary] == pulled[-1]
+    # the first bunch emptied the queue
+    assert sorted(pulled[0]) == sorted(names)
+    assert pulled[1] == []
+
+
+def test_spectra_queue_leases():
+    wd = tempfile.TemporaryDirectory()
+    path = os.path.join(wd.name, 'queue.json')
+    queue = SpectraQueue.create(path, ['spc{}'.format(i) for i in range(5)])
+    assert queue.pull(2, owner='B0') == ['spc0', 'spc1']
+    assert queue.pull(owner='B0') == ['spc2']
+    assert queue.leased('B0') == ['spc0', 'spc1', 'spc2']
+    # a failed bunch keeps its processed spectra
+    assert queue.requeue('B0', keep=['spc0']) == ['spc1', 'spc2']
+    assert queue.leased('B0') == ['spc0']
+    assert queue.remaining() == 4
+    assert queue.pull(3, owner='B1') == ['spc1', 'spc2', 'spc3']
+    queue.ack('B1')
+    assert queue.leased('B1') == []
+    assert queue.requeue('B1') == []
+    assert queue.pull(2) == ['spc4']
+    assert queue.remaining() == 0
+    assert sorted(queue.files()) == sorted(
+        [path, queue.cursor_path, queue.lock_path, queue.requeued_path,
+         queue.lease_path('B0')])
+
+    # a bunch killed after processing 3 of its 4 pulled spectra
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 6, npix=100)
+    config = Config(process_spectra_defaults)
+    config.workdir = wd.name
+    config.logdir = wd.name
+    config.spectra_dir = spectra_dir
+    config.spectra_queue = 'queue.json'
+    config.spectra_listfile = 'B0.json'
+    config.output_dir = os.path.join(wd.name, 'B0')
+    config.process_method = 'synthetic'
+    config.synthetic_cost = 'constant:0'
+    SpectraQueue.create(path, names[:3])
+    assert main_method(config) == 0
+    queue = SpectraQueue.create(path, names)
+    queue.pull(4, owner='B0')
+    with open(os.path.join(wd.name, 'B0.json'), 'w') as ff:
+        json.dump(['pre-processed'], ff)
+
+    config.continue_ = True
+    assert main_method(config) == 0
+    with open(os.path.join(wd.name, 'B0.json')) as ff:
+        assert json.load(ff) == names
+    with open(os.path.join(config.output_dir, 'output.json')) as ff:
+        products = json.load(ff)
+    assert len(set(products)) == 6
+    summary = RedshiftSummary(output_dir=config.output_dir)
+    summary.read()
+    assert [r.spectrum for r in summary.summary] == names
+    assert queue.leased('B0') == []
+    assert queue.remaining() == 0
+
+    # continuing again keeps the spectra and products of the bunch
+    assert main_method(config) == 0
+    with open(os.path.join(wd.name, 'B0.json')) as ff:
+        assert json.load(ff) == names
+    with open(os.path.join(config.output_dir, 'output.json')) as ff:
+        assert json.load(ff) == products
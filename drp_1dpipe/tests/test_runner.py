@@ -3,10 +3,18 @@ import os
 import logging
 import logging.handlers
 import tempfile
+import json
+import time
 
 from drp_1dpipe.core.engine.runner import Runner, register_runner, get_runner, list_runners
 from drp_1dpipe.core.config import Config
 from drp_1dpipe.core.engine.local import Local
+from drp_1dpipe.core.engine import localpool
+from drp_1dpipe.core.engine.localpool import LocalPool
+from drp_1dpipe.core.engine.slurm import Slurm
+from drp_1dpipe.core.engine.batch import array_elements, parse_walltime, format_walltime
+from drp_1dpipe.core.watcher import JobError
+from drp_1dpipe.process_spectra.synthetic import generate_spectra
 
 class RunnerClass(Runner):
     def single(self, command, args):
@@ -47,3 +55,144 @@ def test_local():
     assert tasks[1][0] == "drp_1dpipe"
     assert tasks[1][1] == "--version=1"
     assert tasks[1][2] == "--arg=0"
+
+
+def test_localpool():
+    wd = tempfile.TemporaryDirectory()
+    spectra_dir = os.path.join(wd.name, 'spectra')
+    names = generate_spectra(spectra_dir, 4, npix=100)
+    for b in range(2):
+        with open(os.path.join(wd.name, 'B{}.json'.format(b)), 'w') as ff:
+            json.dump(names[2 * b:2 * b + 2], ff)
+    config = Config({"concurrency": 2, "venv": "", "workdir": wd.name,
+                     "logdir": wd.name})
+    runner = LocalPool(config)
+    bunches = ['B0', 'B1', 'B2']
+    done = []
+    with pytest.raises(RuntimeError):
+        runner.parallel('process_spectra',
+                        {'spectra_listfile': [b + '.json' for b in bunches],
+                         'output_dir': [os.path.join(wd.name, b)
+                                        for b in bunches],
+                         'logdir': [os.path.join(wd.name, 'log', b)
+                                    for b in bunches]},
+                        {'workdir': wd.name, 'spectra_dir': spectra_dir,
+                         'process_method': 'synthetic',
+                         'synthetic_cost': 'constant:0'},
+                        on_done=lambda i, code: done.append((i, code)))
+    assert sorted(done) == [(0, 0), (1, 0), (2, 1)]
+    # the missing spectra list of B2 does not stop B0 and B1
+    assert len(runner.failures) == 1
+    assert runner.failures[0][0][1] == '--spectra_listfile=B2.json'
+    assert 'FileNotFoundError' in runner.failures[0][1]
+    for b in range(2):
+        with open(os.path.join(wd.name, 'B{}'.format(b), 'output.json')) as ff:
+            assert len(json.load(ff)) == 2
+
+
+def _crashing_task(command, task):
+    if task == ['--name=crash']:
+        os._exit(1)
+    time.sleep(0.5)
+    return 0, None
+
+
+def test_localpool_crash(monkeypatch):
+    monkeypatch.setattr(localpool, 'run_task', _crashing_task)
+    config = Config({"concurrency": 2, "venv": "", "workdir": "/wd",
+                     "logdir": "/ld"})
+    runner = LocalPool(config)
+    done = []
+    with pytest.raises(RuntimeError):
+        runner.parallel('process_spectra',
+                        {'name': ['slow', 'crash', 'slow']},
+                        on_done=lambda i, code: done.append((i, code)))
+    # tasks running next to the crashing one are not failed
+    assert sorted(done) == [(0, 0), (1, None), (2, 0)]
+    assert len(runner.failures) == 1
+    assert runner.failures[0] == (['process_spectra', '--name=crash'],
+                                  'worker crashed')
+
+
+def _fake_command(bindir, name, script):
+    path = os.path.join(bindir, name)
+    with open(path, 'w') as ff:
+        ff.write('#!/bin/bash\n' + script)
+    os.chmod(path, 0o755)
+
+
+def test_slurm(monkeypatch):
+    wd = tempfile.TemporaryDirectory()
+    bindir = os.path.join(wd.name, 'bin')
+    os.mkdir(bindir)
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    config = Config({"concurrency": 1, "venv": wd.name, "workdir": wd.name,
+                     "logdir": wd.name})
+    runner = Slurm(config)
+    runner.state_interval = 0.1
+    runner.grace = 0.2
+
+    # the job runs the script at once, the command exit code is reported
+    _fake_command(bindir, 'sbatch', 'bash "$1"\necho "Submitted batch job 42"\n')
+    _fake_command(bindir, 'squeue', 'echo RUNNING\n')
+    with pytest.raises(JobError) as e:
+        runner.single('drp_1dpipe_no_such_command', {})
+    assert list(e.value.failures.values()) == [127]
+
+    # the job is gone without writing its .done file
+    _fake_command(bindir, 'sbatch', 'echo "Submitted batch job 43"\n')
+    _fake_command(bindir, 'squeue', 'exit 0\n')
+    with pytest.raises(JobError) as e:
+        runner.single('process_spectra', {})
+    assert list(e.value.failures.values()) == [None]
+
+    # submission errors are raised
+    _fake_command(bindir, 'sbatch', 'echo "invalid partition" >&2\nexit 1\n')
+    with pytest.raises(RuntimeError, match='invalid partition'):
+        runner.single('process_spectra', {})
+
+
+def test_array_elements():
+    assert array_elements(5, 2) == ([[0, 1], [2, 3], [4]], [None] * 3)
+    # longest first, on the least loaded slot of the first element with room
+    elements, durations = array_elements(5, 2, costs=[1, 5, 2, 4, 3],
+                                         budget=7)
+    assert elements == [[1, 3, 4, 2], [0]]
+    assert durations == [7, 1]
+    # a task over budget gets its own slot
+    assert array_elements(3, 1, costs=[10, 1, 1], budget=5) == \
+        ([[0], [1, 2]], [10, 2])
+    assert parse_walltime('01:30:00') == 5400
+    assert parse_walltime('90') == 90
+    assert format_walltime(5401) == '01:31:00'
+
+
+def test_slurm_array(monkeypatch):
+    wd = tempfile.TemporaryDirectory()
+    bindir = os.path.join(wd.name, 'bin')
+    os.mkdir(bindir)
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    config = Config({"concurrency": 1, "venv": wd.name, "workdir": wd.name,
+                     "logdir": wd.name, "cores_per_node": 2,
+                     "walltime": "00:20:00", "array_throttle": 3})
+    runner = Slurm(config)
+    runner.state_interval = 0.1
+    runner.grace = 0.2
+    # runs each array element of the script in turn
+    _fake_command(bindir, 'sbatch', """cp "$1" "$(dirname "$1")/script.sh"
+n=$(sed -n 's/^#SBATCH --array=1-\\([0-9]*\\).*/\\1/p' "$1")
+for i in $(seq 1 $n); do SLURM_ARRAY_TASK_ID=$i bash "$1"; done
+echo "Submitted batch job 44"
+""")
+    _fake_command(bindir, 'squeue', 'echo RUNNING\n')
+    done = []
+    runner.parallel('true', {'x': list(range(5))}, {},
+                    on_done=lambda i, code: done.append((i, code)),
+                    costs=[600, 600, 600, 60, 60])
+    assert sorted(done) == [(i, 0) for i in range(5)]
+    with open(os.path.join(wd.name, 'script.sh')) as ff:
+        script = ff.read()
+    assert '#SBATCH --array=1-2%3' in script
+    assert '#SBATCH --cpus-per-task=2' in script
+    # the longest element, predicted 660s, with margin and startup
+    assert '#SBATCH --time=00:19:00' in script
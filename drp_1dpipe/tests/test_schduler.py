@@ -5,8 +5,9 @@ import json
 
 from drp_1dpipe.core.config import Config
 from drp_1dpipe.core.utils import config_update
-from drp_1dpipe.scheduler.scheduler import map_process_spectra_entries, reduce_process_spectra_output, auto_dir, main_method, list_aux_data
+from drp_1dpipe.scheduler.scheduler import map_process_spectra_entries, reduce_process_spectra_output, auto_dir, main_method, list_aux_data, create_spectra_queue, failed_bunches
 from drp_1dpipe.scheduler.config import config_defaults
+from drp_1dpipe.scheduler.dag import TaskGraph
 
 
 def test_config_update_none():
@@ -48,6 +49,21 @@ def test_reduce_process_spectra_output():
     assert pl[1] == "output/B1"
 
 
+def test_create_spectra_queue():
+    wd = tempfile.TemporaryDirectory()
+    bunch_files = []
+    for b in range(2):
+        bunch_files.append(os.path.join(wd.name, 'list{}.json'.format(b)))
+        with open(bunch_files[-1], 'w') as ff:
+            json.dump(['spc{}{}'.format(b, i) for i in range(2)], ff)
+    jbl = os.path.join(wd.name, 'bunchlist.json')
+    with open(jbl, 'w') as ff:
+        json.dump(bunch_files, ff)
+    queue = create_spectra_queue(jbl, os.path.join(wd.name, 'queue.json'))
+    assert queue.remaining() == 4
+    assert queue.pull(3) == ['spc00', 'spc01', 'spc10']
+
+
 def test_list_aux_data():
     bd = tempfile.TemporaryDirectory()
     bl = [os.path.join(bd.name, "list0.json"), os.path.join(bd.name, "list1.json")]
@@ -97,3 +113,44 @@ def test_main_method():
         main_method(config)
     logpath = os.path.join(ld.name, "scheduler.log")
     assert os.path.exists(logpath)
+
+
+def test_task_graph():
+    done = []
+    with TaskGraph(workers=2) as graph:
+        for b in ('B0', 'B1'):
+            graph.add('process-' + b)
+            graph.add('merge-' + b, lambda b=b: done.append(b),
+                      requires=['process-' + b])
+        graph.add('fail', lambda: 1 / 0, requires=['merge-B0'])
+        graph.add('after-fail', done.clear, requires=['fail'])
+        with pytest.raises(ValueError):
+            graph.add('other', requires=['unknown'])
+        # B1 is merged as soon as it is processed
+        graph.complete('process-B1')
+        graph.complete('process-B0', 'exit code 1')
+        states = graph.wait()
+    assert done == ['B1']
+    assert states == {'process-B0': 'failed', 'merge-B0': 'skipped',
+                      'process-B1': 'done', 'merge-B1': 'done',
+                      'fail': 'skipped', 'after-fail': 'skipped'}
+    assert list(graph.errors) == ['process-B0']
+
+
+def test_failed_bunches():
+    output_list = ['/out/B0', '/out/B1', '/out/B2']
+    with TaskGraph() as graph:
+        for output, merge in zip(output_list,
+                                 (lambda: None, lambda: 1 / 0, lambda: None)):
+            name = os.path.basename(output)
+            graph.add('process_spectra-' + name)
+            graph.add('merge-' + name, merge,
+                      requires=['process_spectra-' + name])
+        graph.complete('process_spectra-B0')
+        graph.complete('process_spectra-B1')
+        graph.complete('process_spectra-B2', 'exit code 1')
+        states = graph.wait()
+    failures = failed_bunches(graph, states, output_list)
+    assert sorted(failures) == ['/out/B1', '/out/B2']
+    assert 'ZeroDivisionError' in failures['/out/B1']
+    assert failures['/out/B2'] == 'exit code 1'
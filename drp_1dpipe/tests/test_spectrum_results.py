@@ -2,9 +2,12 @@ import pytest
 import os
 import json
 import tempfile
+import types
 import numpy as np
 
 from drp_1dpipe.process_spectra.results import SpectrumResults, RedshiftSummary, StellarSummary, QsoSummary
+from drp_1dpipe.process_spectra.results import read_records, candidates_dtypes
+from drp_1dpipe.process_spectra.results import SummaryWriter, redshift_header
 
 from pfs.datamodel.drp import PfsObject
 from pfs.datamodel.masks import MaskHelper
@@ -87,6 +90,16 @@ def test_lambda_ranges():
     assert pytest.approx(sr.lambda_ranges[0], 1.e-12) == 1.0
     assert pytest.approx(sr.lambda_ranges[1], 1.e-12) == 2.0
 
+def test_lambda_ranges_handle():
+    sd = tempfile.TemporaryDirectory()
+    od = sd
+    handle = types.SimpleNamespace(wavelength=np.array([1.0, 2.0]),
+                                   mask=np.array([0, 1]))
+    sr = SpectrumResults(sd.name, od.name, spectrum_handle=handle)
+    sr._read_lambda_ranges()
+    assert sr.lambda_ranges is handle.wavelength
+    assert sr.mask is handle.mask
+
 def test_lines():
     sd = tempfile.TemporaryDirectory()
     od = sd
@@ -122,6 +135,49 @@ def test_lines():
     assert pytest.approx(sr.linemeas[0].center_cont_flux, 1.e-12) == 12.0
     assert pytest.approx(sr.linemeas[0].cont_err, 1.e-12) == 13.0
 
+def test_lines_malformed():
+    sd = tempfile.TemporaryDirectory()
+    rstr = ("#com\na b c 0 1.0 2.0 3.0 4.0 5.0 g1 6.0 7.0 8.0 9.0 10.0 11.0 12.0 13.0\n"
+            "a b bad\n"
+            "a b d 1 1.0 2.0 3.0 4.0 5.0 -1 6.0 7.0 8.0 9.0 10.0 11.0 12.0 13.0")
+    rname = os.path.join(sd.name, "linemodelsolve.linemodel_fit_extrema_0.csv")
+    with open(rname, "w") as ff:
+        ff.write(rstr)
+    sr = SpectrumResults(sd.name, sd.name, output_lines_dir=sd.name)
+    sr._read_lines()
+    assert list(sr.linemeas.name) == ["c", "d"]
+    assert list(sr.linemeas.fit_group) == ["g1", None]
+    assert list(sr.linemeas.elt_id) == [0, 1]
+
+def test_star():
+    sd = tempfile.TemporaryDirectory()
+    sr = SpectrumResults(sd.name, sd.name)
+    with pytest.raises(FileNotFoundError):
+        sr._read_star()
+    rstr = ("#Stellar results\nRedshift IntgProba EvidenceLog Template\n"
+            "0.0 0.9 -1.0 star1.dat\n0.0 0.1 -2.0 star2.dat\n")
+    rname = os.path.join(sd.name, "stellarsolve.stellarresult.csv")
+    with open(rname, "w") as ff:
+        ff.write(rstr)
+    sr._read_star()
+    assert len(sr.star_candidate) == 1
+    assert sr.star_candidate[0].template == "star1.dat"
+    assert pytest.approx(sr.star_candidate[0].intgProba, 1.e-12) == 0.9
+
+def test_read_records():
+    sd = tempfile.TemporaryDirectory()
+    rname = os.path.join(sd.name, "candidatesresult.csv")
+    with open(rname, "w") as ff:
+        ff.write("#rank\tIDs\n")
+    records = read_records(rname, candidates_dtypes)
+    assert len(records) == 0
+    assert records.dtype.names == tuple(candidates_dtypes)
+    with open(rname, "w") as ff:
+        ff.write("0\tID\t0.1\t2.0\t1\t3.0\t4.0\t5.0\t6.0\t7.0\textra\n")
+    records = read_records(rname, candidates_dtypes)
+    assert records.redshift[0] == float("0.1")
+    assert records.ids[0] == "ID"
+
 def test_classification():
     sd = tempfile.TemporaryDirectory()
     od = sd
@@ -179,6 +235,94 @@ def test_redshift():
     with open(os.path.join(nod.name, 'redshift.csv')) as ff:
         ll = ff.readlines()
 
+def test_summary_header():
+    od = tempfile.TemporaryDirectory()
+    rstr = ("#Spectrum\tProcessingID\tRedshift\tMerit\tExtra\tType\n"
+            "spc1\tspc1\t0.5\t0.9\t1.0\tS\n")
+    with open(os.path.join(od.name, "stellar.csv"), "w") as ff:
+        ff.write(rstr)
+    sr = StellarSummary(output_dir=od.name)
+    sr.read()
+    assert list(sr.table.columns) == ['spectrum', 'processingid', 'redshift',
+                                      'merit', 'Extra', 'type_']
+    assert sr.table['redshift'].dtype == np.float64
+    assert sr.table['Extra'][0] == '1.0'
+    assert sr.summary[0].type_ == 'S'
+    assert np.isnan(sr.summary[0].deltaz)
+    sr.write()
+    with open(os.path.join(od.name, "stellar.csv")) as ff:
+        assert ff.read() == rstr
+    with pytest.raises(ValueError):
+        QsoSummary(output_dir=od.name, format='xls')
+
+@pytest.mark.parametrize('summary_format', ['csv', 'feather'])
+def test_summary_writer(summary_format):
+    if summary_format != 'csv':
+        pytest.importorskip('pyarrow')
+    od = tempfile.TemporaryDirectory()
+    row = "spc{0}\tspc{0}\t0.{0}\t0.9\tt.dat\tm\t0.1\tC1\t-1\t-1\t-1\t-1\tG"
+    inputs = []
+    for i in range(3):
+        inputs.append(os.path.join(od.name, 'B{}'.format(i)))
+        os.makedirs(inputs[-1])
+    # schema header, without last newline
+    with open(os.path.join(inputs[0], 'redshift.csv'), 'w') as ff:
+        ff.write("\t".join(redshift_header) + "\n" + row.format(0))
+    # no header, converted
+    with open(os.path.join(inputs[1], 'redshift.csv'), 'w') as ff:
+        ff.write("#com\n" + row.format(1) + "\n")
+    # header only
+    with open(os.path.join(inputs[2], 'redshift.csv'), 'w') as ff:
+        ff.write("\t".join(redshift_header) + "\n")
+    with SummaryWriter(RedshiftSummary, od.name, format=summary_format) as writer:
+        for input_dir in inputs:
+            writer.append(input_dir)
+        with pytest.raises(FileNotFoundError):
+            writer.append(tempfile.mkdtemp(dir=od.name))
+    sr = RedshiftSummary(output_dir=od.name, format=summary_format)
+    sr.read()
+    assert [r.spectrum for r in sr.summary] == ['spc0', 'spc1']
+    assert [r.redshift for r in sr.summary] == [0.0, 0.1]
+    if summary_format == 'csv':
+        with open(os.path.join(od.name, 'redshift.csv')) as ff:
+            assert ff.read() == ("\t".join(redshift_header) + "\n" +
+                                 row.format(0) + "\n" +
+                                 row.format(1).replace('-1', '-1.0') + "\n")
+
+@pytest.mark.parametrize('summary_format', ['csv', 'feather'])
+@pytest.mark.parametrize('summary_class', [StellarSummary, QsoSummary])
+def test_summary_writer_layout(summary_format, summary_class, caplog):
+    if summary_format != 'csv':
+        pytest.importorskip('pyarrow')
+    od = tempfile.TemporaryDirectory()
+    name = summary_class(output_dir=od.name).__summary_file_name__
+    row = "spc{0}\tspc{0}\t0.{0}\t0.9\tt.dat\tm\t0.1\tC1\t8.5\t1e-17\t4.5\t2e-17\tS"
+    inputs = []
+    for i in range(2):
+        inputs.append(os.path.join(od.name, 'B{}'.format(i)))
+        os.makedirs(inputs[-1])
+    # redshift layout, as written by amazed
+    with open(os.path.join(inputs[0], name), 'w') as ff:
+        ff.write("\t".join(redshift_header) + "\n" + row.format(0) + "\n")
+    # columns in another order and an unknown one, converted
+    columns = redshift_header[1:] + [redshift_header[0][1:], 'Extra']
+    values = row.format(1).split("\t")
+    with open(os.path.join(inputs[1], name), 'w') as ff:
+        ff.write("#" + "\t".join(columns) + "\n" +
+                 "\t".join(values[1:] + values[:1] + ['1']) + "\n")
+    with SummaryWriter(summary_class, od.name,
+                       format=summary_format) as writer:
+        for input_dir in inputs:
+            writer.append(input_dir)
+    assert 'Extra' in caplog.text
+    sr = summary_class(output_dir=od.name, format=summary_format)
+    sr.read()
+    assert [r.spectrum for r in sr.summary] == ['spc0', 'spc1']
+    for result in sr.summary:
+        assert (result.snrha, result.lfha, result.snroII, result.lfoII) == \
+            (8.5, 1e-17, 4.5, 2e-17)
+        assert result.type_ == 'S'
+
 def test_parse_pfsObjectName():
     name = 'pfsObject-999-96321-P,P-0000000000001234-745-0x0000000000000045.fits'
     c, t, p, o, v, h = SpectrumResults._parse_pfsObject_name(name)
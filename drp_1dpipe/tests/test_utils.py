@@ -14,6 +14,8 @@ from drp_1dpipe.core.utils import get_args_from_file, convert_dl_to_ld
 from drp_1dpipe.core.utils import get_auxiliary_path, get_conf_path, normpath, wait_semaphores
 from drp_1dpipe.core.utils import config_update, config_save
 from drp_1dpipe.core.utils import UnconsistencyArgument
+from drp_1dpipe.core.staging import Prefetcher, WriteBehind
+from drp_1dpipe.core.watcher import wait_files, read_exit_code, JobError
 
 
 def test_auxdir():
@@ -162,27 +164,94 @@ def test_config_save():
     assert line.replace(" ","") == "{"+'"k":"v","output_dir":"{}"'.format(fd.name)+"}"
 
 
-# def test_wait_semaphores():
-#
-#     # wait a never created file
-#     _error = []
-#     try:
-#         wait_semaphores(['/file/that/should/not/exist'], 3)
-#     except TimeoutError as e:
-#         _error = e.args[0]
-#     except:
-#         raise
-#
-#     assert _error == ['/file/that/should/not/exist']
-#
-#     # create files before waiting
-#     semaphores = [tempfile.NamedTemporaryFile(prefix='pytest_') for i in range(5)]
-#     wait_semaphores([s.name for s in semaphores], 10, 5)
-#
-#     # create files after waiting
-#     with tempfile.TemporaryDirectory(prefix='pytest_') as tmpdir:
-#         semaphores = [os.path.join(tmpdir, str(i)) for i in range(6)]
-#         t = threading.Thread(target=_create_semaphores, args=(semaphores,))
-#         t.start()
-#         wait_semaphores(semaphores, 50, 5)
-#         t.join(timeout=2)
+def test_wait_semaphores():
+    # wait a never created file
+    with pytest.raises(TimeoutError) as e:
+        wait_semaphores(['/file/that/should/not/exist'], 1, 0.2)
+    assert e.value.args[0] == ['/file/that/should/not/exist']
+
+    # create files after waiting
+    with tempfile.TemporaryDirectory(prefix='pytest_') as tmpdir:
+        semaphores = [os.path.join(tmpdir, str(i)) for i in range(2)]
+        t = threading.Thread(target=_create_semaphores, args=(semaphores,))
+        t.start()
+        wait_semaphores(semaphores, 50, 5)
+        t.join(timeout=2)
+
+
+def _write_exit_codes(paths):
+    """Write the exit code of each file, 0.05 seconds apart"""
+    for code, path in enumerate(paths):
+        time.sleep(0.05)
+        with open(path, 'w') as f:
+            f.write('{}\n'.format(code))
+
+
+def test_wait_files():
+    with tempfile.TemporaryDirectory(prefix='pytest_') as tmpdir:
+        paths = [os.path.join(tmpdir, '{}.done'.format(i)) for i in range(3)]
+        t = threading.Thread(target=_write_exit_codes, args=(paths,))
+        start = time.monotonic()
+        t.start()
+        codes = wait_files(paths, timeout=10, max_tick=5)
+        t.join(timeout=2)
+        # woken by the writes, not by the 5 seconds tick
+        assert time.monotonic() - start < 4
+        assert codes == {p: i for i, p in enumerate(paths)}
+
+        # the job ended without writing its files
+        lost = os.path.join(tmpdir, 'lost.done')
+        codes = wait_files([paths[0], lost], timeout=10, max_tick=0.05,
+                           job_alive=lambda: False, state_interval=0.1,
+                           grace=0.3)
+        assert codes == {paths[0]: 0, lost: None}
+
+        # a file showing up late after the job end is not lost
+        late = os.path.join(tmpdir, 'late.done')
+        t = threading.Thread(target=_write_exit_codes, args=([late],))
+        t.start()
+        codes = wait_files([late], timeout=10, max_tick=0.05,
+                           job_alive=lambda: False, state_interval=0.01,
+                           grace=2.)
+        t.join(timeout=2)
+        assert codes == {late: 0}
+
+        # only written files are read
+        reads = []
+        def read(path):
+            reads.append(path)
+            return read_exit_code(path)
+        missing = os.path.join(tmpdir, 'missing.done')
+        codes = wait_files([paths[1], missing], read=read, max_tick=0.05,
+                           job_alive=lambda: False, state_interval=0.01,
+                           grace=0.3)
+        assert codes == {paths[1]: 1, missing: None}
+        assert reads == [paths[1]]
+    assert read_exit_code(lost) is None
+    assert str(JobError({lost: None, paths[1]: 1})) == \
+        "2 task(s) failed : 1.done (exit 1), lost.done (no exit code)"
+
+
+def test_prefetcher():
+    def load(item):
+        if item == 2:
+            raise ValueError(item)
+        return item * 10
+    prefetcher = Prefetcher(range(5), load, 2)
+    values = list(prefetcher)
+    assert [v[0] for v in values] == [0, 1, 2, 3, 4]
+    assert [v[1] for v in values] == [0, 10, None, 30, 40]
+    assert isinstance(values[2][2], ValueError)
+    assert len(prefetcher.depths) == 6
+    assert prefetcher.stall_time >= 0.
+
+
+def test_write_behind():
+    writer = WriteBehind(2)
+    for i in range(5):
+        writer.submit(lambda x: (time.sleep(0.01), x)[1], i)
+    assert writer.results() == [0, 1, 2, 3, 4]
+    assert writer.max_pending <= 2
+    with WriteBehind(2) as writer:
+        writer.submit(time.sleep, 0.05)
+    assert writer._futures[0].done()